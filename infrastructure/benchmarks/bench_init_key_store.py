@@ -0,0 +1,77 @@
+"""
+Operations per second of the init key store with one million stored keys, single-threaded and with concurrent
+requests whose journal records share an fsync. For comparison, the time of one full JSON rewrite, which the store
+did on every change before it used a journal.
+
+Run from the infrastructure directory:
+    python -m benchmarks.bench_init_key_store
+"""
+import os
+import tempfile
+import threading
+import time
+
+from flask import json
+from store.init_key_store import InitKeyStore
+
+NUM_USERS: int = 10000
+KEYS_PER_USER: int = 100
+NUM_OPERATIONS: int = 2000
+NUM_THREADS: int = 8
+
+
+def _add_and_take(storage: InitKeyStore, users: list, num_operations: int) -> None:
+    for index in range(num_operations):
+        user = users[index % len(users)]
+        if index % 2:
+            storage.take_key_for_user(user)
+        else:
+            storage.add_key(user, os.urandom(32))
+
+
+def _measure(storage: InitKeyStore, num_threads: int) -> float:
+    operations_per_thread = NUM_OPERATIONS // num_threads
+    threads = [threading.Thread(target=_add_and_take,
+                                args=(storage, [f'user{index}' for index in range(offset, NUM_USERS, num_threads)],
+                                      operations_per_thread))
+               for offset in range(num_threads)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return operations_per_thread * num_threads / (time.perf_counter() - start)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'init_key_store.json')
+        storage = InitKeyStore(path, compaction_interval=None)
+
+        start = time.perf_counter()
+        for index in range(NUM_USERS):
+            storage.add_keys(f'user{index}', [os.urandom(32) for _ in range(KEYS_PER_USER)])
+        print(f"{NUM_USERS * KEYS_PER_USER} keys stored in {time.perf_counter() - start:.2f}s")
+
+        for num_threads in [1, NUM_THREADS]:
+            print(f"  {num_threads} thread(s): {_measure(storage, num_threads):8.0f} ops/s")
+
+        start = time.perf_counter()
+        storage.compact()
+        print(f"  compaction:       {time.perf_counter() - start:.2f}s")
+        storage.close()
+
+        start = time.perf_counter()
+        storage = InitKeyStore(path, compaction_interval=None)
+        print(f"  startup:          {time.perf_counter() - start:.2f}s")
+        storage.close()
+
+        start = time.perf_counter()
+        with open(path + '.rewrite', 'w') as handle:
+            json.dump(storage.keys, handle)
+        print(f"  full rewrite:     {time.perf_counter() - start:.2f}s per change before")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Server memory and log size of a fanout of a large message to a large group, as well as the time to hand the message
+out to every member.
+
+Run from the infrastructure directory:
+    python -m benchmarks.bench_message_fanout
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+
+from store.message_log import MessageLog
+from store.message_store import Messagestore, stream_json
+
+MESSAGE_SIZE: int = 1024 * 1024
+NUM_RECEIVERS: int = 1000
+
+
+def main():
+    message = {"message": os.urandom(MESSAGE_SIZE // 2).hex(), "is_welcome": False}
+    receivers = [(f"user{index}", "Phone") for index in range(NUM_RECEIVERS)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_directory = os.path.join(directory, "log")
+        storage = Messagestore(os.path.join(directory, "message_store.json"), MessageLog(log_directory))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        storage.add_fanout(receivers, message)
+        fanout_time = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        log_size = sum(os.path.getsize(os.path.join(log_directory, name)) for name in os.listdir(log_directory))
+        print(f"fanout of {MESSAGE_SIZE} bytes to {NUM_RECEIVERS} receivers in {fanout_time:.2f}s")
+        print(f"  memory:   {memory / 1024 / 1024:8.2f} MiB")
+        print(f"  log:      {log_size / 1024 / 1024:8.2f} MiB")
+
+        start = time.perf_counter()
+        num_bytes = 0
+        for user, device in receivers:
+            for chunk in stream_json(storage.get_messages(user, device)):
+                num_bytes += len(chunk)
+        print(f"  fetch:    {time.perf_counter() - start:8.2f}s for {num_bytes / 1024 / 1024:.0f} MiB of responses")
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
 from libMLS.dot_dumper import DotDumper
 from libMLS.session import Session
@@ -22,12 +22,34 @@ class Chat:
         self.users = chat_users
         self.messages = []
         self.session = session
+        # user names in the order of the leaves of the ratchet tree, blank leaves are None
+        self.leaves: List[Optional[str]] = [user.name for user in chat_users]
 
         self.dumper = DotDumper(
             self.session,
             group_name=self.session.get_state().get_group_context().group_id.decode('utf-8')
         )
 
+    def get_leaf_index(self, user_name: str) -> int:
+        return self.leaves.index(user_name)
+
+    def set_leaves(self, leaves: List[Optional[str]]):
+        """
+        Sets the leaves of the chat and updates the users accordingly
+        """
+        self.leaves = leaves
+        self.users = [User(name) for name in leaves if name is not None]
+
+    def remove_leaves(self, user_names: List[str]):
+        """
+        Blanks the leaves of the given users and truncates blank leaves at the right edge, as the ratchet tree does
+        """
+        leaves = [name if name not in user_names else None for name in self.leaves]
+        while leaves and leaves[-1] is None:
+            leaves.pop()
+
+        self.set_leaves(leaves)
+
     @classmethod
     def from_welcome(cls, chat_users, groupname, session) -> "Chat":
         return cls(chat_users=chat_users, groupname=groupname, session=session)
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Union, List
+from typing import Union, List, Optional
 
 from dataclasses import dataclass
 
@@ -9,24 +9,29 @@ from libMLS.message_packer import pack_dynamic, unpack_dynamic
 
 @dataclass
 class ChatUserListMessage(AbstractMessage):
-    user_names: List[str]
+    """
+    User names in the order of the leaves in the ratchet tree. Blank leaves (i.e. removed users) are None and
+    encoded as empty lines.
+    """
+    user_names: List[Optional[str]]
 
     @classmethod
     def from_bytes(cls, data: bytes):
         box: tuple = unpack_dynamic('V', data)
 
         user_bytes: bytes = box[0]
-        users = user_bytes.decode('UTF-8').split('\n')
+        users = [name if name != '' else None for name in user_bytes.decode('UTF-8').split('\n')]
 
         # pylint: disable=unexpected-keyword-arg
         return cls(user_names=users)
 
     def _pack(self) -> bytes:
-        return pack_dynamic('V', '\n'.join(self.user_names).encode('UTF-8'))
+        return pack_dynamic('V', '\n'.join([name if name is not None else '' for name in self.user_names])
+                            .encode('UTF-8'))
 
     def validate(self) -> bool:
         for name in self.user_names:
-            if name.find('\n') != -1:
+            if name is not None and (name == '' or name.find('\n') != -1):
                 return False
 
         return True
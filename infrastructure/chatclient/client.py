@@ -4,15 +4,16 @@ MLS CLient
 import json
 from typing import List, Dict, Optional
 
-import requests
-
-from libMLS.abstract_application_handler import AbstractApplicationHandler
-from libMLS.messages import WelcomeInfoMessage, MLSCiphertext, GroupOperation
+from libMLS.abstract_application_handler import AbstractApplicationHandler, HandlerEvent
+from libMLS.messages import WelcomeInfoMessage, GroupOperation
+from libMLS.private_key_store import SQLitePrivateKeyStore
 from libMLS.session import Session
+from libMLS.session_manager import SessionManager
 
 from chatclient.chat import Chat
 from chatclient.message import Message
-from chatclient.key_service import KeyService
+from chatclient.key_service import KeyService, InitKeyReplenisher, InitKeyPrefetcher
+from chatclient.transport import HttpTransport
 from chatclient.user import User
 
 from .chat_protocol import ChatProtocolMessage, ChatMessage, ChatUserListMessage, ChatProtocolMessageType
@@ -26,32 +27,47 @@ class MLSClient(AbstractApplicationHandler):
         """
         checks a given ip_address for a running MLS Auth Server
         """
-        try:
-            response = requests.get("http://" + self.auth_server + "/")
-            return response.text == "MLS AUTH SERVER"
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        response = self.transport.get(self.auth_server, "/", retry=True)
+        return response.text == "MLS AUTH SERVER"
 
 
     def check_dir_server(self) -> bool:
         """
         checks a given ip_address for a running MLS Dir Server
         """
-        try:
-            response = requests.get("http://" + self.dir_server + "/")
-            return response.text == "MLS DIR SERVER"
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        response = self.transport.get(self.dir_server, "/", retry=True)
+        return response.text == "MLS DIR SERVER"
 
-    def __init__(self, auth_server: str, dir_server: str, user: str, device: str):
+    def __init__(self, auth_server: str, dir_server: str, user: str, device: str,
+                 transport: Optional[HttpTransport] = None, prefetch_init_keys: bool = False,
+                 key_store_path: Optional[str] = None):
         super().__init__()
         self.auth_server = auth_server
         self.dir_server = dir_server
         self.user = user
         self.device = device
         self.chats: Dict[str, Chat] = {}
-        self.keystore = KeyService(user, dir_server)
-        self.keystore.clear_data(self.user, self.device)
+        # routes the polled messages to the sessions of the chats
+        self.sessions = SessionManager()
+        self._batch_state_path: Optional[str] = None
+        # connections to both servers are pooled in one transport
+        self.transport: HttpTransport = transport if transport is not None else HttpTransport()
+        if key_store_path is None:
+            self.keystore = KeyService(user, dir_server, self.transport)
+            # the private keys of init keys at the dirserver are lost with the last run
+            self.keystore.clear_data(self.user, self.device)
+        else:
+            self.keystore = KeyService(user, dir_server, self.transport, SQLitePrivateKeyStore(key_store_path))
+        # keep enough init keys at the dirserver, so others can add this user to groups
+        self.key_replenisher = InitKeyReplenisher(self.keystore)
+        self.key_replenisher.start()
+
+        # serve the init keys of recent contacts locally, so adding them to a group does not wait for the dirserver
+        self.key_prefetcher: Optional[InitKeyPrefetcher] = None
+        if prefetch_init_keys:
+            self.key_prefetcher = InitKeyPrefetcher(self.keystore)
+            self.keystore.set_prefetcher(self.key_prefetcher)
+            self.key_prefetcher.start()
 
     def get_auth_key(self, user: str, device: str):
         """
@@ -61,7 +77,7 @@ class MLSClient(AbstractApplicationHandler):
         :return:
         """
         params = {"user": user, "device": device}
-        requests.get("http://" + self.auth_server + "/keys", params=params)
+        self.transport.get(self.auth_server, "/keys", params=params)
 
     def publish_auth_key(self, user: str, device: str, key: str):
         """
@@ -72,7 +88,7 @@ class MLSClient(AbstractApplicationHandler):
         :return:
         """
         key_data = json.dumps({"user": user, "device": device, "long_term_key": key})
-        requests.post("http://" + self.auth_server + "/keys", data=key_data)
+        self.transport.post(self.auth_server, "/keys", data=key_data)
 
     def send_welcome_to_user(self, user_name: str, message: WelcomeInfoMessage):
         message_data = json.dumps(
@@ -80,8 +96,7 @@ class MLSClient(AbstractApplicationHandler):
                 "receivers": [{"user": user_name, "device": "phone"}],
                 "message": {"message": message.pack().hex(), "is_welcome": True}
             })
-        requests.post("http://" + self.dir_server + "/message",
-                      data=message_data)
+        self.transport.post(self.dir_server, "/message", data=message_data)
 
     def send_message_to_group(self,
                               group_name: str,
@@ -97,70 +112,84 @@ class MLSClient(AbstractApplicationHandler):
         :param handshake:
         :param message: The Message itself
         """
-        try:
-            if message is not None and handshake is not None or handshake is None and message is None:
-                raise ValueError("Specify either a handshake or an app message")
-
-            chat = self.chats[group_name]
-
-            all_users = []
-            for some_user in chat.users:
-                all_users.append({"user": some_user.name, "device": some_user.devices[0]})
-
-            # print(f"Sending message to users [{';'.join([u.name for u in chat.users])}]")
-            if message is not None:
-                encrypted_message = chat.session.encrypt_application_message(message=message)
-            else:
-                encrypted_message = chat.session.encrypt_handshake_message(group_op=handshake)
-
-            message_data = json.dumps(
-                {
-                    "receivers": all_users,
-                    "message": {"message": encrypted_message.pack().hex(), "is_welcome": False}
-                }
-            )
-            response = requests.post("http://" + self.dir_server + "/message",
-                                     data=message_data)
-            # print(response.text)
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        if message is not None and handshake is not None or handshake is None and message is None:
+            raise ValueError("Specify either a handshake or an app message")
+
+        chat = self.chats[group_name]
+
+        all_users = []
+        for some_user in chat.users:
+            all_users.append({"user": some_user.name, "device": some_user.devices[0]})
+
+        # print(f"Sending message to users [{';'.join([u.name for u in chat.users])}]")
+        if message is not None:
+            encrypted_message = chat.session.encrypt_application_message(message=message)
+        else:
+            encrypted_message = chat.session.encrypt_handshake_message(group_op=handshake)
+
+        message_data = json.dumps(
+            {
+                "receivers": all_users,
+                "message": {"message": encrypted_message.pack().hex(), "is_welcome": False}
+            }
+        )
+        response = self.transport.post(self.dir_server, "/message", data=message_data)
+        # print(response.text)
 
     def get_messages(self, user: str, device: str):
         """
         Requests messages from dirserver using own identity
         :return:
         """
-        try:
-            params = {"user": user, "device": device}
-            response = requests.get("http://" + self.dir_server + "/message", params=params)
-
-            # print(response.content)
-
-            if response.status_code != 200:
-                raise RuntimeError(f'GetMessage status code {response.status_code}')
-
-            messages: Dict = json.loads(response.content)
-            print(f"Got {len(messages)} messages!")
-
-            for message in messages:
-                print(message)
-                message_wrapper = message['message']
-                is_welcome: bool = message_wrapper['is_welcome']
-                message_content: bytes = bytes.fromhex(message_wrapper['message'])
-
-                if is_welcome:
-                    session: Session = Session.from_welcome(WelcomeInfoMessage.from_bytes(message_content), self.keystore,
-                                                            self.user)
-                    chat_name = session.get_state().get_group_context().group_id.decode('ASCII')
-                    self.chats[chat_name] = Chat.from_welcome([], chat_name, session)
-                    print("Got added to group " + chat_name)
-                    continue
-
-                name = Session.get_groupid_from_cipher(data=message_content).decode('UTF-8')
-                self.chats[name].session.process_message(message=MLSCiphertext.from_bytes(message_content), handler=self)
-            return len(messages)
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        params = {"user": user, "device": device}
+        # the dirserver empties the queue when it answers, a retry would lose the messages of a timed out answer
+        response = self.transport.get(self.dir_server, "/message", params=params, retry=False)
+
+        # print(response.content)
+
+        if response.status_code != 200:
+            raise RuntimeError(f'GetMessage status code {response.status_code}')
+
+        messages: Dict = json.loads(response.content)
+        print(f"Got {len(messages)} messages!")
+
+        ciphertexts: List[bytes] = []
+        for message in messages:
+            print(message)
+            message_wrapper = message['message']
+            is_welcome: bool = message_wrapper['is_welcome']
+            message_content: bytes = bytes.fromhex(message_wrapper['message'])
+
+            if is_welcome:
+                session: Session = Session.from_welcome(WelcomeInfoMessage.from_bytes(message_content), self.keystore,
+                                                        self.user)
+                chat_name = session.get_state().get_group_context().group_id.decode('ASCII')
+                self._add_chat(Chat.from_welcome([], chat_name, session))
+                print("Got added to group " + chat_name)
+                continue
+
+            ciphertexts.append(message_content)
+
+        # messages of groups we got removed from are dropped as well
+        group_ids = set()
+        for result in self.sessions.process_messages(ciphertexts, handler=self):
+            if result.header is None:
+                print(f"Dropped malformed message: {result.error}")
+                continue
+
+            group_ids.add(result.header.group_id)
+            for failed in [result] + result.released:
+                if not failed.processed:
+                    print(f"Dropped message of epoch {failed.header.epoch} in group {failed.header.group_id!r}: "
+                          f"{failed.error}")
+
+        for group_id in group_ids:
+            session = self.sessions.get_session(group_id)
+            if session is not None and session.get_reorder_buffer().get_depth() > 0:
+                print(f"Holding back messages of group {group_id!r}: {session.get_reorder_buffer().get_metrics()}")
+
+        self._precompute_updates()
+        return len(messages)
 
     def on_application_message(self, application_data: bytes, group_id: str):
 
@@ -176,14 +205,14 @@ class MLSClient(AbstractApplicationHandler):
             self.chats[group_id].messages.append(message)
             print(f"Received Message in Group {group_id}:\n{msg.contents.message}")
         elif isinstance(msg.contents, ChatUserListMessage):
-            users_string = ", ".join(msg.contents.user_names)
+            users_string = ", ".join([name for name in msg.contents.user_names if name is not None])
             message = Message(description="User List:",
                               message=users_string,
                               protocol=True)
             message.state_path = self.dump_state_image(group_id)
 
             self.chats[group_id].messages.append(message)
-            self.chats[group_id].users = [User(name) for name in msg.contents.user_names]
+            self.chats[group_id].set_leaves(msg.contents.user_names)
             print(f"Updated members of group {group_id}: {';'.join([user.name for user in self.chats[group_id].users])}")
         else:
             raise RuntimeError()
@@ -198,6 +227,19 @@ class MLSClient(AbstractApplicationHandler):
 
         self.send_message_to_group(group_name=group_id, message=name_update_msg.pack())
 
+    def on_batch_processed(self, group_id: bytes, events: List[HandlerEvent]):
+        group_name = group_id.decode('ASCII')
+        # all notifications of a batch see the same state, so it is dumped only once
+        self._batch_state_path = self.dump_state_image(group_name)
+        try:
+            for event in events:
+                if group_name not in self.chats:
+                    # we got removed from this group, the remaining messages are of no interest
+                    break
+                getattr(self, event.callback)(*event.args)
+        finally:
+            self._batch_state_path = None
+
     def on_group_welcome(self, session: Session):
 
         groupname = session.get_state().get_group_context().group_id.decode('ASCII')
@@ -207,7 +249,7 @@ class MLSClient(AbstractApplicationHandler):
             session=session,
         )
 
-        self.chats[groupname] = chat
+        self._add_chat(chat)
 
         message = Message(description="Welcome Message:",
                           message=groupname,
@@ -234,6 +276,23 @@ class MLSClient(AbstractApplicationHandler):
 
         self.chats[group_name].messages.append(message)
 
+    def on_group_member_removed(self, group_id: bytes):
+        group_name = group_id.decode('ASCII')
+        chat = self.chats[group_name]
+
+        if not chat.session.is_member():
+            print(f"Got removed from group {group_name}")
+            del self.chats[group_name]
+            self.sessions.remove_session(group_id)
+            return
+
+        message = Message(description="Group Member Removed!",
+                          message=group_name,
+                          protocol=True)
+        message.state_path = self.dump_state_image(group_name)
+
+        chat.messages.append(message)
+
     def group_creation(self, group_name: str):
         """
         create a group with yourself and user
@@ -250,18 +309,15 @@ class MLSClient(AbstractApplicationHandler):
         # Send welcome messaged directly to the member added first
 
         # Add further Members with group_add
-        try:
-            print(group_name)
-            self.chats[group_name] = Chat.from_empty(User(self.user), group_name, self.keystore)
-            print(self.chats[group_name])
-            message = Message(description="Dummy Message: Group Created",
-                              message=group_name,
-                              protocol=True)
-            message.state_path = self.dump_state_image(group_name)
+        print(group_name)
+        self._add_chat(Chat.from_empty(User(self.user), group_name, self.keystore))
+        print(self.chats[group_name])
+        message = Message(description="Dummy Message: Group Created",
+                          message=group_name,
+                          protocol=True)
+        message.state_path = self.dump_state_image(group_name)
 
-            self.chats[group_name].messages.append(message)
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError()
+        self.chats[group_name].messages.append(message)
 
 
     def group_add(self, group_name: str, user: str):
@@ -278,32 +334,67 @@ class MLSClient(AbstractApplicationHandler):
         # update state(every member)
 
         # send welcome message
-        try:
-            chat = self.chats[group_name]
+        chat = self.chats[group_name]
+
+        welcome, add = chat.session.add_member(user, b'0')
+        group_op = GroupOperation.from_instance(add)
+
+        # add_payload = chat.session.encrypt_handshake_message(add)
+
+        self.send_welcome_to_user(user, welcome)
+        chat.set_leaves(chat.leaves + [user])
+        self.send_message_to_group(group_name=group_name, handshake=group_op)
 
-            welcome, add = chat.session.add_member(user, b'0')
-            group_op = GroupOperation.from_instance(add)
+        self._send_user_list(chat)
 
-            # add_payload = chat.session.encrypt_handshake_message(add)
+    def group_remove(self, group_name: str, users: List[str]):
+        """
+        Remove one or more members from a group. Several members are removed with a single BulkRemoveMessage, so
+        the group only advances one epoch.
+        :param group_name:
+        :param users: names of the users to remove
+        :return:
+        """
+        chat = self.chats[group_name]
+
+        leaf_indices = [chat.get_leaf_index(user) for user in users]
+        if len(leaf_indices) == 1:
+            remove = chat.session.remove_member(leaf_indices[0])
+        else:
+            remove = chat.session.remove_members(leaf_indices)
+
+        # the removed users still receive the remove, so they know that they are not part of the group anymore
+        self.send_message_to_group(group_name=group_name, handshake=GroupOperation.from_instance(remove))
+        chat.remove_leaves(users)
 
-            self.send_welcome_to_user(user, welcome)
-            chat.users.append(User(user))
-            self.send_message_to_group(group_name=group_name, handshake=group_op)
+        self._send_user_list(chat)
 
-            # pylint: disable=unexpected-keyword-arg
-            name_update_msg = ChatProtocolMessage(
-                msg_type=ChatProtocolMessageType.USER_LIST,
-                contents=ChatUserListMessage(user_names=[user.name for user in chat.users])
-            )
+    def _send_user_list(self, chat: Chat):
+        # pylint: disable=unexpected-keyword-arg
+        name_update_msg = ChatProtocolMessage(
+            msg_type=ChatProtocolMessageType.USER_LIST,
+            contents=ChatUserListMessage(user_names=chat.leaves)
+        )
 
-            self.send_message_to_group(group_name=group_name, message=name_update_msg.pack())
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        self.send_message_to_group(group_name=chat.name, message=name_update_msg.pack())
 
     def group_update(self, chat: Chat):
         update_message = chat.session.update()
         group_op = GroupOperation.from_instance(update_message)
         self.send_message_to_group(group_name=chat.name, handshake=group_op)
+        chat.session.precompute_update()
+
+    def _add_chat(self, chat: Chat):
+        self.chats[chat.name] = chat
+        self.sessions.add_session(chat.session)
+
+    def _precompute_updates(self):
+        """
+        Use the idle time after polling to prepare the next update of each chat
+        """
+        for chat in self.chats.values():
+            if chat.session.is_member():
+                chat.session.precompute_update()
 
     def get_recievers(self, chat_identifier: str) -> List[User]:
         """
@@ -315,4 +406,6 @@ class MLSClient(AbstractApplicationHandler):
         return []
 
     def dump_state_image(self, group_name: str):
+        if self._batch_state_path is not None:
+            return self._batch_state_path
         return self.chats[group_name].dumper.dump_next_state()
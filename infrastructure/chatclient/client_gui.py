@@ -7,13 +7,12 @@ from chatclient.client import *
 from chatclient.chat_protocol import *
 from chatclient.message import Message
 from chatclient.key_service import NoKeysAvailableException
+from chatclient.transport import HttpTransport
 
 from dataclasses import dataclass
 import sys
 import json
 import argparse
-import os
-import requests
 
 APP = None
 
@@ -196,9 +195,7 @@ class MainMenuBar(QToolBar):
 
     def post_init_key_button_function(self):
         try:
-            for _ in range(10):
-                key = os.urandom(10)
-                self.client.keystore.register_keypair(key, b'0')
+            self.client.keystore.register_keypairs(self.client.key_replenisher.generate_keypairs(10))
             self.message_box = QMessageBox()
             self.message_box.setText("10 init-keys stored on dirserver")
             self.message_box.move(self.gui.pos())
@@ -510,11 +507,11 @@ class SetUpWindow(QWidget):
 
     def check_dir_server(self):
         try:
-            response = requests.get("http://" + self.dir_server_line_edit.text() + "/")
+            response = HttpTransport(max_retries=0).get(self.dir_server_line_edit.text(), "/")
             if response.text != "MLS DIR SERVER":
-                raise requests.exceptions.ConnectionError
+                raise ConnectionError
             return True
-        except requests.exceptions.ConnectionError:
+        except ConnectionError:
             self.check_dir_server_message_box = QMessageBox()
             self.check_dir_server_message_box.setText(f"No Dir Server reachable on this IP")
             self.check_dir_server_message_box.move(self.pos())
@@ -522,10 +519,10 @@ class SetUpWindow(QWidget):
 
     def check_auth_server(self):
         try:
-            response = requests.get("http://" + self.auth_server_line_edit.text() + "/")
+            response = HttpTransport(max_retries=0).get(self.auth_server_line_edit.text(), "/")
             if response.text != "MLS AUTH SERVER":
-                raise requests.exceptions.ConnectionError
-        except requests.exceptions.ConnectionError:
+                raise ConnectionError
+        except ConnectionError:
             self.check_auth_server_message_box = QMessageBox()
             self.check_auth_server_message_box.setText(f"No Auth Server reachable on this IP")
             self.check_auth_server_message_box.move(self.pos())
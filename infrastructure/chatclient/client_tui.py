@@ -48,6 +48,13 @@ class Menu:
         if menu_item == 8:
             group_name = input("Group Name:").strip()
             self.client.dump_state_image(group_name=group_name)
+        if menu_item == 9:
+            # Remove members
+            group_name = input("Group Name:").strip()
+            users_to_remove = input("Users to remove (comma separated):").strip()
+
+            self.client.group_remove(group_name=group_name,
+                                     users=[user.strip() for user in users_to_remove.split(',') if user.strip()])
 
 
 def parse_arguments():
@@ -56,6 +63,8 @@ def parse_arguments():
     parser.add_argument('-d', '--device', default='phone', type=str)
     parser.add_argument('-ds', '--dirserver', default='127.0.0.1:5001', type=str)
     parser.add_argument('-as', '--authserver', default='127.0.0.1:5000', type=str)
+    parser.add_argument('-p', '--prefetch', action='store_true', help='prefetch the init keys of recent contacts')
+    parser.add_argument('-k', '--keystore', default=None, type=str, help='file which keeps the private init keys')
     return parser.parse_args()
 
 def print_main_menu():
@@ -68,6 +77,7 @@ def print_main_menu():
     print("6) Add Member")
     print("7) Update Keys")
     print("8) Dump state")
+    print("9) Remove Members")
     print("99) Exit")
     print("+++++++++++++++++++++++++++++++++")
 
@@ -82,7 +92,8 @@ def main():
     # load config_file
 
 
-    client = MLSClient(args.authserver, args.dirserver, args.user, args.device)
+    client = MLSClient(args.authserver, args.dirserver, args.user, args.device, prefetch_init_keys=args.prefetch,
+                       key_store_path=args.keystore)
 
     print(f"----Chatclient for----")
     print(f"\tUser: {args.user}")
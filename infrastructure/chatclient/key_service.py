@@ -1,9 +1,30 @@
 import json
-from typing import Optional, Dict
-
-import requests
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Tuple, Callable, Deque
 
 from libMLS.abstract_keystore import AbstractKeystore
+from libMLS.cipher_suite import CipherSuite
+from libMLS.private_key_store import PrivateKeyStore
+from libMLS.x25519_cipher_suite import X25519CipherSuite
+
+from chatclient.transport import HttpTransport
+
+DEFAULT_KEY_BATCH_SIZE: int = 32
+DEFAULT_LOW_WATERMARK: int = 8
+# seconds between two polls of the number of remaining init keys
+DEFAULT_POLL_INTERVAL: float = 30.0
+
+DEFAULT_KEYS_PER_CONTACT: int = 2
+DEFAULT_MAX_CONTACTS: int = 32
+# seconds a prefetched key is held before it is returned to the server
+DEFAULT_PREFETCH_TTL: float = 600.0
+DEFAULT_REFRESH_INTERVAL: float = 60.0
+# taking a key wakes the prefetcher once a contact has fewer keys left
+DEFAULT_PREFETCH_WATERMARK: int = 1
 
 
 class NoKeysAvailableException(Exception):
@@ -12,51 +33,424 @@ class NoKeysAvailableException(Exception):
 
 class KeyService(AbstractKeystore):
 
-    def __init__(self, user_name: str, dir_server_url: str):
+    def __init__(self, user_name: str, dir_server_url: str, transport: Optional[HttpTransport] = None,
+                 private_keys: Optional[PrivateKeyStore] = None):
+        """
+        :param private_keys: the private keys of the init keys of this user, kept in memory if None
+        """
         super().__init__(user_name)
         self._username = user_name
         self._dir_server_url = dir_server_url
-        self._private_public_map: Dict[bytes, bytes] = {}
+        self._transport: HttpTransport = transport if transport is not None else HttpTransport()
+        self._private_keys: PrivateKeyStore = private_keys if private_keys is not None else PrivateKeyStore()
+        self._prefetcher: Optional['InitKeyPrefetcher'] = None
+
+    def set_prefetcher(self, prefetcher: Optional['InitKeyPrefetcher']) -> None:
+        """
+        Serves init keys from the given prefetcher, if it holds keys of the requested users
+        """
+        self._prefetcher = prefetcher
 
     def register_keypair(self, public_key: bytes, private_key: bytes):
-        try:
-            keydata = json.dumps({"user": self._username, "key": public_key.hex(), "identifier": ""})
-            response = requests.post("http://" + self._dir_server_url + "/keys", data=keydata)
-            if response.status_code == 200:
-                self._private_public_map[public_key] = private_key
-            else:
-                raise RuntimeError("Failed to store key at server")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+        keydata = json.dumps({"user": self._username, "key": public_key.hex(), "identifier": ""})
+        response = self._transport.post(self._dir_server_url, "/keys", data=keydata)
+        if response.status_code == 200:
+            self._private_keys.add_keypairs([(public_key, private_key)])
+        else:
+            raise RuntimeError("Failed to store key at server")
+
+    def register_keypairs(self, key_pairs: List[Tuple[bytes, bytes]]) -> int:
+        """
+        Uploads several init keys with a single request
+        :param key_pairs: public and private key of each init key
+        :return: the number of init keys of this user at the server, including the new ones
+        """
+        keydata = json.dumps({"user": self._username, "keys": [public_key.hex() for public_key, _ in key_pairs],
+                              "identifier": ""})
+        response = self._transport.post(self._dir_server_url, "/keys", data=keydata)
+        if response.status_code != 200:
+            raise RuntimeError("Failed to store keys at server")
+
+        self._private_keys.add_keypairs(key_pairs)
+
+        return json.loads(response.content)["num_keys"]
+
+    def get_num_init_keys(self) -> int:
+        """
+        :return: the number of init keys of this user which are left at the server
+        """
+        response = self._transport.get(self._dir_server_url, "/keys/count", params={"user": self._username},
+                                       retry=True)
+        if response.status_code != 200:
+            raise RuntimeError("Failed to get the number of keys from server")
+
+        return json.loads(response.content)["num_keys"]
 
     def fetch_init_key(self, user_name: str) -> Optional[bytes]:
-        try:
-            params = {"user": user_name}
-            response = requests.get("http://" + self._dir_server_url + "/keys", params=params)
+        if self._prefetcher is not None:
+            key = self._prefetcher.take_key(user_name)
+            if key is not None:
+                return key
+
+        return self.download_init_key(user_name)
+
+    def fetch_init_keys(self, user_names: List[str]) -> Dict[str, bytes]:
+        """
+        Fetches the init keys of several users, the keys which are not prefetched are fetched with a single request
+        :raises NoKeysAvailableException: if any of the users has no init key left
+        """
+        keys: Dict[str, bytes] = {}
+        if self._prefetcher is not None:
+            for user_name in user_names:
+                key = self._prefetcher.take_key(user_name)
+                if key is not None:
+                    keys[user_name] = key
+
+        missing = [user_name for user_name in user_names if user_name not in keys]
+        if missing:
+            keys.update(self.download_init_keys(missing))
+
+        return keys
+
+    def download_init_key(self, user_name: str) -> bytes:
+        """
+        Takes an init key of a user from the server
+        :raises NoKeysAvailableException: if the user has no init key left
+        """
+        params = {"user": user_name}
+        # the key is taken from the server, a retry might use up a second one
+        response = self._transport.get(self._dir_server_url, "/keys", params=params, retry=False)
+
+        if response.status_code != 200:
+            raise NoKeysAvailableException()
 
-            if response.status_code != 200:
-                raise NoKeysAvailableException()
+        return bytes.fromhex(json.loads(response.content))
 
-            return bytes.fromhex(json.loads(response.content))
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError
+    def download_init_keys(self, user_names: List[str]) -> Dict[str, bytes]:
+        """
+        Takes the init keys of several users from the server with a single request
+        :raises NoKeysAvailableException: if any of the users has no init key left, no key is taken then
+        """
+        response = self._transport.post(self._dir_server_url, "/keys/batch", data=json.dumps({"users": user_names}))
+
+        if response.status_code != 200:
+            raise NoKeysAvailableException()
+
+        return {user_name: bytes.fromhex(key) for user_name, key in json.loads(response.content).items()}
+
+    def release_init_keys(self, user_name: str, keys: List[bytes]) -> None:
+        """
+        Returns unused init keys of another user to the server, e.g. prefetched keys which expired
+        """
+        keydata = json.dumps({"user": user_name, "keys": [key.hex() for key in keys], "identifier": ""})
+        response = self._transport.post(self._dir_server_url, "/keys", data=keydata)
+        if response.status_code != 200:
+            raise RuntimeError("Failed to release keys at server")
 
     def get_private_key(self, public_key: bytes) -> Optional[bytes]:
-        if public_key in self._private_public_map.keys():
-            return self._private_public_map[public_key]
+        return self._private_keys.get_private_key(public_key)
 
-        return None
+    def consume_private_key(self, public_key: bytes) -> Optional[bytes]:
+        # the dirserver hands out each init key only once
+        private_key = self._private_keys.get_private_key(public_key)
+        if private_key is not None:
+            self._private_keys.delete_keys([public_key])
+        return private_key
 
     def is_available(self) -> bool:
         try:
-            requests.get("http://" + self._dir_server_url + "/keys", timeout=2)
-        except requests.exceptions.Timeout:
-            return False
-        except requests.exceptions.ConnectionError:
+            self._transport.get(self._dir_server_url, "/", timeout=2, retry=False)
+        except ConnectionError:
             return False
 
         return True
 
     def clear_data(self, user_name: str, device_name: str) -> None:
         params = {"user": user_name, "device": device_name}
-        requests.delete("http://" + self._dir_server_url + "/clear", params=params)
+        self._transport.delete(self._dir_server_url, "/clear", params=params, retry=False)
+
+
+class _PeriodicWorker:
+    """
+    Background thread which runs a task every interval and whenever it is woken up
+    """
+
+    def __init__(self, name: str, task: Callable[[], object], interval: float, action: str):
+        """
+        :param action: what the task does, for the message printed if it fails
+        """
+        self._name: str = name
+        self._task: Callable[[], object] = task
+        self._interval: float = interval
+        self._action: str = action
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self._task()
+            except (ConnectionError, RuntimeError) as error:
+                print(f"Failed to {self._action}: {error}")
+
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+
+class InitKeyReplenisher:
+    """
+    Keeps the init keys of a user at the dirserver above a low watermark. Each init key is used up by the group
+    member who adds the user, so a popular user runs out of keys when several groups are created in a short time.
+    A background thread polls the number of remaining keys and, once it drops below the watermark, generates a
+    batch of key pairs and uploads them with a single request.
+    """
+
+    def __init__(self, key_service: KeyService, cipher_suite: Optional[CipherSuite] = None,
+                 batch_size: int = DEFAULT_KEY_BATCH_SIZE, low_watermark: int = DEFAULT_LOW_WATERMARK,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self._key_service: KeyService = key_service
+        self._cipher_suite: CipherSuite = cipher_suite if cipher_suite is not None else X25519CipherSuite()
+        self._batch_size: int = batch_size
+        self._low_watermark: int = low_watermark
+        self._worker = _PeriodicWorker("init-key-replenisher", self.replenish, poll_interval, "replenish init keys")
+        self._lock = threading.Lock()
+
+    def generate_keypairs(self, num_keys: int) -> List[Tuple[bytes, bytes]]:
+        return [self._cipher_suite.derive_key_pair(os.urandom(32)) for _ in range(num_keys)]
+
+    def replenish(self, num_keys: Optional[int] = None) -> int:
+        """
+        Uploads a batch of new init keys if the number of keys is below the low watermark
+        :param num_keys: the number of keys left at the server, polled if None
+        :return: the number of uploaded keys
+        """
+        with self._lock:
+            if num_keys is None:
+                num_keys = self._key_service.get_num_init_keys()
+
+            if num_keys >= self._low_watermark:
+                return 0
+
+            # fill up to the watermark at least
+            num_new_keys = max(self._batch_size, self._low_watermark - num_keys)
+            self._key_service.register_keypairs(self.generate_keypairs(num_new_keys))
+            return num_new_keys
+
+    def notify_num_keys(self, num_keys: int) -> None:
+        """
+        Tells the replenisher about the number of keys left at the server, e.g. from a response of the server. The
+        background thread replenishes right away instead of waiting for its next poll if the number is too low.
+        """
+        if num_keys < self._low_watermark:
+            self._worker.wake()
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def stop(self) -> None:
+        self._worker.stop()
+
+
+@dataclass
+class PrefetchConfig:
+    """
+    Tuning parameters of an InitKeyPrefetcher
+    """
+    keys_per_contact: int = DEFAULT_KEYS_PER_CONTACT
+    max_contacts: int = DEFAULT_MAX_CONTACTS
+    # seconds a prefetched key is held before it is returned to the server
+    ttl: float = DEFAULT_PREFETCH_TTL
+    # seconds between two refreshes of the background thread
+    refresh_interval: float = DEFAULT_REFRESH_INTERVAL
+    # taking a key wakes the background thread once the contact has fewer keys left
+    low_watermark: int = DEFAULT_PREFETCH_WATERMARK
+    # the clock of the TTL, replaced in tests
+    clock: Callable[[], float] = time.monotonic
+
+
+@dataclass
+class PrefetchMetrics:
+    num_hits: int = 0
+    num_misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        num_requests = self.num_hits + self.num_misses
+        return self.num_hits / num_requests if num_requests else 0.0
+
+
+class InitKeyPrefetcher:
+    """
+    Holds a few init keys of the recent contacts of a user, so a member can be added to a group without waiting for
+    the dirserver. A background thread refills the keys of all contacts, fetching the first key of every contact with
+    a single batch request. Taking a key wakes it once the contact has fewer keys left than the low watermark.
+
+    Prefetched keys are used up at the server, so keys which are held longer than the TTL and the keys of contacts
+    which are evicted to make room for more recent ones are returned to the server.
+    """
+
+    def __init__(self, key_service: KeyService, config: Optional[PrefetchConfig] = None):
+        self._key_service: KeyService = key_service
+        self._config: PrefetchConfig = config if config is not None else PrefetchConfig()
+        # contacts ordered from least to most recently used, with their keys and the time they were fetched at
+        self._contacts: 'OrderedDict[str, Deque[Tuple[bytes, float]]]' = OrderedDict()
+        # keys which have to be returned to the server
+        self._released: Dict[str, List[bytes]] = {}
+        self._metrics = PrefetchMetrics()
+        self._lock = threading.Lock()
+        self._worker = _PeriodicWorker("init-key-prefetcher", self.refresh, self._config.refresh_interval,
+                                       "prefetch init keys")
+
+    def add_contact(self, user_name: str) -> None:
+        """
+        Starts prefetching the keys of a user, evicting the least recently used contact if there are too many
+        """
+        with self._lock:
+            self._touch(user_name)
+        self._worker.wake()
+
+    def _touch(self, user_name: str) -> None:
+        if user_name in self._contacts:
+            self._contacts.move_to_end(user_name)
+            return
+
+        self._contacts[user_name] = deque()
+        while len(self._contacts) > self._config.max_contacts:
+            evicted, keys = self._contacts.popitem(last=False)
+            if keys:
+                self._released.setdefault(evicted, []).extend(key for key, _ in keys)
+
+    def _expire(self) -> None:
+        now = self._config.clock()
+        for user_name, keys in self._contacts.items():
+            while keys and now - keys[0][1] > self._config.ttl:
+                self._released.setdefault(user_name, []).append(keys.popleft()[0])
+
+    def take_key(self, user_name: str) -> Optional[bytes]:
+        """
+        :return: a prefetched key of the user or None, the user becomes a contact in both cases
+        """
+        with self._lock:
+            self._expire()
+            self._touch(user_name)
+            keys = self._contacts[user_name]
+
+            key = keys.popleft()[0] if keys else None
+            if key is None:
+                self._metrics.num_misses += 1
+            else:
+                self._metrics.num_hits += 1
+            refill = len(keys) < self._config.low_watermark
+
+        if refill:
+            self._worker.wake()
+        return key
+
+    def get_num_keys(self, user_name: str) -> int:
+        with self._lock:
+            return len(self._contacts.get(user_name, ()))
+
+    def get_hit_rate(self) -> float:
+        return self.get_metrics().hit_rate
+
+    def get_metrics(self) -> PrefetchMetrics:
+        with self._lock:
+            # pylint: disable=unexpected-keyword-arg
+            return PrefetchMetrics(num_hits=self._metrics.num_hits, num_misses=self._metrics.num_misses)
+
+    def _download(self, user_names: List[str]) -> Dict[str, bytes]:
+        try:
+            return self._key_service.download_init_keys(user_names)
+        except NoKeysAvailableException:
+            pass
+
+        # some users have no keys left, which fails the whole batch
+        keys: Dict[str, bytes] = {}
+        for user_name in user_names:
+            try:
+                keys[user_name] = self._key_service.download_init_key(user_name)
+            except NoKeysAvailableException:
+                pass
+        return keys
+
+    def refresh(self) -> None:
+        """
+        Returns expired and evicted keys to the server and fills up the keys of all contacts
+        """
+        exhausted: set = set()
+
+        for _ in range(self._config.keys_per_contact):
+            with self._lock:
+                self._expire()
+                user_names = [user_name for user_name, keys in self._contacts.items()
+                              if len(keys) < self._config.keys_per_contact and user_name not in exhausted]
+            if not user_names:
+                break
+
+            keys = self._download(user_names)
+            exhausted.update(user_name for user_name in user_names if user_name not in keys)
+
+            with self._lock:
+                now = self._config.clock()
+                for user_name, key in keys.items():
+                    if user_name in self._contacts:
+                        self._contacts[user_name].append((key, now))
+                    else:
+                        # evicted while the keys were downloaded
+                        self._released.setdefault(user_name, []).append(key)
+
+        self._release()
+
+    def _release(self) -> None:
+        with self._lock:
+            released, self._released = self._released, {}
+
+        pending = list(released.items())
+        while pending:
+            user_name, keys = pending[0]
+            try:
+                self._key_service.release_init_keys(user_name, keys)
+            except (ConnectionError, RuntimeError):
+                # keep the keys for the next attempt
+                with self._lock:
+                    for pending_user_name, pending_keys in pending:
+                        self._released.setdefault(pending_user_name, []).extend(pending_keys)
+                raise
+            pending.pop(0)
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread and returns all held keys to the server
+        """
+        self._worker.stop()
+
+        with self._lock:
+            for user_name, keys in self._contacts.items():
+                if keys:
+                    self._released.setdefault(user_name, []).extend(key for key, _ in keys)
+                    keys.clear()
+        self._release()
@@ -0,0 +1,127 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT: float = 10.0
+DEFAULT_MAX_RETRIES: int = 2
+# seconds before the first retry, doubled for each further retry
+DEFAULT_BACKOFF: float = 0.2
+DEFAULT_POOL_SIZE: int = 8
+
+
+@dataclass
+class TransportMetrics:
+    num_requests: int
+    num_retries: int
+    num_failures: int
+    # seconds, including retries
+    total_latency: float
+    max_latency: float
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.num_requests if self.num_requests else 0.0
+
+
+class HttpTransport:
+    """
+    HTTP connection to the servers, shared by MLSClient and KeyService. Connections are kept alive in a pool per
+    server instead of being opened for every request. Every request has a timeout. Failed connections are only
+    retried with exponential backoff if the caller opts in, as most endpoints of the dirserver change its state even
+    for a GET, e.g. GET /message empties the queue of the device.
+
+    The underlying requests.Session can be injected, e.g. to stub the servers in tests.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff: float = DEFAULT_BACKOFF, pool_size: int = DEFAULT_POOL_SIZE,
+                 session: Optional[requests.Session] = None):
+        self._timeout: float = timeout
+        self._max_retries: int = max_retries
+        self._backoff: float = backoff
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+        self._session: requests.Session = session
+
+        # the transport is used by the key replenisher thread as well
+        self._lock = threading.Lock()
+        self._num_requests: int = 0
+        self._num_retries: int = 0
+        self._num_failures: int = 0
+        self._total_latency: float = 0.0
+        self._max_latency: float = 0.0
+
+    @staticmethod
+    def get_url(server: str, path: str) -> str:
+        """
+        :param server: host and port of the server, e.g. 127.0.0.1:5001
+        :param path: the path of the endpoint, starting with /
+        """
+        return "http://" + server + path
+
+    def request(self, method: str, server: str, path: str, timeout: Optional[float] = None,
+                retry: bool = False, **kwargs) -> requests.Response:
+        """
+        Sends a request, see requests.Session.request for the keyword arguments
+        :param method: the HTTP method
+        :param server: see get_url
+        :param path: see get_url
+        :param timeout: the timeout of each attempt in seconds, the default timeout of the transport if None
+        :param retry: whether to retry after connection errors and timeouts, only for requests which the server may
+                      process twice, as a timed out request might have been processed already
+        :raises ConnectionError: if the server could not be reached
+        """
+        method = method.upper()
+        num_retries = self._max_retries if retry else 0
+        start = time.perf_counter()
+        attempt = 0
+
+        while True:
+            try:
+                response = self._session.request(method, self.get_url(server, path),
+                                                 timeout=self._timeout if timeout is None else timeout, **kwargs)
+                self._record(time.perf_counter() - start, attempt, failed=False)
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if attempt == num_retries:
+                    self._record(time.perf_counter() - start, attempt, failed=True)
+                    raise ConnectionError(f"{method} {path} at {server} failed: {error}") from error
+
+            time.sleep(self._backoff * 2 ** attempt)
+            attempt += 1
+
+    def get(self, server: str, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", server, path, **kwargs)
+
+    def post(self, server: str, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", server, path, **kwargs)
+
+    def delete(self, server: str, path: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", server, path, **kwargs)
+
+    def _record(self, latency: float, num_retries: int, failed: bool) -> None:
+        with self._lock:
+            self._num_requests += 1
+            self._num_retries += num_retries
+            self._num_failures += 1 if failed else 0
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+    def get_metrics(self) -> TransportMetrics:
+        with self._lock:
+            # pylint: disable=unexpected-keyword-arg
+            return TransportMetrics(num_requests=self._num_requests,
+                                    num_retries=self._num_retries,
+                                    num_failures=self._num_failures,
+                                    total_latency=self._total_latency,
+                                    max_latency=self._max_latency)
+
+    def close(self) -> None:
+        self._session.close()
@@ -2,14 +2,15 @@
 MLS Dirserver
 """
 import json
-from flask import Flask, request
+from flask import Flask, Response, request
 
 from store.init_key_store import InitKeyStore
-from store.message_store import Message, Messagestore
+from store.message_log import MessageLog
+from store.message_store import Messagestore, stream_json
 
 APP = Flask(__name__)
 INITKEYSTORE = InitKeyStore("./init_key_store.json")
-MESSAGESTORE = Messagestore("./message_store.json")
+MESSAGESTORE = Messagestore("./message_store.json", MessageLog("./message_log"))
 
 
 def main():
@@ -43,6 +44,31 @@ def get_init_key():
         return "Get has wrong format", 400
 
 
+@APP.route('/keys/batch', methods=["GET", "POST"])
+def get_init_keys():
+    """
+    Return one init_key of each requested user, e.g. for the creation of a group. The users are given as repeated
+    user query parameters or as a posted users list, which is not limited by the length of the URL. Either all keys
+    are taken or none.
+    """
+    try:
+        if request.method == "POST":
+            users = json.loads(request.data)["users"]
+        else:
+            users = request.args.getlist("user")
+
+        if not isinstance(users, list) or not users:
+            return "Request at least one user", 400
+
+        keys = INITKEYSTORE.take_keys(users)
+        if keys is None:
+            return json.dumps([user for user in users if not INITKEYSTORE.has_key(user)]), 400
+
+        return json.dumps({user: key.hex() for user, key in keys.items()}), 200
+    except (KeyError, TypeError, ValueError):
+        return "Request has wrong format", 400
+
+
 @APP.route('/keys', methods=["POST"])
 def add_init_keys():
     """
@@ -54,17 +80,27 @@ def add_init_keys():
         if "key" in data:
             INITKEYSTORE.add_key(user=data["user"], key=bytes.fromhex(data["key"]), identifier=data["identifier"])
             return "OK", 200
-        # if "keys" in data:
-        #     for key in data["keys"]:
-        #         key_bytes = key.encode("ascii")
-        #         init_key = InitKey(data["identifier"], data["user"], key_bytes)
-        #         INITKEYSTORE.add_key(data["user"], key)
-        #     return "OK", 200
+        if "keys" in data:
+            INITKEYSTORE.add_keys(user=data["user"], keys=[bytes.fromhex(key) for key in data["keys"]],
+                                  identifier=data["identifier"])
+            # tell the client how many keys are left, so it can replenish them
+            return json.dumps({"num_keys": INITKEYSTORE.get_num_keys(data["user"])}), 200
         return "Send either key with one key or Keys with list of keys", 400
-    except KeyError:
+    except (KeyError, ValueError):
         return "Post has wrong format", 400
 
 
+@APP.route('/keys/count', methods=["GET"])
+def get_num_init_keys():
+    """
+    Return the number of init_keys left for a user
+    """
+    try:
+        return json.dumps({"num_keys": INITKEYSTORE.get_num_keys(request.args["user"])}), 200
+    except KeyError:
+        return "Get has wrong format", 400
+
+
 @APP.route('/message', methods=["POST"])
 def message_fanout():
     """
@@ -72,12 +108,9 @@ def message_fanout():
     """
     data = json.loads(request.data)
     try:
-        receivers = data["receivers"]
-        message = data["message"]
-        for receiver in receivers:
-            jans_gutes_message_object = Message(receiver["user"], receiver["device"], message)
-            MESSAGESTORE.add_element(jans_gutes_message_object)
-        print(len(MESSAGESTORE.elements))
+        receivers = [(receiver["user"], receiver["device"]) for receiver in data["receivers"]]
+        # the message is stored once for all receivers
+        MESSAGESTORE.add_fanout(receivers, data["message"])
         return "OK", 200
     except KeyError:
         return "Post has wrong format", 400
@@ -85,10 +118,7 @@ def message_fanout():
 
 def _get_messages(user: str, device: str):
     found_messages = MESSAGESTORE.get_messages(user, device)
-    found_messages_json = []
-    for message in found_messages:
-        found_messages_json.append(message.to_json())
-    return json.dumps(found_messages_json), 200
+    return Response(stream_json(found_messages), mimetype="application/json"), 200
 
 
 @APP.route('/clear', methods=["DELETE"])
@@ -0,0 +1,87 @@
+"""
+Group Commit
+"""
+import os
+import threading
+from typing import IO, Callable
+
+
+class GroupCommit:
+    """
+    Makes the records of an append-only file durable. Records are written under the lock of the file's owner, which
+    is not held while a record is synced. The first thread waiting for its record syncs all records written so far,
+    the threads which wrote records in the meantime only wait for this fsync instead of starting their own.
+
+    The file is synced through a duplicate of its descriptor, so the owner may replace the file while a sync is
+    running, after making the records of the old file durable with sync_now.
+    """
+
+    def __init__(self, lock: threading.Lock, get_file: Callable[[], IO], sync: bool = True):
+        """
+        :param lock: the lock of the owner which guards the file
+        :param get_file: returns the file the records are currently written to
+        :param sync: whether records are fsynced, if not they are only flushed
+        """
+        self._lock = lock
+        self._get_file = get_file
+        self._sync: bool = sync
+
+        self._condition = threading.Condition()
+        self._syncing: bool = False
+        self._num_written: int = 0
+        self._num_synced: int = 0
+
+    def append(self, data) -> int:
+        """
+        Writes a record, the caller holds the lock
+        :return: the number of the record, see wait
+        """
+        self._get_file().write(data)
+        self._num_written += 1
+        return self._num_written
+
+    def sync_now(self) -> int:
+        """
+        Makes all records durable before the call returns, the caller holds the lock, e.g. before the file is closed
+        :return: the number of the last record, see wait
+        """
+        handle = self._get_file()
+        handle.flush()
+        if self._sync:
+            os.fsync(handle.fileno())
+
+        with self._condition:
+            self._num_synced = max(self._num_synced, self._num_written)
+            self._condition.notify_all()
+        return self._num_written
+
+    def wait(self, record_number: int) -> None:
+        """
+        Returns once the given record is durable, the caller does not hold the lock
+        """
+        with self._condition:
+            while self._num_synced < record_number and self._syncing:
+                self._condition.wait()
+            if self._num_synced >= record_number:
+                return
+            self._syncing = True
+
+        num_synced = self._num_synced
+        try:
+            with self._lock:
+                handle = self._get_file()
+                handle.flush()
+                num_written = self._num_written
+                descriptor = os.dup(handle.fileno()) if self._sync else None
+
+            if descriptor is not None:
+                try:
+                    os.fsync(descriptor)
+                finally:
+                    os.close(descriptor)
+            num_synced = num_written
+        finally:
+            with self._condition:
+                self._num_synced = max(self._num_synced, num_synced)
+                self._syncing = False
+                self._condition.notify_all()
@@ -2,45 +2,279 @@
 Init Key Store
 """
 import os
-from typing import Dict, List, Tuple, Optional
+import threading
+from dataclasses import dataclass, field
+from typing import IO, Dict, List, Tuple, Optional
 
 from flask import json
 
+from store.group_commit import GroupCommit
+
+# seconds between two checks whether the journal should be compacted
+DEFAULT_COMPACTION_INTERVAL: float = 60.0
+# number of journal records after which the journal is compacted into the snapshot
+DEFAULT_COMPACTION_THRESHOLD: int = 10000
+
+SNAPSHOT_SUFFIX: str = ".snapshot"
+JOURNAL_SUFFIX: str = ".journal"
+PREVIOUS_JOURNAL_SUFFIX: str = ".journal.prev"
+
+
+@dataclass
+class _Journal:
+    """
+    The open journal, records are appended to it until a compaction replaces it or the store is closed
+    """
+    file: IO
+    generation: int
+    # records since the last compaction
+    num_records: int = 0
+
+
+@dataclass
+class _Compaction:
+    # journal records after which the journal is compacted
+    threshold: int
+    # only one compaction at a time writes the snapshot and the previous journal
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    stopped: threading.Event = field(default_factory=threading.Event)
+    thread: Optional[threading.Thread] = None
+
 
 class InitKeyStore:
+    """
+    Stores the init keys of every user. Every change is appended to a journal instead of rewriting all keys, so a
+    change costs the same for any number of stored keys. Changes of concurrent requests are made durable with one
+    fsync (group commit). A background thread compacts the journal into a snapshot from time to time.
+
+    Files next to the given path:
+        <path>.snapshot         all keys up to the generation stored in it
+        <path>.journal          the changes since then, starting with its generation
+        <path>.journal.prev     the previous journal while a compaction is writing the snapshot
 
-    def __init__(self, path: str):
-        self.keys: Dict[str, List[Tuple[str, bytes]]] = {}
+    Both the snapshot and the journal are replaced atomically, so a crash cannot corrupt them. A record which was cut
+    off by a crash is dropped on startup, its request was never answered. A JSON file of the former format at the
+    path itself is imported on first start and left unchanged.
+    """
+
+    def __init__(self, path: str, compaction_interval: Optional[float] = DEFAULT_COMPACTION_INTERVAL,
+                 compaction_threshold: int = DEFAULT_COMPACTION_THRESHOLD, sync: bool = True):
+        """
+        :param path: path of the store, see above
+        :param compaction_interval: seconds between the checks of the compaction thread, no thread if None
+        :param compaction_threshold: journal records after which the journal is compacted
+        :param sync: whether changes are fsynced before they are acknowledged
+        """
+        self.keys: Dict[str, List[Tuple[str, str]]] = {}
         self.path = os.path.abspath(path)
+        self._sync: bool = sync
+
+        # the dirserver handles requests in several threads, the lock guards the keys and the journal
+        self._lock = threading.Lock()
+        self._group_commit = GroupCommit(self._lock, lambda: self._journal.file, sync)
+        self._journal: _Journal = self._load()
 
-        if os.path.exists(self.path):
-            with open(self.path, 'r') as handle:
+        self._compaction = _Compaction(compaction_threshold)
+        if compaction_interval is not None:
+            self._compaction.thread = threading.Thread(target=self._run_compaction, args=(compaction_interval,),
+                                                       daemon=True)
+            self._compaction.thread.start()
+
+    def _load(self) -> _Journal:
+        snapshot_path = self.path + SNAPSHOT_SUFFIX
+        journal_path = self.path + JOURNAL_SUFFIX
+        previous_journal_path = self.path + PREVIOUS_JOURNAL_SUFFIX
+
+        snapshot_generation = 0
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'r', encoding="utf-8") as handle:
+                snapshot = json.load(handle)
+            snapshot_generation = snapshot["generation"]
+            self.keys = snapshot["keys"]
+        elif os.path.exists(self.path):
+            with open(self.path, 'r', encoding="utf-8") as handle:
                 self.keys = json.load(handle)
 
-    def _on_modify(self):
-        with open(self.path, 'w') as file:
-            json.dump(self.keys, file)
+        # JSON has no tuples
+        self.keys = {user: [tuple(key) for key in user_keys] for user, user_keys in self.keys.items()}
+
+        generation = snapshot_generation
+        num_records = 0
+        for path in [previous_journal_path, journal_path]:
+            if os.path.exists(path):
+                journal_generation, num_journal_records = self._replay(path, snapshot_generation)
+                generation = max(generation, journal_generation)
+                num_records += num_journal_records
+
+        if os.path.exists(previous_journal_path):
+            # a compaction did not finish, the new snapshot covers both journals
+            generation += 1
+            self._write_snapshot(generation, self.keys)
+            self._create_journal(journal_path, generation)
+            os.remove(previous_journal_path)
+            num_records = 0
+        elif not os.path.exists(journal_path) or os.path.getsize(journal_path) == 0:
+            self._create_journal(journal_path, generation)
+
+        return _Journal(self._open_journal(), generation, num_records)
+
+    def _open_journal(self) -> IO:
+        # pylint: disable=consider-using-with
+        # the journal stays open for appending until a compaction replaces it or the store is closed
+        return open(self.path + JOURNAL_SUFFIX, 'a', encoding="utf-8")
+
+    def _replay(self, journal_path: str, snapshot_generation: int) -> Tuple[int, int]:
+        """
+        Applies the records of a journal which are not in the snapshot yet
+        :return: the generation of the journal and the number of applied records
+        """
+        with open(journal_path, 'rb') as handle:
+            data = handle.read()
+
+        lines = data.split(b'\n')
+        # everything after the last newline was cut off while it was written
+        complete_length = len(data) - len(lines[-1])
+        if complete_length < len(data):
+            with open(journal_path, 'r+b') as handle:
+                handle.truncate(complete_length)
+
+        generation = json.loads(lines[0])["generation"] if len(lines) > 1 else snapshot_generation
+        # the snapshot contains all changes of older journals
+        if generation < snapshot_generation:
+            return generation, 0
+
+        for line in lines[1:-1]:
+            self._apply(json.loads(line))
+        return generation, max(len(lines) - 2, 0)
+
+    def _apply(self, record: dict):
+        operation = record["op"]
+        if operation == "add":
+            self.keys.setdefault(record["user"], []).extend((record["identifier"], key) for key in record["keys"])
+        elif operation == "take":
+            for user in record["users"]:
+                self.keys[user].pop()
+        elif operation == "clear":
+            self.keys[record["user"]] = []
+        else:
+            raise RuntimeError(f"Unknown journal record {operation}")
+
+    def _sync_file(self, handle):
+        handle.flush()
+        if self._sync:
+            os.fsync(handle.fileno())
+
+    def _create_journal(self, journal_path: str, generation: int):
+        with open(journal_path + ".tmp", 'w', encoding="utf-8") as handle:
+            handle.write(json.dumps({"generation": generation}) + "\n")
+            self._sync_file(handle)
+        os.replace(journal_path + ".tmp", journal_path)
+
+    def _write_snapshot(self, generation: int, keys: Dict[str, List[Tuple[str, str]]]):
+        snapshot_path = self.path + SNAPSHOT_SUFFIX
+        with open(snapshot_path + ".tmp", 'w', encoding="utf-8") as handle:
+            json.dump({"generation": generation, "keys": keys}, handle)
+            self._sync_file(handle)
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+    def _log(self, record: dict) -> int:
+        """
+        Appends a record to the journal, the caller holds the lock and has applied the record to the keys.
+        :return: the number of the record, see GroupCommit.wait
+        """
+        self._journal.num_records += 1
+        return self._group_commit.append(json.dumps(record) + "\n")
+
+    def compact(self):
+        """
+        Writes all keys into a new snapshot and starts a new journal. Requests are only blocked while the keys are
+        copied, not while the snapshot is written.
+        """
+        journal_path = self.path + JOURNAL_SUFFIX
+        previous_journal_path = self.path + PREVIOUS_JOURNAL_SUFFIX
+
+        with self._compaction.lock:
+            with self._lock:
+                self._group_commit.sync_now()
+                keys = {user: list(user_keys) for user, user_keys in self.keys.items()}
+
+                self._journal.file.close()
+                os.replace(journal_path, previous_journal_path)
+                generation = self._journal.generation + 1
+                self._create_journal(journal_path, generation)
+                self._journal = _Journal(self._open_journal(), generation)
+
+            self._write_snapshot(generation, keys)
+            os.remove(previous_journal_path)
+
+    def _run_compaction(self, interval: float):
+        while not self._compaction.stopped.wait(interval):
+            if self._journal.num_records >= self._compaction.threshold:
+                self.compact()
+
+    def close(self):
+        self._compaction.stopped.set()
+        if self._compaction.thread is not None:
+            self._compaction.thread.join()
+        with self._lock:
+            self._group_commit.sync_now()
+            self._journal.file.close()
 
     def add_key(self, user: str, key: bytes, identifier: str = ""):
+        self.add_keys(user, [key], identifier)
 
-        if user not in self.keys:
-            self.keys[user] = []
+    def add_keys(self, user: str, keys: List[bytes], identifier: str = ""):
+        """
+        Adds several keys of a user with one journal record
+        """
+        record = {"op": "add", "user": user, "identifier": identifier, "keys": [key.hex() for key in keys]}
+        with self._lock:
+            self._apply(record)
+            record_number = self._log(record)
+        self._group_commit.wait(record_number)
 
-        self.keys[user].append((identifier, key.hex()))
-        self._on_modify()
+    def get_num_keys(self, user: str) -> int:
+        return len(self.keys.get(user, []))
 
     def get_key_for_user(self, user: str) -> bytes:
         return bytes.fromhex(self.keys[user][0][1])
 
+    def has_key(self, user: str) -> bool:
+        return user in self.keys and len(self.keys[user]) > 0
+
     def take_key_for_user(self, user) -> Optional[bytes]:
-        if user in self.keys and len(self.keys[user]) > 0:
-            key = self.keys[user].pop()[1]
-            self._on_modify()
-            return bytes.fromhex(key)
+        keys = self.take_keys([user])
+        return keys[user] if keys is not None else None
+
+    def take_keys(self, users: List[str]) -> Optional[Dict[str, bytes]]:
+        """
+        Takes one key of each of the given users at once. The keys are only taken if there is a key for every user,
+        so a failed request does not use up the keys of the other users. The batch is one journal record.
+        :param users: the users, duplicates are ignored
+        :return: the key of each user or None if any user has no key left
+        """
+        users = list(dict.fromkeys(users))
+        if not users:
+            return {}
 
-        return None
+        with self._lock:
+            if not all(self.has_key(user) for user in users):
+                return None
+
+            keys = {user: bytes.fromhex(self.keys[user][-1][1]) for user in users}
+            record = {"op": "take", "users": users}
+            self._apply(record)
+            record_number = self._log(record)
+
+        self._group_commit.wait(record_number)
+        return keys
 
     def clear_user(self, user):
-        if user in self.keys:
-            self.keys[user] = []
-            self._on_modify()
+        if user not in self.keys:
+            return
+
+        record = {"op": "clear", "user": user}
+        with self._lock:
+            self._apply(record)
+            record_number = self._log(record)
+        self._group_commit.wait(record_number)
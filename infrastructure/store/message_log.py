@@ -0,0 +1,378 @@
+"""
+Message Log
+"""
+import bisect
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+from enum import Enum
+from typing import Dict, List, Iterable, Iterator, Optional, Tuple, NamedTuple, Union
+
+from store.group_commit import GroupCommit
+
+DEFAULT_SEGMENT_SIZE: int = 16 * 1024 * 1024
+
+SEGMENT_SUFFIX: str = ".log"
+
+# length of the record after this header and crc32 of it
+RECORD_HEADER = struct.Struct(">II")
+# type and offset of a record
+RECORD_PREFIX = struct.Struct(">BQ")
+
+
+class RecordType(Enum):
+    """
+    enum {
+        message(0),
+        consume(1),
+        delete(2),
+        body(3),
+        (255)
+    } RecordType;
+    """
+    MESSAGE = 0
+    CONSUME = 1
+    DELETE = 2
+    BODY = 3
+
+
+class LogRecord(NamedTuple):
+    """
+    A record of the message log, the offset is the offset of the message for messages and deletes, the read offset of
+    the recipient for consumes and the offset of the next message for bodies. Timestamp and content id are set for
+    messages, content id and body for bodies.
+    """
+    record_type: RecordType
+    offset: int
+    user: str = ""
+    device: str = ""
+    timestamp: Optional[Union[datetime, str]] = None
+    content_id: Optional[str] = None
+    body: Optional[str] = None
+
+
+def _pack_string(value: str, length_format: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack(length_format, len(data)) + data
+
+
+def _unpack_string(data: bytes, position: int, length_format: str) -> Tuple[str, int]:
+    (length,) = struct.unpack_from(length_format, data, position)
+    position += struct.calcsize(length_format)
+    return data[position:position + length].decode("utf-8"), position + length
+
+
+def pack_record(record: LogRecord) -> bytes:
+    """
+    struct {
+        uint32 length;
+        uint32 crc32;
+        RecordType record_type;
+        uint64 offset;
+        select (record_type) {
+            case body:
+                opaque content_id<0..255>;
+                opaque body<0..2^32-1>;  // the message as JSON
+            case message:
+                opaque user<0..2^16-1>;
+                opaque device<0..2^16-1>;
+                opaque timestamp<0..255>;
+                opaque content_id<0..255>;
+            case consume:
+            case delete:
+                opaque user<0..2^16-1>;
+                opaque device<0..2^16-1>;
+        }
+    } LogRecord;
+
+    The length and the crc32 cover everything after them.
+    """
+    data = RECORD_PREFIX.pack(record.record_type.value, record.offset)
+    if record.record_type == RecordType.BODY:
+        data += _pack_string(record.content_id, ">B") + _pack_string(record.body, ">I")
+    else:
+        data += _pack_string(record.user, ">H") + _pack_string(record.device, ">H")
+
+    if record.record_type == RecordType.MESSAGE:
+        # messages imported from a JSON store have their timestamp as string
+        timestamp = record.timestamp if isinstance(record.timestamp, str) else record.timestamp.isoformat(sep=" ")
+        data += _pack_string(timestamp, ">B") + _pack_string(record.content_id, ">B")
+
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def unpack_record(data: bytes) -> LogRecord:
+    record_type, offset = RECORD_PREFIX.unpack_from(data)
+    record_type = RecordType(record_type)
+
+    if record_type == RecordType.BODY:
+        content_id, position = _unpack_string(data, RECORD_PREFIX.size, ">B")
+        body, position = _unpack_string(data, position, ">I")
+        return LogRecord(record_type, offset, content_id=content_id, body=body)
+
+    user, position = _unpack_string(data, RECORD_PREFIX.size, ">H")
+    device, position = _unpack_string(data, position, ">H")
+    if record_type != RecordType.MESSAGE:
+        return LogRecord(record_type, offset, user, device)
+
+    timestamp, position = _unpack_string(data, position, ">B")
+    content_id, position = _unpack_string(data, position, ">B")
+    return LogRecord(record_type, offset, user, device, datetime.fromisoformat(timestamp), content_id)
+
+
+class _Segments:
+    """
+    The segment files of a MessageLog. The segments are numbered in the order they were created, the base offset of a
+    segment is the offset of its first message, segments without messages share their base offset with the next
+    segment.
+    """
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        segments = sorted(tuple(int(part) for part in name[:-len(SEGMENT_SUFFIX)].split("-"))
+                          for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        self.numbers: List[int] = [segment for segment, _ in segments]
+        self.base_offsets: List[int] = [base_offset for _, base_offset in segments]
+        # number of messages in each segment which are not consumed yet and bodies which are not released yet
+        self.num_pending: Dict[int, int] = {}
+        # the segment of each body
+        self.body_segments: Dict[str, int] = {}
+        self.next_offset: int = self.base_offsets[-1] if segments else 0
+        # paths of consumed segments with the number of the record which has to be durable before they are deleted
+        self._deletable: List[Tuple[int, str]] = []
+
+    def get_path(self, segment_index: int) -> str:
+        return os.path.join(self.directory, f"{self.numbers[segment_index]:010d}-"
+                                            f"{self.base_offsets[segment_index]:020d}{SEGMENT_SUFFIX}")
+
+    def get_segment(self, offset: int) -> int:
+        return self.numbers[bisect.bisect_right(self.base_offsets, offset) - 1]
+
+    def start(self, segment: int) -> None:
+        self.numbers.append(segment)
+        self.base_offsets.append(self.next_offset)
+        self.num_pending[segment] = 0
+
+    def collect_consumed(self, record_number: int) -> None:
+        """
+        Drops the oldest segments without pending messages and bodies, their files are deleted by pop_deletable
+        :param record_number: the record which consumed the messages or released the bodies
+        """
+        # the consume records in a segment may refer to older segments, so only the oldest segments are deleted
+        while len(self.numbers) > 1 and self.num_pending[self.numbers[0]] == 0:
+            self._deletable.append((record_number, self.get_path(0)))
+            del self.num_pending[self.numbers.pop(0)]
+            self.base_offsets.pop(0)
+
+    def pop_deletable(self, record_number: int) -> List[str]:
+        """
+        :param record_number: all records up to this one are durable
+        :return: the paths of the consumed segments which may be deleted now
+        """
+        paths = [path for number, path in self._deletable if number <= record_number]
+        self._deletable = [(number, path) for number, path in self._deletable if number > record_number]
+        return paths
+
+
+class MessageLog:
+    """
+    Append-only log of the messages fanned out by the dirserver, split into segment files named by their number and
+    the offset of their first message. Every message gets the next offset. The body of a message is logged once in a
+    body record, the messages of all its recipients refer to it by its content id. A recipient who fetched its
+    messages is logged with a consume record holding its read offset, all its messages below the read offset are
+    consumed.
+
+    Records are made durable with one fsync for concurrent requests, see GroupCommit. A segment is deleted once all
+    messages in it and in older segments are consumed, all bodies in it are released and the records which did so
+    are durable, so recovery only reads the segments of the unconsumed backlog.
+
+    Usage: read the records of the existing segments with read_records, then call open with the offsets of the
+    messages which are not consumed and the content ids of their bodies. The log is not thread-safe by itself,
+    callers hold lock while they append records and call wait afterwards.
+    """
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE, sync: bool = True):
+        """
+        :param directory: the directory of the segments, created if missing
+        :param segment_size: size in bytes after which a new segment is started
+        :param sync: whether records are fsynced before requests are answered
+        """
+        self.directory: str = os.path.abspath(directory)
+        self.created: bool = not os.path.isdir(self.directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._segment_size: int = segment_size
+        self.lock = threading.Lock()
+        self._segments = _Segments(self.directory)
+        self._file = None
+        self._group_commit = GroupCommit(self.lock, lambda: self._file, sync)
+
+    def read_records(self) -> Iterator[LogRecord]:
+        """
+        Reads the records of all segments in order. A record cut off by a crash at the end of the last segment is
+        removed from it.
+        :raises RuntimeError: if an older segment is corrupt
+        """
+        segments = self._segments
+        for segment_index, segment in enumerate(segments.numbers):
+            path = segments.get_path(segment_index)
+            with open(path, 'rb') as handle:
+                data = handle.read()
+
+            position = 0
+            while position < len(data):
+                record = self._read_record(data, position)
+                if record is None:
+                    if segment_index != len(segments.numbers) - 1:
+                        raise RuntimeError(f"Corrupt record at {position} in message log segment {path}")
+                    with open(path, 'r+b') as handle:
+                        handle.truncate(position)
+                    break
+
+                position, record = record
+                if record.record_type == RecordType.MESSAGE:
+                    segments.next_offset = max(segments.next_offset, record.offset + 1)
+                elif record.record_type == RecordType.BODY:
+                    segments.body_segments[record.content_id] = segment
+                yield record
+
+    @staticmethod
+    def _read_record(data: bytes, position: int) -> Optional[Tuple[int, LogRecord]]:
+        if position + RECORD_HEADER.size > len(data):
+            return None
+
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        body = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+        if len(body) != length or zlib.crc32(body) != crc:
+            return None
+
+        return position + RECORD_HEADER.size + length, unpack_record(body)
+
+    def open(self, pending_offsets: Iterable[int], content_ids: Iterable[str]) -> None:
+        """
+        Starts appending to the log
+        :param pending_offsets: the offsets of all messages which are not consumed yet
+        :param content_ids: the content ids of the bodies of these messages
+        """
+        segments = self._segments
+        segments.num_pending = {segment: 0 for segment in segments.numbers}
+        for offset in pending_offsets:
+            segments.num_pending[segments.get_segment(offset)] += 1
+
+        segments.body_segments = {content_id: segments.body_segments[content_id] for content_id in content_ids}
+        for segment in segments.body_segments.values():
+            segments.num_pending[segment] += 1
+
+        if segments.numbers:
+            self._open_segment()
+        else:
+            self._start_segment(0)
+
+        # the records which consumed these segments were read from them, so they are durable already
+        segments.collect_consumed(0)
+        for path in segments.pop_deletable(0):
+            os.remove(path)
+
+    def _open_segment(self) -> None:
+        # pylint: disable=consider-using-with
+        # the newest segment stays open for appending until the next segment is started or the log is closed
+        self._file = open(self._segments.get_path(-1), 'ab')
+
+    def _start_segment(self, segment: int) -> None:
+        self._segments.start(segment)
+        self._open_segment()
+
+    def _append(self, record: LogRecord) -> int:
+        if self._file.tell() >= self._segment_size:
+            # the old segment is synced at once, GroupCommit only syncs the current file
+            self._group_commit.sync_now()
+            self._file.close()
+            self._start_segment(self._segments.numbers[-1] + 1)
+
+        return self._group_commit.append(pack_record(record))
+
+    def append_body(self, content_id: str, body: str) -> int:
+        """
+        Logs a body before the first message which refers to it, the caller holds lock
+        :param body: the message as JSON
+        :return: the number of the record, see wait
+        """
+        segments = self._segments
+        record_number = self._append(LogRecord(RecordType.BODY, segments.next_offset, content_id=content_id,
+                                               body=body))
+        segments.body_segments[content_id] = segments.numbers[-1]
+        segments.num_pending[segments.numbers[-1]] += 1
+        return record_number
+
+    def release_body(self, content_id: str, record_number: int) -> None:
+        """
+        Tells the log that no message refers to the body anymore, the caller holds lock
+        :param record_number: the consume or delete record of the last message which referred to the body, the
+                              segment of the body is kept until it is durable
+        """
+        segments = self._segments
+        segments.num_pending[segments.body_segments.pop(content_id)] -= 1
+        segments.collect_consumed(record_number)
+
+    def append_message(self, user: str, device: str, timestamp: Union[datetime, str],
+                       content_id: str) -> Tuple[int, int]:
+        """
+        The caller holds lock and has logged the body with append_body
+        :return: the offset of the message and the number of the record, see wait
+        """
+        segments = self._segments
+        offset = segments.next_offset
+        record_number = self._append(LogRecord(RecordType.MESSAGE, offset, user, device, timestamp, content_id))
+        segments.next_offset += 1
+        segments.num_pending[segments.numbers[-1]] += 1
+        return offset, record_number
+
+    def consume(self, user: str, device: str, offsets: List[int]) -> int:
+        """
+        Logs that a recipient has fetched its messages, the caller holds lock
+        :param offsets: the offsets of all messages of the recipient, in ascending order
+        :return: the number of the record, see wait
+        """
+        record_number = self._append(LogRecord(RecordType.CONSUME, offsets[-1] + 1, user, device))
+        self._release(offsets, record_number)
+        return record_number
+
+    def delete(self, user: str, device: str, offset: int) -> int:
+        """
+        Logs that a single message was removed, the caller holds lock
+        :return: the number of the record, see wait
+        """
+        record_number = self._append(LogRecord(RecordType.DELETE, offset, user, device))
+        self._release([offset], record_number)
+        return record_number
+
+    def _release(self, offsets: List[int], record_number: int) -> None:
+        segments = self._segments
+        for offset in offsets:
+            segments.num_pending[segments.get_segment(offset)] -= 1
+        segments.collect_consumed(record_number)
+
+    def wait(self, record_number: int) -> None:
+        """
+        Returns once the record is durable, the caller does not hold lock. Deletes the segments which were consumed
+        by records up to this one.
+        """
+        self._group_commit.wait(record_number)
+
+        with self.lock:
+            paths = self._segments.pop_deletable(record_number)
+        for path in paths:
+            os.remove(path)
+
+    def get_num_segments(self) -> int:
+        return len(self._segments.numbers)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._file is not None:
+                record_number = self._group_commit.sync_now()
+                self._file.close()
+                for path in self._segments.pop_deletable(record_number):
+                    os.remove(path)
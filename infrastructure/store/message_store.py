@@ -1,10 +1,16 @@
 """
 Keystore Class zum Storen von Keys in Dateien.
 """
+import hashlib
+import heapq
+import json
+import threading
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from typing import List, Dict, Tuple, Deque, Iterator, Optional
 
+from store.message_log import MessageLog, RecordType
 from store.store import Store
 
 
@@ -24,6 +30,9 @@ class Message:
         self.device = device
         self.message = message
         self.timestamp = timestamp
+        # set by MessageQueues, the body shared with the other recipients of the message
+        self.content_id: Optional[str] = None
+        self.serialized_message: Optional[str] = None
 
     def to_json(self) -> dict:
         """
@@ -57,11 +66,250 @@ class Message:
         return False
 
 
+class MessageBody:
+    """
+    The body of a message, stored once for all its recipients and freed once the last of them fetched it
+    """
+    __slots__ = ["message", "serialized", "num_references"]
+
+    def __init__(self, message, serialized: Optional[str]):
+        self.message = message
+        # the message as JSON, sent as it is in the responses
+        self.serialized: Optional[str] = serialized
+        self.num_references: int = 0
+
+    @staticmethod
+    def get_content_id(serialized: str) -> str:
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class MessageQueues:
+    """
+    The messages of a Messagestore in one queue per recipient (user, device), so adding a message and handing out the
+    messages of a recipient do not depend on the messages of other recipients. Behaves like the list of all messages
+    in the order they were added, as the Store base class and older callers use it.
+
+    Equal message bodies are stored once under their content id, the queued messages refer to the body. With a
+    MessageLog, every change is logged and the queues are recovered from the log.
+    """
+
+    def __init__(self, log: Optional[MessageLog] = None):
+        self.queues: Dict[Tuple[str, str], Deque[Tuple[int, Message]]] = {}
+        self.bodies: Dict[str, MessageBody] = {}
+        # numbers the messages in the order they were added, to iterate them in this order, the offsets in the log
+        self._next_sequence: int = 0
+        self._num_messages: int = 0
+
+        self._log: Optional[MessageLog] = log
+        # the dirserver handles requests in several threads
+        self._lock = log.lock if log is not None else threading.Lock()
+        # the log finds out which bodies are left after the recovery by itself
+        self._recovering: bool = log is not None
+        if log is not None:
+            self._recover()
+            self._recovering = False
+
+    def _recover(self):
+        for record in self._log.read_records():
+            key = (record.user, record.device)
+            if record.record_type == RecordType.BODY:
+                self.bodies[record.content_id] = MessageBody(json.loads(record.body), record.body)
+            elif record.record_type == RecordType.MESSAGE:
+                # the segment of a body is deleted once all its messages are consumed, while consumed messages in
+                # newer segments may be kept, their consume records follow
+                body = self.bodies.setdefault(record.content_id, MessageBody(None, None))
+                message = Message(record.user, record.device, None, record.timestamp)
+                self._reference_body(message, body, record.content_id)
+                self._enqueue(record.offset, message)
+            elif record.record_type == RecordType.CONSUME:
+                queue = self.queues.get(key, deque())
+                while queue and queue[0][0] < record.offset:
+                    self._release_body(queue.popleft()[1], None)
+                    self._num_messages -= 1
+                self._drop_if_empty(key)
+            else:
+                entry = self._remove_entry(key, lambda sequence, _, offset=record.offset: sequence == offset)
+                if entry is not None:
+                    self._release_body(entry[1], None)
+
+        # bodies whose messages were all consumed are not needed anymore
+        self.bodies = {content_id: body for content_id, body in self.bodies.items() if body.num_references > 0}
+        if any(body.serialized is None for body in self.bodies.values()):
+            raise RuntimeError(f"Message log {self._log.directory} lacks the body of a message")
+        self._log.open((sequence for queue in self.queues.values() for sequence, _ in queue), self.bodies.keys())
+
+    def _enqueue(self, sequence: int, message: Message):
+        self.queues.setdefault((message.user, message.device), deque()).append((sequence, message))
+        self._num_messages += 1
+
+    def _drop_if_empty(self, key: Tuple[str, str]):
+        if key in self.queues and not self.queues[key]:
+            del self.queues[key]
+
+    def _remove_entry(self, key: Tuple[str, str], matches) -> Optional[Tuple[int, Message]]:
+        """
+        Removes the first queued message which matches, the caller releases its body
+        """
+        queue = self.queues.get(key, deque())
+        for index, (sequence, message) in enumerate(queue):
+            if matches(sequence, message):
+                del queue[index]
+                self._num_messages -= 1
+                self._drop_if_empty(key)
+                return sequence, message
+        return None
+
+    @staticmethod
+    def _reference_body(message: Message, body: MessageBody, content_id: str):
+        message.message = body.message
+        message.serialized_message = body.serialized
+        message.content_id = content_id
+        body.num_references += 1
+
+    def _release_body(self, message: Message, record_number: Optional[int]):
+        """
+        :param record_number: the logged consume or delete record of the message, see MessageLog.release_body
+        """
+        body = self.bodies[message.content_id]
+        body.num_references -= 1
+        if body.num_references == 0:
+            del self.bodies[message.content_id]
+            if self._log is not None and not self._recovering:
+                self._log.release_body(message.content_id, record_number)
+
+    def append_fanout(self, messages: List[Message]) -> None:
+        """
+        Adds messages which have the same body, e.g. the messages of a fanout to all members of a group. The body is
+        serialized, stored and logged once for all of them.
+        """
+        if not messages:
+            return
+
+        serialized = json.dumps(messages[0].message)
+        content_id = MessageBody.get_content_id(serialized)
+        record_number = None
+
+        with self._lock:
+            body = self.bodies.get(content_id)
+            if body is None:
+                body = self.bodies[content_id] = MessageBody(messages[0].message, serialized)
+                if self._log is not None:
+                    self._log.append_body(content_id, serialized)
+
+            for message in messages:
+                self._reference_body(message, body, content_id)
+                if self._log is not None:
+                    sequence, record_number = self._log.append_message(message.user, message.device,
+                                                                       message.timestamp, content_id)
+                else:
+                    sequence = self._next_sequence
+                    self._next_sequence += 1
+                self._enqueue(sequence, message)
+
+        # the records are synced in order, so the last one covers all of them
+        if record_number is not None:
+            self._log.wait(record_number)
+
+    def append(self, message: Message):
+        self.append_fanout([message])
+
+    def remove(self, message: Message):
+        """
+        Removes the first message equal to the given one, like list.remove
+        """
+        record_number = None
+        with self._lock:
+            entry = self._remove_entry((message.user, message.device), lambda _, queued: queued == message)
+            if entry is None:
+                raise ValueError("Message to be removed was not in list")
+            sequence, removed = entry
+            if self._log is not None:
+                record_number = self._log.delete(message.user, message.device, sequence)
+            # the body is released after the delete record, which the segment of the body waits for
+            self._release_body(removed, record_number)
+
+        if record_number is not None:
+            self._log.wait(record_number)
+
+    def get_first(self, user: str, device: str) -> Optional[Message]:
+        with self._lock:
+            queue = self.queues.get((user, device))
+            return queue[0][1] if queue else None
+
+    def take_all(self, user: str, device: str) -> List[Message]:
+        """
+        Removes and returns all messages of a recipient
+        """
+        record_number = None
+        with self._lock:
+            queue = self.queues.pop((user, device), deque())
+            self._num_messages -= len(queue)
+            if self._log is not None and queue:
+                record_number = self._log.consume(user, device, [sequence for sequence, _ in queue])
+            for _, message in queue:
+                self._release_body(message, record_number)
+
+        if record_number is not None:
+            self._log.wait(record_number)
+        return [message for _, message in queue]
+
+    def __iter__(self) -> Iterator[Message]:
+        with self._lock:
+            entries = list(heapq.merge(*self.queues.values()))
+        for _, message in entries:
+            yield message
+
+    def __len__(self):
+        return self._num_messages
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+def stream_json(messages: List[Message]) -> Iterator[str]:
+    """
+    Yields the JSON list of the messages in pieces, the bodies as they are stored instead of serializing them again
+    for every response
+    """
+    yield "["
+    for index, message in enumerate(messages):
+        serialized = message.serialized_message
+        if serialized is None:
+            serialized = json.dumps(message.message)
+
+        yield (", " if index > 0 else "") + '{"user": ' + json.dumps(message.user) + ', "device": ' + \
+            json.dumps(message.device) + ', "message": '
+        yield serialized
+        yield ', "timestamp": ' + json.dumps(message.timestamp.isoformat(sep=" ")) + "}"
+    yield "]"
+
+
 class Messagestore(Store):
     """
     Manages Messages for Dirserver
     """
 
+    def __init__(self, file_name: str, log: Optional[MessageLog] = None):
+        """
+        :param file_name: the JSON file of the store
+        :param log: keeps the messages across restarts, the JSON file is only imported into a new log
+        """
+        self._log: Optional[MessageLog] = log
+        # recovers the messages from the log, if any
+        self.queues: MessageQueues = MessageQueues(log)
+        super().__init__(file_name)
+
+    def _init_elements(self):
+        # the queues are created before Store.__init__ loads the JSON file
+        pass
+
+    @property
+    def elements(self) -> MessageQueues:
+        """
+        the queues under the name of the Store base class, read-only
+        """
+        return self.queues
+
     @classmethod
     def from_json(cls, file_path: str, json_data):
         """
@@ -78,9 +326,9 @@ class Messagestore(Store):
         Converts Messagestore into json
         """
         json_data = []
-        for element in self.elements:
+        for element in self.queues:
             json_data.append(element.to_json())
-            return json_data
+        return json_data
 
     def add_element(self, element: Message):
         """
@@ -88,32 +336,27 @@ class Messagestore(Store):
         Since the Server Decides the sequence the time is added here.
         """
         element.timestamp = datetime.now()
-        self.elements.append(element)
+        self.queues.append(element)
+
+    def add_fanout(self, receivers: List[Tuple[str, str]], message) -> None:
+        """
+        Adds one message for each of the given (user, device) receivers, the message body is stored once
+        """
+        timestamp = datetime.now()
+        self.queues.append_fanout([Message(user, device, message, timestamp) for user, device in receivers])
 
     def get_messages(self, user: str, device: str) -> List[Message]:
         """
         gets all messages for a given user device
         for server use
         """
-        search_message = Message(user, device, None, None)
-        result_list = []
-
-        for message in self.elements:
-            if search_message.same_user_device(message):
-                result_list.append(message)
-        for message in result_list:
-            self.elements.remove(message)
-
-        return result_list
+        return self.queues.take_all(user, device)
 
     def get_element(self, element: Message) -> Message:
         """
         returns first message for given user
         """
-        for message in self.elements:
-            if element.same_user_device(message):
-                return message
-        return None
+        return self.queues.get_first(element.user, element.device)
 
     def get_element_by_user_device(self, user: str, device: str):
         """
@@ -126,13 +369,12 @@ class Messagestore(Store):
         """
         deletes given message from server
         """
-        for message in self.elements:
-            if message == message_data:
-                self.elements.remove(message)
-                return
-        raise ValueError("Message to be removed was not in list")
+        self.queues.remove(message_data)
 
     def load_from_file(self):
+        if self._log is not None and not self._log.created:
+            return
+
         json_data = super().load_json_from_file()
 
         # load elements with necesary values into List
@@ -141,4 +383,8 @@ class Messagestore(Store):
                                    datum["device"],
                                    datum["message"],
                                    datum["timestamp"])
-            self.elements.append(message_data)
+            self.queues.append(message_data)
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
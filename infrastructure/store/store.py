@@ -16,9 +16,16 @@ class Store(ABC):
         super().__init__()
         self.file_name = file_name
         self.absolute_file_path = os.path.abspath(file_name)
-        self.elements = []
+        self._init_elements()
         self.load_from_file()
 
+    def _init_elements(self):
+        """
+        creates the empty elements list, stores which keep their elements in another container override it
+        """
+        # pylint: disable=attribute-defined-outside-init
+        self.elements = []
+
     def to_json(self) -> dict:
         """
         converts elementstore to json
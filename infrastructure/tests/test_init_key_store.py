@@ -1,8 +1,8 @@
 # pylint: disable=R0124
 # pylint: disable=C0111
-import filecmp
 import os
 import tempfile
+import threading
 
 from flask import json
 from store.init_key_store import InitKeyStore
@@ -10,19 +10,21 @@ from store.init_key_store import InitKeyStore
 
 def test_to_json():
     file = tempfile.mktemp()
-    storage = InitKeyStore(file)
-    storage.add_key("Jan", b'11234', "1234")
+    with open(file, 'w') as handle:
+        json.dump({"Jan": [["1234", "3131323334"]]}, handle)
 
-    with open(file) as handle:
-        json_content = json.load(handle)
-
-    assert json_content == {"Jan": [["1234", "3131323334"]]}
+    # a store of the former format is imported and left unchanged
+    storage = InitKeyStore(file)
     storage.add_key("Sebastian", b"14", "12345")
+    storage.close()
 
     with open(file) as handle:
-        json_content = json.load(handle)
+        assert json.load(handle) == {"Jan": [["1234", "3131323334"]]}
 
-    assert json_content == {"Jan": [["1234", "3131323334"]], "Sebastian": [["12345", "3134"]]}
+    storage = InitKeyStore(file)
+    assert storage.get_key_for_user("Jan") == b'11234'
+    assert storage.get_key_for_user("Sebastian") == b'14'
+    storage.close()
 
 
 def test_remove_element():
@@ -34,3 +36,112 @@ def test_remove_element():
     assert storage.take_key_for_user("Jan") == b'11234'
 
     assert storage.keys == {"Jan": []}
+    storage.close()
+
+
+def test_take_keys():
+    file = tempfile.mktemp()
+    storage = InitKeyStore(file)
+
+    storage.add_key("Jan", b'jan1', "1")
+    storage.add_key("Jan", b'jan2', "2")
+    storage.add_key("Sebastian", b'sebastian', "3")
+
+    assert storage.take_keys(["Jan", "Sebastian", "Jan"]) == {"Jan": b'jan2', "Sebastian": b'sebastian'}
+
+    # Sebastian has no keys left, so Jan keeps his key
+    assert storage.take_keys(["Jan", "Sebastian"]) is None
+    assert storage.take_keys(["Jan", "Unknown"]) is None
+    assert storage.keys == {"Jan": [("1", b'jan1'.hex())], "Sebastian": []}
+    storage.close()
+
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert storage.keys == {"Jan": [("1", b'jan1'.hex())], "Sebastian": []}
+    storage.close()
+
+
+def test_add_keys():
+    file = tempfile.mktemp()
+    storage = InitKeyStore(file)
+
+    storage.add_key("Jan", b'jan1', "1")
+    storage.add_keys("Jan", [b'jan2', b'jan3'], "2")
+
+    assert storage.get_num_keys("Jan") == 3
+    assert storage.get_num_keys("Sebastian") == 0
+    storage.close()
+
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert storage.keys == {"Jan": [("1", b'jan1'.hex()), ("2", b'jan2'.hex()), ("2", b'jan3'.hex())]}
+    storage.close()
+
+
+def test_compaction_and_replay():
+    file = tempfile.mktemp()
+    storage = InitKeyStore(file, compaction_interval=None)
+
+    storage.add_keys("Jan", [b'jan1', b'jan2'])
+    storage.compact()
+    storage.take_key_for_user("Jan")
+    storage.add_key("Sebastian", b'sebastian')
+    storage.clear_user("Sebastian")
+    storage.close()
+
+    assert not os.path.exists(file + ".journal.prev")
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert storage.keys == {"Jan": [("", b'jan1'.hex())], "Sebastian": []}
+    storage.compact()
+    storage.close()
+
+    replayed = InitKeyStore(file, compaction_interval=None)
+    assert replayed.keys == storage.keys
+    replayed.close()
+
+
+def test_interrupted_compaction_and_write():
+    file = tempfile.mktemp()
+    storage = InitKeyStore(file, compaction_interval=None)
+    storage.add_key("Jan", b'jan1')
+    storage.compact()
+    storage.add_key("Jan", b'jan2')
+    storage.close()
+
+    # crash after the journal was replaced but before the snapshot was written, while a record was written
+    os.replace(file + ".journal", file + ".journal.prev")
+    with open(file + ".journal", 'w') as handle:
+        handle.write(json.dumps({"generation": 2}) + "\n")
+        handle.write(json.dumps({"op": "add", "user": "Jan", "identifier": "", "keys": ["6a616e33"]}) + "\n")
+        handle.write('{"op": "take", "us')
+
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert storage.keys == {"Jan": [("", b'jan1'.hex()), ("", b'jan2'.hex()), ("", b'jan3'.hex())]}
+    assert not os.path.exists(file + ".journal.prev")
+    storage.take_key_for_user("Jan")
+    storage.close()
+
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert storage.get_num_keys("Jan") == 2
+    storage.close()
+
+
+def test_concurrent_requests():
+    file = tempfile.mktemp()
+    storage = InitKeyStore(file, compaction_interval=None)
+
+    def add_and_take(user: str):
+        for index in range(100):
+            storage.add_keys(user, [bytes([index]), bytes([index])])
+            storage.take_key_for_user(user)
+            if index == 50:
+                storage.compact()
+
+    threads = [threading.Thread(target=add_and_take, args=(f'user{index}',)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    storage.close()
+
+    storage = InitKeyStore(file, compaction_interval=None)
+    assert all(storage.get_num_keys(f'user{index}') == 100 for index in range(8))
+    storage.close()
@@ -0,0 +1,187 @@
+# pylint: disable=C0111
+import threading
+import time
+from typing import List, Tuple, Dict
+
+import pytest
+
+from libMLS.private_key_store import PrivateKeyStore
+
+from chatclient.key_service import KeyService, InitKeyReplenisher, InitKeyPrefetcher, NoKeysAvailableException, \
+    PrefetchConfig
+
+
+class StubCipherSuite:
+
+    def __init__(self):
+        self.num_derived = 0
+
+    def derive_key_pair(self, material: bytes) -> Tuple[bytes, bytes]:
+        self.num_derived += 1
+        return b'public' + material, b'private' + material
+
+
+class StubKeyService(KeyService):
+    """
+    KeyService which keeps the keys of the dirserver in memory
+    """
+
+    def __init__(self, num_keys: int):
+        super().__init__("Jan", "")
+        self.server_keys: List[bytes] = [b'key'] * num_keys
+        self.num_uploads = 0
+        self.uploaded = threading.Event()
+
+    def register_keypairs(self, key_pairs: List[Tuple[bytes, bytes]]) -> int:
+        self.num_uploads += 1
+        self.uploaded.set()
+        self.server_keys.extend(public_key for public_key, _ in key_pairs)
+        return len(self.server_keys)
+
+    def get_num_init_keys(self) -> int:
+        return len(self.server_keys)
+
+
+def test_replenish_below_watermark():
+    key_service = StubKeyService(num_keys=3)
+    replenisher = InitKeyReplenisher(key_service, StubCipherSuite(), batch_size=10, low_watermark=4)
+
+    assert replenisher.replenish() == 10
+    assert len(key_service.server_keys) == 13
+    assert key_service.num_uploads == 1
+
+    assert replenisher.replenish() == 0
+    assert key_service.num_uploads == 1
+
+    # the batch fills up to the watermark at least
+    replenisher = InitKeyReplenisher(key_service, StubCipherSuite(), batch_size=10, low_watermark=30)
+    assert replenisher.replenish(num_keys=0) == 30
+
+
+def test_notification_wakes_background_thread():
+    key_service = StubKeyService(num_keys=5)
+    cipher_suite = StubCipherSuite()
+    replenisher = InitKeyReplenisher(key_service, cipher_suite, batch_size=10, low_watermark=4, poll_interval=3600)
+
+    replenisher.start()
+    try:
+        key_service.server_keys = key_service.server_keys[:2]
+        replenisher.notify_num_keys(2)
+
+        assert key_service.uploaded.wait(10)
+    finally:
+        replenisher.stop()
+
+    assert key_service.num_uploads == 1
+    assert len(key_service.server_keys) == 12
+
+
+class StubDirectory(KeyService):
+    """
+    KeyService with the init keys of other users in memory
+    """
+
+    def __init__(self, keys: Dict[str, List[bytes]]):
+        super().__init__("Jan", "")
+        self.keys = keys
+        self.num_downloads = 0
+
+    def download_init_key(self, user_name: str) -> bytes:
+        self.num_downloads += 1
+        if not self.keys.get(user_name):
+            raise NoKeysAvailableException()
+        return self.keys[user_name].pop(0)
+
+    def download_init_keys(self, user_names: List[str]) -> Dict[str, bytes]:
+        self.num_downloads += 1
+        if not all(self.keys.get(user_name) for user_name in user_names):
+            raise NoKeysAvailableException()
+        return {user_name: self.keys[user_name].pop(0) for user_name in user_names}
+
+    def release_init_keys(self, user_name: str, keys: List[bytes]) -> None:
+        self.keys.setdefault(user_name, []).extend(keys)
+
+
+def test_prefetched_keys_are_served_locally():
+    directory = StubDirectory({"Sebastian": [b's1', b's2', b's3'], "Tom": [b't1']})
+    prefetcher = InitKeyPrefetcher(directory, PrefetchConfig(keys_per_contact=2))
+    directory.set_prefetcher(prefetcher)
+
+    prefetcher.add_contact("Sebastian")
+    prefetcher.add_contact("Tom")
+    prefetcher.refresh()
+
+    assert prefetcher.get_num_keys("Sebastian") == 2
+    assert prefetcher.get_num_keys("Tom") == 1
+
+    num_downloads = directory.num_downloads
+    assert directory.fetch_init_key("Sebastian") == b's1'
+    assert directory.fetch_init_keys(["Sebastian", "Tom"]) == {"Sebastian": b's2', "Tom": b't1'}
+    assert directory.num_downloads == num_downloads
+
+    # not prefetched
+    with pytest.raises(NoKeysAvailableException):
+        directory.fetch_init_key("Tom")
+    assert prefetcher.get_hit_rate() == 0.75
+
+
+def test_taking_a_key_wakes_prefetcher_below_watermark():
+    directory = StubDirectory({"Sebastian": [b's1', b's2', b's3', b's4']})
+    prefetcher = InitKeyPrefetcher(directory, PrefetchConfig(keys_per_contact=3, low_watermark=2,
+                                                             refresh_interval=3600))
+    prefetcher.add_contact("Sebastian")
+    prefetcher.refresh()
+    prefetcher.start()
+    try:
+        num_downloads = directory.num_downloads
+        assert prefetcher.take_key("Sebastian") == b's1'
+        time.sleep(0.1)
+        assert directory.num_downloads == num_downloads
+
+        # only one key is left, below the watermark
+        assert prefetcher.take_key("Sebastian") == b's2'
+        deadline = time.monotonic() + 10
+        while prefetcher.get_num_keys("Sebastian") < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert prefetcher.get_num_keys("Sebastian") == 2
+    finally:
+        prefetcher.stop()
+
+
+def test_unused_prefetched_keys_are_released():
+    now = [0.0]
+    directory = StubDirectory({"Sebastian": [b's1', b's2'], "Tom": [b't1'], "Anna": [b'a1']})
+    prefetcher = InitKeyPrefetcher(directory, PrefetchConfig(keys_per_contact=1, max_contacts=2, ttl=10,
+                                                             clock=lambda: now[0]))
+
+    prefetcher.add_contact("Sebastian")
+    prefetcher.add_contact("Tom")
+    prefetcher.refresh()
+    assert directory.keys == {"Sebastian": [b's2'], "Tom": [], "Anna": [b'a1']}
+
+    # expired keys are returned and replaced, as far as the contacts have keys left
+    now[0] = 11
+    prefetcher.refresh()
+    assert directory.keys == {"Sebastian": [b's1'], "Tom": [b't1'], "Anna": [b'a1']}
+    assert prefetcher.get_num_keys("Sebastian") == 1
+    assert prefetcher.get_num_keys("Tom") == 0
+
+    # Sebastian is the least recently used contact
+    prefetcher.add_contact("Anna")
+    prefetcher.refresh()
+    assert prefetcher.get_num_keys("Sebastian") == 0
+    assert directory.keys == {"Sebastian": [b's1', b's2'], "Tom": [], "Anna": []}
+
+    prefetcher.stop()
+    assert directory.keys == {"Sebastian": [b's1', b's2'], "Tom": [b't1'], "Anna": [b'a1']}
+
+
+def test_consumed_private_keys_are_deleted():
+    private_keys = PrivateKeyStore()
+    private_keys.add_keypairs([(b'public', b'private')])
+    key_service = KeyService("Jan", "", private_keys=private_keys)
+
+    assert key_service.get_private_key(b'public') == b'private'
+    assert key_service.consume_private_key(b'public') == b'private'
+    assert len(private_keys) == 0
+    assert key_service.get_private_key(b'public') is None
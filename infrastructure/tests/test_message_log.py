@@ -0,0 +1,212 @@
+# pylint: disable=C0111
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+import pytest
+
+from flask import json
+from store.message_log import MessageLog, SEGMENT_SUFFIX
+from store.message_store import Messagestore, Message
+
+
+def _open_store(directory: str, segment_size: int = 1024) -> Messagestore:
+    return Messagestore(os.path.join(directory, "message_store.json"),
+                        MessageLog(os.path.join(directory, "log"), segment_size=segment_size))
+
+
+def test_messages_survive_restart():
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _open_store(directory)
+        welcome = {"message": "00ff", "is_welcome": True}
+        storage.add_element(Message("Jan", "Phone", welcome))
+        storage.add_element(Message("Jan", "Laptop", "laptop"))
+        storage.add_element(Message("Sebastian", "Phone", "first"))
+        storage.add_element(Message("Sebastian", "Phone", "second"))
+        storage.remove_message(storage.get_element_by_user_device("Sebastian", "Phone"))
+        assert [message.message for message in storage.get_messages("Jan", "Laptop")] == ["laptop"]
+        messages = list(storage.elements)
+        storage.close()
+
+        storage = _open_store(directory)
+        assert storage.elements == messages
+        assert storage.get_messages("Jan", "Phone")[0].message == welcome
+        assert isinstance(messages[0].timestamp, datetime)
+
+        storage.add_element(Message("Jan", "Phone", "after restart"))
+        storage.close()
+
+        storage = _open_store(directory)
+        assert [message.message for message in storage.elements] == ["second", "after restart"]
+        storage.close()
+
+
+def test_consumed_segments_are_deleted():
+    with tempfile.TemporaryDirectory() as directory:
+        log = MessageLog(os.path.join(directory, "log"), segment_size=256)
+        storage = Messagestore(os.path.join(directory, "message_store.json"), log)
+        for index in range(50):
+            storage.add_element(Message("Jan", "Phone", f"jan {index}"))
+            storage.add_element(Message("Sebastian", "Phone", f"sebastian {index}"))
+
+        num_segments = log.get_num_segments()
+        assert num_segments > 10
+
+        # Sebastian's messages keep every segment alive
+        assert len(storage.get_messages("Jan", "Phone")) == 50
+        assert log.get_num_segments() >= num_segments
+
+        assert len(storage.get_messages("Sebastian", "Phone")) == 50
+        assert log.get_num_segments() == 1
+        storage.add_element(Message("Jan", "Phone", "new"))
+        storage.close()
+
+        assert len([name for name in os.listdir(os.path.join(directory, "log")) if name.endswith(SEGMENT_SUFFIX)]) == 1
+        storage = _open_store(directory, segment_size=256)
+        assert [message.message for message in storage.elements] == ["new"]
+        storage.close()
+
+
+def test_cut_off_record_is_dropped():
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _open_store(directory)
+        storage.add_element(Message("Jan", "Phone", "complete"))
+        storage.close()
+
+        log_directory = os.path.join(directory, "log")
+        segment = os.path.join(log_directory, sorted(os.listdir(log_directory))[-1])
+        size = os.path.getsize(segment)
+        with open(segment, 'ab') as handle:
+            handle.write(b'\x00\x00\x00\x40\x12\x34')
+
+        storage = _open_store(directory)
+        assert os.path.getsize(segment) == size
+        storage.add_element(Message("Jan", "Phone", "next"))
+        storage.close()
+
+        storage = _open_store(directory)
+        assert [message.message for message in storage.get_messages("Jan", "Phone")] == ["complete", "next"]
+        storage.close()
+
+
+def test_corrupt_older_segment_is_rejected():
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _open_store(directory, segment_size=64)
+        for index in range(5):
+            storage.add_element(Message("Jan", "Phone", f"jan {index}"))
+        storage.close()
+
+        log_directory = os.path.join(directory, "log")
+        with open(os.path.join(log_directory, sorted(os.listdir(log_directory))[0]), 'r+b') as handle:
+            handle.seek(12)
+            handle.write(b'X')
+
+        with pytest.raises(RuntimeError):
+            _open_store(directory, segment_size=64)
+
+
+def test_json_store_is_imported_into_new_log():
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "message_store.json"), 'w', encoding="utf-8") as handle:
+            json.dump([{"user": "Jan", "device": "Phone", "message": "hallo",
+                        "timestamp": "2017-11-28 23:55:59.342380"}], handle)
+
+        _open_store(directory).close()
+        storage = _open_store(directory)
+        assert storage.to_json() == [{"user": "Jan", "device": "Phone", "message": "hallo",
+                                      "timestamp": "2017-11-28 23:55:59.342380"}]
+        storage.close()
+
+
+def test_concurrent_fanout():
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _open_store(directory, segment_size=512)
+
+        def fanout(sender: int):
+            for index in range(50):
+                for receiver in range(4):
+                    storage.add_element(Message(f"user{receiver}", "Phone", f"{sender} {index}"))
+                storage.get_messages(f"user{sender}", "Phone")
+
+        threads = [threading.Thread(target=fanout, args=(sender,)) for sender in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        remaining = list(storage.elements)
+        storage.close()
+
+        storage = _open_store(directory, segment_size=512)
+        assert storage.elements == remaining
+        storage.close()
+
+
+def test_fanout_body_is_logged_once():
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _open_store(directory, segment_size=1024 * 1024)
+        body = {"message": os.urandom(64 * 1024).hex(), "is_welcome": False}
+        receivers = [(f"user{index}", "Phone") for index in range(100)]
+        storage.add_fanout(receivers, body)
+        storage.add_fanout(receivers[:2], "small")
+        storage.close()
+
+        log_directory = os.path.join(directory, "log")
+        assert sum(os.path.getsize(os.path.join(log_directory, name)) for name in os.listdir(log_directory)) < \
+            len(json.dumps(body)) + 200 * 100
+
+        storage = _open_store(directory, segment_size=1024 * 1024)
+        assert len(storage.queues.bodies) == 2
+        for user, device in receivers:
+            assert storage.get_messages(user, device)[0].message == body
+        assert list(storage.queues.bodies) == []
+        storage.close()
+
+        storage = _open_store(directory, segment_size=1024 * 1024)
+        assert len(storage.elements) == 0 and not storage.queues.bodies
+        storage.close()
+
+
+def test_segment_of_body_is_kept_while_referenced():
+    with tempfile.TemporaryDirectory() as directory:
+        log = MessageLog(os.path.join(directory, "log"), segment_size=256)
+        storage = Messagestore(os.path.join(directory, "message_store.json"), log)
+        storage.add_fanout([("Jan", "Phone"), ("Sebastian", "Phone")], "shared " * 40)
+        for index in range(20):
+            storage.add_element(Message("Jan", "Phone", f"jan {index}"))
+        storage.get_messages("Jan", "Phone")
+        assert log.get_num_segments() > 1
+
+        storage.close()
+        storage = _open_store(directory, segment_size=256)
+        assert [message.message for message in storage.get_messages("Sebastian", "Phone")] == ["shared " * 40]
+        storage.close()
+
+        assert len([name for name in os.listdir(os.path.join(directory, "log")) if name.endswith(SEGMENT_SUFFIX)]) == 1
+
+
+def test_segments_are_deleted_once_their_consume_record_is_durable():
+    with tempfile.TemporaryDirectory() as directory:
+        log = MessageLog(os.path.join(directory, "log"), segment_size=64)
+        storage = Messagestore(os.path.join(directory, "message_store.json"), log)
+        for index in range(5):
+            storage.add_element(Message("Jan", "Phone", f"jan {index}"))
+
+        def count_segments() -> int:
+            return len([name for name in os.listdir(log.directory) if name.endswith(SEGMENT_SUFFIX)])
+
+        num_segments = count_segments()
+        assert num_segments > 1
+
+        # what MessageQueues.take_all does, without waiting for the consume record
+        entries = list(storage.queues.queues[("Jan", "Phone")])
+        with log.lock:
+            record_number = log.consume("Jan", "Phone", [sequence for sequence, _ in entries])
+            for _, message in entries:
+                log.release_body(message.content_id, record_number)
+        assert log.get_num_segments() == 1
+        assert count_segments() >= num_segments
+
+        log.wait(record_number)
+        assert count_segments() == 1
+        log.close()
@@ -1,9 +1,11 @@
 # pylint: disale=R0124
 # pylint: disable=C0111
 import filecmp
+import json
 import os
+import tempfile
 from datetime import datetime
-from store.message_store import Messagestore, Message
+from store.message_store import Messagestore, Message, stream_json
 
 sample_timestamp = datetime(2017, 11, 28, 23, 55, 59, 342380)
 sample_timestamp2 = datetime(2019, 11, 28, 23, 55, 59, 237456)
@@ -99,3 +101,52 @@ def test_save_to_file():
 
     storage.save_to_file()
     assert filecmp.cmp(storage.absolute_file_path, comp_file_absolute_path)
+
+
+def test_recipients_are_queued_separately():
+    storage = Messagestore(tempfile.mktemp())
+
+    messages = [Message(user, device, f"{user} {device} {index}", sample_timestamp)
+                for index in range(3) for user, device in [("Jan", "Phone"), ("Jan", "Laptop"), ("Sebastian", "Phone")]]
+    for message in messages:
+        storage.add_element(message)
+
+    assert list(storage.elements) == messages
+    assert len(storage.elements) == 9
+
+    storage.remove_message(messages[4])
+    assert storage.get_messages("Jan", "Laptop") == [messages[1], messages[7]]
+    assert storage.get_element_by_user_device("Jan", "Laptop") is None
+    assert storage.get_element_by_user_device("Sebastian", "Phone") == messages[2]
+    assert storage.elements == [message for index, message in enumerate(messages) if index % 3 != 1]
+    assert len(storage.elements) == 6
+
+
+def test_fanout_stores_body_once():
+    storage = Messagestore(tempfile.mktemp())
+    body = {"message": "ab" * 1000, "is_welcome": False}
+    receivers = [(f"user{index}", "Phone") for index in range(100)]
+
+    storage.add_fanout(receivers, body)
+    storage.add_element(Message("user0", "Phone", dict(body)))
+    assert len(storage.elements.bodies) == 1
+    assert len(storage.elements) == 101
+
+    first = storage.get_messages("user0", "Phone")
+    assert len(first) == 2 and first[0].message is first[1].message
+    for user, device in receivers[1:-1]:
+        assert storage.get_messages(user, device)[0].message is first[0].message
+    assert len(storage.elements.bodies) == 1
+
+    storage.get_messages(*receivers[-1])
+    assert not storage.elements.bodies
+
+
+def test_stream_json():
+    storage = Messagestore(tempfile.mktemp())
+    storage.add_fanout([("Jan", "Phone"), ("Sebastian", "Phone")], {"message": "00ff", "is_welcome": True})
+    storage.add_element(Message("Jan", "Phone", "Hallo \"Jan\""))
+
+    messages = storage.get_messages("Jan", "Phone")
+    assert json.loads("".join(stream_json(messages))) == [message.to_json() for message in messages]
+    assert json.loads("".join(stream_json([]))) == []
@@ -0,0 +1,97 @@
+# pylint: disable=C0111
+import json
+from typing import List
+
+import pytest
+import requests
+
+from chatclient.key_service import KeyService
+from chatclient.transport import HttpTransport
+
+
+class StubResponse:
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode()
+
+
+class StubSession:
+    """
+    Replaces the requests.Session of a transport, fails the first requests with the given error
+    """
+
+    def __init__(self, num_failures: int = 0, response: StubResponse = StubResponse(200, b'OK'),
+                 error: Exception = requests.exceptions.ConnectionError("connection refused")):
+        self.num_failures = num_failures
+        self.response = response
+        self.error = error
+        self.requests: List[tuple] = []
+
+    def request(self, method: str, url: str, **kwargs) -> StubResponse:
+        self.requests.append((method, url, kwargs))
+        if self.num_failures > 0:
+            self.num_failures -= 1
+            raise self.error
+        return self.response
+
+    def close(self):
+        pass
+
+
+def test_requests_are_retried_on_request():
+    session = StubSession(num_failures=2)
+    transport = HttpTransport(timeout=3, max_retries=2, backoff=0, session=session)
+
+    assert transport.get("127.0.0.1:5001", "/keys/count", params={"user": "Jan"}, retry=True).text == 'OK'
+    assert [request[:2] for request in session.requests] == [("GET", "http://127.0.0.1:5001/keys/count")] * 3
+    assert session.requests[0][2] == {"timeout": 3, "params": {"user": "Jan"}}
+
+    metrics = transport.get_metrics()
+    assert metrics.num_requests == 1
+    assert metrics.num_retries == 2
+    assert metrics.num_failures == 0
+
+
+def test_retries_are_bounded():
+    transport = HttpTransport(max_retries=2, backoff=0, session=StubSession(num_failures=3))
+
+    with pytest.raises(ConnectionError):
+        transport.get("127.0.0.1:5001", "/", retry=True)
+
+    assert transport.get_metrics().num_failures == 1
+    assert transport.get_metrics().num_retries == 2
+
+
+def test_requests_are_not_retried_by_default():
+    session = StubSession(num_failures=1)
+    transport = HttpTransport(max_retries=2, backoff=0, session=session)
+
+    with pytest.raises(ConnectionError):
+        transport.post("127.0.0.1:5001", "/message", data="{}")
+    assert len(session.requests) == 1
+
+    assert transport.post("127.0.0.1:5001", "/message", data="{}", retry=True).status_code == 200
+
+
+def test_timed_out_message_fetch_is_not_retried():
+    # the dirserver may have emptied the queue before the answer timed out, a second GET would get an empty list
+    session = StubSession(num_failures=1, response=StubResponse(200, b'[]'),
+                          error=requests.exceptions.ReadTimeout("read timed out"))
+    transport = HttpTransport(max_retries=2, backoff=0, session=session)
+
+    with pytest.raises(ConnectionError):
+        transport.get("127.0.0.1:5001", "/message", params={"user": "Jan", "device": "Phone"})
+    assert len(session.requests) == 1
+    assert transport.get_metrics().num_retries == 0
+
+
+def test_key_service_uses_injected_transport():
+    session = StubSession(response=StubResponse(200, json.dumps({"Jan": "aa", "Sebastian": "bb"}).encode()))
+    key_service = KeyService("Jan", "dirserver:5001", HttpTransport(session=session))
+
+    assert key_service.fetch_init_keys(["Jan", "Sebastian"]) == {"Jan": b'\xaa', "Sebastian": b'\xbb'}
+    method, url, kwargs = session.requests[0]
+    assert (method, url) == ("POST", "http://dirserver:5001/keys/batch")
+    assert json.loads(kwargs["data"]) == {"users": ["Jan", "Sebastian"]}
@@ -0,0 +1,62 @@
+"""
+CPU time against saved bytes of the compression codecs for typical payloads: chat messages, file-like application
+data and welcomes of large groups.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_compression
+"""
+import functools
+import os
+import timeit
+
+from libMLS.compression import PayloadCompressor, CompressionCodec
+from libMLS.messages import WelcomeInfoMessage, PROTOCOL_VERSION_DRAFT_07, PROTOCOL_VERSION_COMPACT_TREE
+from libMLS.tree_node import TreeNode
+
+NUM_ITERATIONS: int = 20
+NUM_TREE_NODES: int = 8191
+
+
+def _create_welcome(protocol_version: bytes) -> bytes:
+    # every third node is blank, as after some removes
+    tree = [None if node_index % 3 == 0 else TreeNode(os.urandom(32)) for node_index in range(NUM_TREE_NODES)]
+
+    # pylint: disable=unexpected-keyword-arg
+    return WelcomeInfoMessage(protocol_version=protocol_version, group_id=b'group', epoch=0, tree=tree,
+                              interim_transcript_hash=os.urandom(32), init_secret=os.urandom(32), key=b'0',
+                              nounce=b'0').pack()
+
+
+def _create_payloads() -> dict:
+    words = [b'hello', b'group', b'meeting', b'tomorrow', b'the', b'a', b'at', b'noon', b'see', b'you']
+    text = b' '.join(words[index % len(words)] for index in range(64 * 1024))
+
+    return {
+        'chat message': b'see you tomorrow at noon',
+        'text 64 KiB': text[:64 * 1024],
+        'random 64 KiB': os.urandom(64 * 1024),
+        'welcome draft-07': _create_welcome(PROTOCOL_VERSION_DRAFT_07),
+        'welcome compact': _create_welcome(PROTOCOL_VERSION_COMPACT_TREE),
+    }
+
+
+def _measure(function, *args) -> float:
+    return timeit.timeit(functools.partial(function, *args), number=NUM_ITERATIONS) * 1e3 / NUM_ITERATIONS
+
+
+def main():
+    print(f'{"payload":>18}{"codec":>7}{"size [B]":>10}{"packed [B]":>12}{"saved [%]":>11}{"compress [ms]":>15}'
+          f'{"decompress [ms]":>17}')
+
+    for name, payload in _create_payloads().items():
+        for codec in CompressionCodec:
+            compressor = PayloadCompressor(codec)
+            packed = compressor.compress(payload)
+
+            print(f'{name:>18}{codec.name.lower():>7}{len(payload):>10}{len(packed):>12}'
+                  f'{(1 - len(packed) / len(payload)) * 100:>11.1f}{_measure(compressor.compress, payload):>15.3f}'
+                  f'{_measure(compressor.decompress, packed):>17.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Memory per user and throughput of the in-memory key directory, single-threaded and with several threads taking
+batches of keys.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_key_directory
+"""
+import threading
+import time
+import tracemalloc
+
+from libMLS.key_directory import KeyDirectory
+
+NUM_USERS: int = 1000000
+KEYS_PER_USER: int = 2
+NUM_THREADS: int = 8
+BATCH_SIZE: int = 16
+
+
+def _fill(directory: KeyDirectory) -> None:
+    for user_index in range(NUM_USERS):
+        key = user_index.to_bytes(32, 'big')
+        directory.add_keys(f'user{user_index}', [key] * KEYS_PER_USER)
+
+
+def _take_batches(directory: KeyDirectory, thread_index: int) -> None:
+    users = [f'user{user_index}' for user_index in range(thread_index, NUM_USERS, NUM_THREADS)]
+    for _ in range(KEYS_PER_USER):
+        for offset in range(0, len(users), BATCH_SIZE):
+            directory.take_keys(users[offset:offset + BATCH_SIZE])
+
+
+def main():
+    tracemalloc.start()
+    directory = KeyDirectory()
+    start = time.perf_counter()
+    _fill(directory)
+    fill_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{NUM_USERS} users with {KEYS_PER_USER} keys each")
+    print(f"  add:    {fill_time:6.2f}s, {memory / NUM_USERS:6.1f} bytes per user")
+
+    threads = [threading.Thread(target=_take_batches, args=(directory, thread_index))
+               for thread_index in range(NUM_THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    take_time = time.perf_counter() - start
+
+    print(f"  take:   {take_time:6.2f}s with {NUM_THREADS} threads in batches of {BATCH_SIZE}, "
+          f"{directory.get_num_users()} users left")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Micro-benchmark of pack_dynamic and unpack_dynamic for the format strings used in libMLS.messages.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_message_packer
+"""
+import functools
+import os
+import timeit
+from typing import Dict, List
+
+from libMLS.message_packer import pack_dynamic, unpack_dynamic
+
+NUM_RUNS: int = 20000
+
+CASES: Dict[str, List] = {
+    'VIIBVV': [b'group', 42, 7, 1, os.urandom(256), b'signature'],
+    'VIBVVV': [b'group', 42, 1, b'nonce', os.urandom(8), os.urandom(512)],
+    '32sV': [os.urandom(32), os.urandom(64)],
+    'IVV': [3, os.urandom(32), os.urandom(32)],
+    'BV': [2, os.urandom(128)],
+    'IV': [0, os.urandom(128)],
+    'II': [3, 0],
+    'VVIVVVVV': [b'1', b'group', 42, os.urandom(1024), b'0', os.urandom(32), b'', b''],
+}
+
+
+def _measure(statement) -> float:
+    return min(timeit.repeat(statement, number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1e6
+
+
+def main():
+    print(f'{"format":<12}{"pack [us]":>12}{"unpack [us]":>14}')
+
+    for fmt, args in CASES.items():
+        packed = pack_dynamic(fmt, *args)
+        assert list(unpack_dynamic(fmt, packed)) == args
+
+        pack_time = _measure(functools.partial(pack_dynamic, fmt, *args))
+        unpack_time = _measure(functools.partial(unpack_dynamic, fmt, packed))
+        print(f'{fmt:<12}{pack_time:>12.2f}{unpack_time:>14.2f}')
+
+if __name__ == '__main__':
+    main()
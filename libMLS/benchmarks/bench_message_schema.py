@@ -0,0 +1,59 @@
+"""
+Benchmark of the generated packing and unpacking of schema messages against the generic pack_dynamic and
+unpack_dynamic, which interpret the format string on each call.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_message_schema
+"""
+import functools
+import os
+import timeit
+
+from libMLS.message_packer import pack_dynamic, unpack_dynamic
+from libMLS.messages import MLSCiphertext, HPKECiphertext, ContentType
+
+NUM_ITERATIONS: int = 100000
+
+
+def _pack_generic_ciphertext(message: MLSCiphertext) -> bytes:
+    return pack_dynamic('VIBVVV', message.group_id, message.epoch, message.content_type.value,
+                        message.sender_data_nounce, message.encrypted_sender_data, message.ciphertext)
+
+
+def _unpack_generic_ciphertext(data: bytes) -> tuple:
+    return unpack_dynamic('VIBVVV', data)
+
+
+def _pack_generic_hpke(message: HPKECiphertext) -> bytes:
+    return pack_dynamic('32sV', message.ephemeral_key, message.cipher_text)
+
+
+def _unpack_generic_hpke(data: bytes) -> tuple:
+    return unpack_dynamic('32sV', data)
+
+
+def _measure(function, *args) -> float:
+    return timeit.timeit(functools.partial(function, *args), number=NUM_ITERATIONS) * 1e9 / NUM_ITERATIONS
+
+
+def main():
+    # pylint: disable=unexpected-keyword-arg
+    ciphertext = MLSCiphertext(group_id=b'group', epoch=1, content_type=ContentType.APPLICATION,
+                               sender_data_nounce=os.urandom(12), encrypted_sender_data=os.urandom(8),
+                               ciphertext=os.urandom(256))
+    hpke = HPKECiphertext(ephemeral_key=os.urandom(32), cipher_text=os.urandom(64))
+
+    print(f'{"message":>16}{"operation":>12}{"generic [ns]":>14}{"schema [ns]":>14}')
+    for name, message, pack_generic, unpack_generic in [
+            ('MLSCiphertext', ciphertext, _pack_generic_ciphertext, _unpack_generic_ciphertext),
+            ('HPKECiphertext', hpke, _pack_generic_hpke, _unpack_generic_hpke)]:
+        packed = message.pack()
+        assert packed == pack_generic(message)
+
+        print(f'{name:>16}{"pack":>12}{_measure(pack_generic, message):>14.0f}{_measure(message.pack):>14.0f}')
+        print(f'{name:>16}{"unpack":>12}{_measure(unpack_generic, packed):>14.0f}'
+              f'{_measure(type(message).from_bytes, packed):>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
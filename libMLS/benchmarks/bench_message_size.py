@@ -0,0 +1,53 @@
+"""
+Benchmark of the decode time of messages against their size. With offset based unpacking, the decode time should
+grow linearly with the size of a message.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_message_size
+"""
+import os
+import time
+
+from libMLS.message_packer import unpack_byte_list, pack_dynamic
+from libMLS.messages import UpdateMessage, DirectPathNode, HPKECiphertext
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024]
+CIPHERTEXT_SIZE: int = 1024
+NODES_PER_PATH: int = 16
+
+
+def _create_update(size: int) -> UpdateMessage:
+    num_ciphertexts = max(1, size // CIPHERTEXT_SIZE)
+    ciphertext = HPKECiphertext(os.urandom(32), os.urandom(CIPHERTEXT_SIZE - 32))
+    per_node = max(1, num_ciphertexts // NODES_PER_PATH)
+
+    direct_path = [DirectPathNode(os.urandom(32), [])]
+    while num_ciphertexts > 0:
+        direct_path.append(DirectPathNode(os.urandom(32), [ciphertext] * min(per_node, num_ciphertexts)))
+        num_ciphertexts -= per_node
+
+    return UpdateMessage(direct_path)
+
+
+def _measure(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f'{"size [KiB]":>12}{"UpdateMessage [ms]":>20}{"byte list [ms]":>16}{"ns/byte":>10}')
+
+    for size in SIZES:
+        packed_update = _create_update(size).pack()
+        byte_list = pack_dynamic('V', os.urandom(CIPHERTEXT_SIZE - 4)) * max(1, size // CIPHERTEXT_SIZE)
+
+        update_time = _measure(UpdateMessage.from_bytes, packed_update)
+        list_time = _measure(unpack_byte_list, byte_list)
+
+        print(f'{size // 1024:>12}{update_time * 1e3:>20.2f}{list_time * 1e3:>16.2f}'
+              f'{update_time * 1e9 / len(packed_update):>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
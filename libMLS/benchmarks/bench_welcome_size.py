@@ -0,0 +1,75 @@
+"""
+Size of a WelcomeInfo with the draft-07 tree encoding against the compact one, for trees which went through a
+trace of adds, removes and updates.
+
+Run from the libMLS directory:
+    python -m benchmarks.bench_welcome_size
+"""
+import os
+import random
+
+from libMLS.messages import WelcomeInfoMessage, PROTOCOL_VERSION_DRAFT_07, PROTOCOL_VERSION_COMPACT_TREE
+from libMLS.tree import Tree
+from libMLS.tree_math import direct_path, root
+from libMLS.tree_node import TreeNode
+from libMLS.x25519_cipher_suite import X25519CipherSuite
+
+NUM_LEAVES = [64, 1024, 16384, 50000]
+# probability of a remove and of an update, the remaining steps are adds
+TRACES = {
+    'updates': (0.05, 0.9),
+    'churn': (0.3, 0.4),
+    'departures': (0.6, 0.2),
+}
+
+
+def _create_tree(num_leaves: int, remove_probability: float, update_probability: float) -> Tree:
+    rng = random.Random(num_leaves)
+    tree = Tree(X25519CipherSuite())
+    members = []
+
+    for leaf_index in range(num_leaves):
+        tree.add_leaf(TreeNode(os.urandom(32)))
+        members.append(leaf_index)
+
+    # as many operations as there are leaves
+    for _ in range(num_leaves):
+        choice = rng.random()
+        if choice < remove_probability and len(members) > 1:
+            tree.remove_leaf(members.pop(rng.randrange(len(members))))
+        elif choice < remove_probability + update_probability:
+            node_index = rng.choice(members) * 2
+            for path_index in direct_path(node_index, tree.get_num_leaves()) + [root(tree.get_num_leaves())]:
+                tree.set_node(path_index, TreeNode(os.urandom(32)))
+        else:
+            members.append(tree.get_num_leaves())
+            tree.add_leaf(TreeNode(os.urandom(32)))
+
+    return tree
+
+
+def _get_welcome_size(tree: Tree, protocol_version: bytes) -> int:
+    # pylint: disable=unexpected-keyword-arg
+    return len(WelcomeInfoMessage(protocol_version=protocol_version, group_id=b'group', epoch=0,
+                                  tree=tree.get_nodes(), interim_transcript_hash=os.urandom(32),
+                                  init_secret=os.urandom(32), key=b'0', nounce=b'0').pack())
+
+
+def main():
+    print(f'{"trace":>12}{"leaves":>8}{"nodes":>8}{"blank [%]":>11}{"draft-07 [KiB]":>16}{"compact [KiB]":>15}'
+          f'{"saved [%]":>11}')
+
+    for trace, probabilities in TRACES.items():
+        for num_leaves in NUM_LEAVES:
+            tree = _create_tree(num_leaves, *probabilities)
+            num_blank = sum(1 for node in tree.get_nodes() if node is None)
+            legacy_size = _get_welcome_size(tree, PROTOCOL_VERSION_DRAFT_07)
+            compact_size = _get_welcome_size(tree, PROTOCOL_VERSION_COMPACT_TREE)
+
+            print(f'{trace:>12}{num_leaves:>8}{tree.get_num_nodes():>8}'
+                  f'{num_blank * 100 / tree.get_num_nodes():>11.1f}{legacy_size / 1024:>16.1f}'
+                  f'{compact_size / 1024:>15.1f}{(1 - compact_size / legacy_size) * 100:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
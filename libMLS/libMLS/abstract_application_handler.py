@@ -1,3 +1,15 @@
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class HandlerEvent:
+    """
+    A handler notification which was deferred while processing a batch of messages, see Session.process_messages
+    """
+    callback: str
+    args: tuple
+
 
 class AbstractApplicationHandler:
 
@@ -15,3 +27,43 @@ class AbstractApplicationHandler:
 
     def on_keys_updated(self, group_id: bytes):
         raise NotImplementedError()
+
+    def on_group_member_removed(self, group_id: bytes):
+        raise NotImplementedError()
+
+    def on_batch_processed(self, group_id: bytes, events: List[HandlerEvent]):
+        """
+        Called once after a batch of messages of a group was processed, with all notifications of the batch in
+        processing order. By default, the notifications are dispatched to the single callbacks.
+        """
+        for event in events:
+            getattr(self, event.callback)(*event.args)
+
+
+class DeferringHandler(AbstractApplicationHandler):
+    """
+    Records all notifications instead of handling them, so they can be delivered at once
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.events: List[HandlerEvent] = []
+
+    def _defer(self, callback: str, *args) -> None:
+        # pylint: disable=unexpected-keyword-arg
+        self.events.append(HandlerEvent(callback=callback, args=args))
+
+    def on_application_message(self, application_data: bytes, group_id: bytes):
+        self._defer('on_application_message', application_data, group_id)
+
+    def on_group_welcome(self, session):
+        self._defer('on_group_welcome', session)
+
+    def on_group_member_added(self, group_id: bytes):
+        self._defer('on_group_member_added', group_id)
+
+    def on_keys_updated(self, group_id: bytes):
+        self._defer('on_keys_updated', group_id)
+
+    def on_group_member_removed(self, group_id: bytes):
+        self._defer('on_group_member_removed', group_id)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Dict, List
 
 
 class AbstractKeystore:
@@ -11,5 +11,20 @@ class AbstractKeystore:
     def fetch_init_key(self, user_name: str) -> Optional[bytes]:
         raise NotImplementedError()
 
+    def fetch_init_keys(self, user_names: List[str]) -> Dict[str, Optional[bytes]]:
+        """
+        Fetches the init keys of several users. Key stores with a remote directory should override this to fetch all
+        keys in one round trip, by default the keys are fetched one by one.
+        :return: the init key of each user, None for users without an init key
+        """
+        return {user_name: self.fetch_init_key(user_name) for user_name in user_names}
+
     def get_private_key(self, public_key: bytes) -> Optional[bytes]:
         raise NotImplementedError()
+
+    def consume_private_key(self, public_key: bytes) -> Optional[bytes]:
+        """
+        Returns the private key of an init key which is used to join a group or create one. Key stores whose init
+        keys are handed out only once by the directory should forget the private key then, by default it is kept.
+        """
+        return self.get_private_key(public_key)
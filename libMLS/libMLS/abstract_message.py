@@ -1,6 +1,9 @@
+from libMLS.message_packer import MessageWriter
 
 
 class AbstractMessage:
+    # allows messages to declare __slots__, see message_schema
+    __slots__ = ()
 
     def __init__(self):
         return
@@ -17,7 +20,37 @@ class AbstractMessage:
 
     def _pack(self) -> bytes:
         # see https://docs.python.org/3.7/library/struct.html
-        raise NotImplementedError()
+        # A message overrides either _pack or packed_size and _write. By default, the message is written into a buffer
+        # of its exact size.
+        writer = MessageWriter(self.packed_size())
+        self._write(writer)
+        return writer.getvalue()
+
+    def write(self, writer: MessageWriter) -> None:
+        """
+        Serializes the message into the buffer of the given writer, e.g. the one of its parent message
+        """
+        if not self.validate():
+            raise RuntimeError(f'Validation failed for a message of type \"{self.__class__.__name__}\"')
+
+        self._write(writer)
+
+    def _write(self, writer: MessageWriter) -> None:
+        # messages which only implement _pack are copied into the buffer
+        self._require_pack()
+        writer.write_raw(self._pack())
+
+    def packed_size(self) -> int:
+        """
+        :return: the length of the packed message
+        """
+        self._require_pack()
+        return len(self._pack())
+
+    def _require_pack(self) -> None:
+        # the defaults of _pack and of _write/packed_size are built on each other, one side has to be overridden
+        if type(self)._pack is AbstractMessage._pack:
+            raise NotImplementedError(f'{self.__class__.__name__} implements neither _pack nor packed_size and _write')
 
     def validate(self) -> bool:
         raise NotImplementedError()
@@ -0,0 +1,86 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Optional, List
+
+from libMLS.abstract_application_handler import DeferringHandler, HandlerEvent
+from libMLS.messages import MLSCiphertext, WelcomeInfoMessage, AddMessage, UpdateMessage
+from libMLS.session import Session
+
+
+# pylint: disable=too-few-public-methods
+# the callbacks are implemented by the subclasses
+class AsyncApplicationHandler:
+    """
+    Asynchronous counterpart of AbstractApplicationHandler, see AsyncSession. Subclasses implement the callbacks of
+    AbstractApplicationHandler which they need, e.g. on_application_message, as coroutines with the same arguments.
+    """
+
+    async def on_batch_processed(self, group_id: bytes, events: List[HandlerEvent]):
+        """
+        Awaits the callbacks of the notifications in order, see AbstractApplicationHandler.on_batch_processed
+        """
+        # pylint: disable=unused-argument
+        # the group id is for subclasses which handle the batch as a whole
+        for event in events:
+            callback = getattr(self, event.callback, None)
+            if callback is None:
+                raise NotImplementedError(f"{type(self).__name__} does not implement {event.callback}")
+            await callback(*event.args)
+
+
+class AsyncSession:
+    """
+    Wraps a Session for the use in asyncio applications. The tree operations of a handshake are run in an executor,
+    so they do not block the event loop. As a Session belongs to exactly one group, all operations of the wrapper are
+    serialized, which preserves the order of the messages of the group. Handler notifications are awaited on the
+    event loop after the operation which caused them has finished.
+    """
+
+    def __init__(self, session: Session, executor: Optional[Executor] = None):
+        """
+        :param session: the wrapped session
+        :param executor: executor for the cryptographic operations, the default executor of the loop if None
+        """
+        self._session: Session = session
+        self._executor: Optional[Executor] = executor
+        self._lock: Optional[asyncio.Lock] = None
+
+    def get_session(self) -> Session:
+        return self._session
+
+    def _get_lock(self) -> asyncio.Lock:
+        # the lock is created lazily, as it is bound to the running loop on older python versions
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _execute(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def _run(self, function, *args):
+        async with self._get_lock():
+            return await self._execute(function, *args)
+
+    async def process_message(self, message: MLSCiphertext, handler: AsyncApplicationHandler) -> None:
+        """
+        See Session.process_message. The notifications of a message are awaited before the next message of the
+        group is processed.
+        """
+        async with self._get_lock():
+            deferred = DeferringHandler()
+            await self._execute(self._session.process_message, message, deferred)
+            if deferred.events:
+                await handler.on_batch_processed(message.group_id, deferred.events)
+
+    async def update(self) -> UpdateMessage:
+        """
+        See Session.update
+        """
+        return await self._run(self._session.update)
+
+    async def add_member(self, user_name: str, user_credentials: bytes,
+                         supported_versions: Optional[List[bytes]] = None) -> (WelcomeInfoMessage, AddMessage):
+        """
+        See Session.add_member. Fetching the init key of the new member is run in the executor as well.
+        """
+        return await self._run(self._session.add_member, user_name, user_credentials, supported_versions)
@@ -0,0 +1,126 @@
+"""
+Compact encoding of the tree of a WelcomeInfo, see PROTOCOL_VERSION_COMPACT_TREE. Blank nodes and the empty private
+key and credential vectors make up most of a packed tree after some churn, so the tree is packed as
+
+    struct {
+        uint32 num_nodes;
+        opaque present[(num_nodes + 7) / 8];
+        opaque has_credentials[(num_nodes + 7) / 8];
+        struct {
+            opaque public_key[32];
+            opaque credentials<0..2^32-1>; // only if the bit in has_credentials is set
+        } nodes[popcount(present)];
+    } CompactTree;
+
+The bitmaps are ordered by node index, starting with the most significant bit of the first byte. As a WelcomeInfo
+never contains private keys, the compact encoding cannot hold them.
+"""
+from struct import unpack_from, error as StructError
+from typing import List, Optional
+
+from libMLS.message_packer import MessageWriter, read_vector, MP_BYTE_ORDERING, MP_LENGTH_FIELD_SIZE
+from libMLS.tree_node import TreeNode
+
+# size of the public keys in the compact tree encoding
+COMPACT_KEY_SIZE: int = 32
+
+
+def _get_bitmap_size(num_nodes: int) -> int:
+    return (num_nodes + 7) // 8
+
+
+def can_pack_compact_tree(tree: List[Optional[TreeNode]]) -> bool:
+    """
+    :return: False if a node has a public key of another size or a private key
+    """
+    for node in tree:
+        if node is not None and (len(node.get_public_key()) != COMPACT_KEY_SIZE or node.has_private_key()):
+            return False
+
+    return True
+
+
+def compact_tree_size(tree: List[Optional[TreeNode]]) -> int:
+    """
+    :return: the length of the packed tree
+    """
+    nodes_size = MP_LENGTH_FIELD_SIZE + 2 * _get_bitmap_size(len(tree))
+    for node in tree:
+        if node is not None:
+            nodes_size += COMPACT_KEY_SIZE
+            if node.get_credentials():
+                nodes_size += MP_LENGTH_FIELD_SIZE + len(node.get_credentials())
+    return nodes_size
+
+
+def write_compact_tree(writer: MessageWriter, tree: List[Optional[TreeNode]]) -> None:
+    bitmap_size = _get_bitmap_size(len(tree))
+    present = bytearray(bitmap_size)
+    has_credentials = bytearray(bitmap_size)
+
+    for node_index, node in enumerate(tree):
+        if node is None:
+            continue
+
+        present[node_index >> 3] |= 0x80 >> (node_index & 7)
+        if node.get_credentials():
+            has_credentials[node_index >> 3] |= 0x80 >> (node_index & 7)
+
+    writer.write('I', len(tree))
+    writer.write_raw(bytes(present))
+    writer.write_raw(bytes(has_credentials))
+
+    for node in tree:
+        if node is None:
+            continue
+
+        writer.write_raw(node.get_public_key())
+        if node.get_credentials():
+            writer.write('V', node.get_credentials())
+
+
+def unpack_compact_tree(view: memoryview) -> List[Optional[TreeNode]]:
+    """
+    Reverse of write_compact_tree, the tree has to fill the whole buffer
+    :raises RuntimeError: if the buffer does not hold a valid compact tree
+    """
+    if len(view) < MP_LENGTH_FIELD_SIZE:
+        raise RuntimeError("Buffer is too short for a compact tree")
+
+    num_nodes: int = unpack_from(f'{MP_BYTE_ORDERING}I', view)[0]
+    bitmap_size = _get_bitmap_size(num_nodes)
+    offset = MP_LENGTH_FIELD_SIZE + 2 * bitmap_size
+
+    if offset > len(view):
+        raise RuntimeError(f"Buffer is too short for a compact tree of {num_nodes} nodes")
+
+    present = view[MP_LENGTH_FIELD_SIZE:MP_LENGTH_FIELD_SIZE + bitmap_size]
+    has_credentials = view[MP_LENGTH_FIELD_SIZE + bitmap_size:offset]
+    nodes: List[Optional[TreeNode]] = []
+
+    for node_index in range(num_nodes):
+        mask = 0x80 >> (node_index & 7)
+        if not present[node_index >> 3] & mask:
+            nodes.append(None)
+            continue
+
+        if offset + COMPACT_KEY_SIZE > len(view):
+            raise RuntimeError(f"Buffer is too short for node {node_index} of a compact tree")
+
+        public_key = bytes(view[offset:offset + COMPACT_KEY_SIZE])
+        offset += COMPACT_KEY_SIZE
+
+        credentials: Optional[bytes] = None
+        if has_credentials[node_index >> 3] & mask:
+            try:
+                credentials, offset = read_vector(view, offset)
+            except StructError as error:
+                raise RuntimeError(f"Credentials of node {node_index} exceed the buffer") from error
+            credentials = bytes(credentials)
+
+        nodes.append(TreeNode(public_key, None, credentials))
+
+    if offset != len(view):
+        raise RuntimeError("Compact tree is followed by trailing bytes")
+
+    return nodes
@@ -0,0 +1,105 @@
+import lzma
+import zlib
+from enum import Enum
+
+DEFAULT_COMPRESSION_THRESHOLD: int = 1024
+DEFAULT_MAX_DECOMPRESSED_SIZE: int = 16 * 1024 * 1024
+
+
+class CompressionCodec(Enum):
+    """
+    enum {
+        none(0),
+        zlib(1),
+        lzma(2),
+        (255)
+    } CompressionCodec;
+    """
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+
+class PayloadCompressor:
+    """
+    Optional compression of payloads, e.g. application data before it is encrypted or packed welcomes. A compressed
+    payload is prefixed with one byte holding its CompressionCodec:
+
+    struct {
+        CompressionCodec codec;
+        opaque payload[];
+    } CompressedPayload;
+
+    Payloads smaller than the threshold as well as payloads which do not shrink are sent with codec none, so small
+    chat messages only pay for the tag. Decompression stops at max_decompressed_size, which protects receivers
+    against decompression bombs.
+    """
+
+    def __init__(self, codec: CompressionCodec = CompressionCodec.ZLIB,
+                 threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+                 max_decompressed_size: int = DEFAULT_MAX_DECOMPRESSED_SIZE):
+        self._codec: CompressionCodec = codec
+        self._threshold: int = threshold
+        self._max_decompressed_size: int = max_decompressed_size
+
+    def get_codec(self) -> CompressionCodec:
+        return self._codec
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        :param data: the payload
+        :return: the tagged payload, compressed if it is worth it
+        """
+        if self._codec != CompressionCodec.NONE and len(data) >= self._threshold:
+            if self._codec == CompressionCodec.ZLIB:
+                compressed = zlib.compress(data)
+            else:
+                compressed = lzma.compress(data)
+
+            if len(compressed) < len(data):
+                return bytes([self._codec.value]) + compressed
+
+        return bytes([CompressionCodec.NONE.value]) + data
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Reverse of compress. Any codec can be decompressed, independent of the codec of this compressor.
+        :param data: the tagged payload
+        :return: the payload
+        :raises RuntimeError: if the tag is unknown, the payload is corrupt or exceeds max_decompressed_size
+        """
+        if not data:
+            raise RuntimeError("Compressed payload lacks the codec tag")
+
+        try:
+            codec = CompressionCodec(data[0])
+        except ValueError as error:
+            raise RuntimeError(f"Unknown compression codec {data[0]}") from error
+
+        payload = memoryview(data)[1:]
+
+        if codec == CompressionCodec.NONE:
+            if len(payload) > self._max_decompressed_size:
+                raise RuntimeError(f"Payload exceeds the limit of {self._max_decompressed_size} bytes")
+            return bytes(payload)
+
+        # decompress one byte more than allowed to detect payloads which exceed the limit
+        try:
+            if codec == CompressionCodec.ZLIB:
+                decompressor = zlib.decompressobj()
+                out = decompressor.decompress(payload, self._max_decompressed_size + 1)
+                complete = decompressor.eof
+            else:
+                decompressor = lzma.LZMADecompressor()
+                out = decompressor.decompress(payload, max_length=self._max_decompressed_size + 1)
+                complete = decompressor.eof
+        except (zlib.error, lzma.LZMAError) as error:
+            raise RuntimeError(f"Corrupt {codec.name.lower()} payload") from error
+
+        if len(out) > self._max_decompressed_size:
+            raise RuntimeError(f"Decompressed payload exceeds the limit of {self._max_decompressed_size} bytes")
+
+        if not complete:
+            raise RuntimeError(f"Truncated {codec.name.lower()} payload")
+
+        return out
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from libMLS.key_schedule import KeySchedule
+
+DEFAULT_MAX_EPOCHS: int = 8
+DEFAULT_MAX_BYTES: int = 64 * 1024
+
+
+def _zero(buffer: bytearray) -> None:
+    buffer[:] = bytes(len(buffer))
+
+
+@dataclass
+class EpochSecrets:
+    """
+    RFC Section 11.3 Deletion Schedule
+    https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-11.3
+
+    It is important to delete all security sensitive values as soon as
+    they are consumed.
+
+    The secrets of a past epoch which are needed to process application messages that arrive late, i.e. after the
+    handshake message which ended the epoch. The secrets are held in bytearrays, so they can be overwritten in place
+    once the epoch is evicted. Note that python may still hold copies of these values elsewhere.
+    """
+    epoch: int
+    application_secret: bytearray
+    sender_data_secret: bytearray
+    # ratchet state, i.e. the highest generation received per sender
+    generations: Dict[int, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_key_schedule(cls, epoch: int, key_schedule: KeySchedule) -> 'EpochSecrets':
+        # pylint: disable=unexpected-keyword-arg
+        return cls(epoch=epoch,
+                   application_secret=bytearray(key_schedule.get_application_secret()),
+                   sender_data_secret=bytearray(key_schedule.get_sender_data_secret()))
+
+    def get_size(self) -> int:
+        # two integers per ratchet entry
+        return len(self.application_secret) + len(self.sender_data_secret) + len(self.generations) * 8
+
+    def zero(self) -> None:
+        _zero(self.application_secret)
+        _zero(self.sender_data_secret)
+        self.generations.clear()
+
+
+class EpochHistory:
+    """
+    A bounded ring of the secrets of the last epochs. It is bounded by the number of epochs as well as by the memory
+    used by the secrets. Whenever one of the bounds is exceeded, the oldest epoch is evicted and its secrets are
+    zeroed.
+    """
+
+    def __init__(self, max_epochs: int = DEFAULT_MAX_EPOCHS, max_bytes: int = DEFAULT_MAX_BYTES):
+        if max_epochs < 1:
+            raise ValueError("The epoch history must hold at least one epoch")
+
+        self._max_epochs: int = max_epochs
+        self._max_bytes: int = max_bytes
+        self._epochs: 'OrderedDict[int, EpochSecrets]' = OrderedDict()
+        self._size: int = 0
+
+    def add(self, secrets: EpochSecrets) -> None:
+        if secrets.epoch in self._epochs:
+            self._evict(secrets.epoch)
+
+        self._epochs[secrets.epoch] = secrets
+        self._size += secrets.get_size()
+        self._enforce_bounds()
+
+    def get(self, epoch: int) -> Optional[EpochSecrets]:
+        return self._epochs.get(epoch)
+
+    def record_generation(self, epoch: int, sender: int, generation: int) -> None:
+        """
+        Advances the ratchet state of a sender in the given epoch
+        """
+        secrets = self._epochs.get(epoch)
+        if secrets is None:
+            raise KeyError(f"Epoch {epoch} is not part of the history")
+
+        if sender not in secrets.generations:
+            self._size += 8
+
+        secrets.generations[sender] = max(generation, secrets.generations.get(sender, generation))
+        self._enforce_bounds()
+
+    def get_num_epochs(self) -> int:
+        return len(self._epochs)
+
+    def get_size(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        for epoch in list(self._epochs.keys()):
+            self._evict(epoch)
+
+    def _enforce_bounds(self) -> None:
+        # the newest epoch is kept, even if it exceeds the memory budget on its own
+        while len(self._epochs) > 1 and (len(self._epochs) > self._max_epochs or self._size > self._max_bytes):
+            self._evict(next(iter(self._epochs)))
+
+    def _evict(self, epoch: int) -> None:
+        secrets = self._epochs.pop(epoch)
+        self._size -= secrets.get_size()
+        secrets.zero()
+
+    def __contains__(self, epoch: int) -> bool:
+        return epoch in self._epochs
@@ -0,0 +1,134 @@
+import threading
+from contextlib import ExitStack
+from typing import Dict, List, Optional
+
+DEFAULT_NUM_STRIPES: int = 64
+DEFAULT_KEY_SIZE: int = 32
+
+
+class KeyDirectory:
+    """
+    In-memory stand-in for the init key API of the dirserver (see store.init_key_store.InitKeyStore in the
+    infrastructure), e.g. for load tests and simulations with many threads and groups.
+
+    Every user has a queue of init keys, each key is handed out once and the most recently added key is handed out
+    first, as by the dirserver. The keys of a user are concatenated in one bytearray, as all keys of a cipher suite
+    have the same size, so a user costs one dict entry and one bytearray instead of an object per key.
+
+    The users are spread over num_stripes dicts with a lock each, so threads working on different users rarely wait
+    for each other. Independent simulations use separate namespaces, see namespace.
+    """
+
+    def __init__(self, num_stripes: int = DEFAULT_NUM_STRIPES, key_size: int = DEFAULT_KEY_SIZE):
+        if num_stripes < 1:
+            raise RuntimeError(f"Key directory needs at least one stripe, not {num_stripes}")
+
+        self._num_stripes: int = num_stripes
+        self._key_size: int = key_size
+        self._stripes: List[Dict[str, bytearray]] = [{} for _ in range(num_stripes)]
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(num_stripes)]
+
+        self._namespace_lock = threading.Lock()
+        self._namespaces: Dict[str, 'KeyDirectory'] = {}
+
+    def namespace(self, name: str) -> 'KeyDirectory':
+        """
+        :param name: the name of the namespace, e.g. of a test or a simulated group
+        :return: the key directory of the namespace, which is created on first use and shares no users with this
+                 directory or other namespaces
+        """
+        with self._namespace_lock:
+            if name not in self._namespaces:
+                self._namespaces[name] = KeyDirectory(self._num_stripes, self._key_size)
+            return self._namespaces[name]
+
+    def drop_namespace(self, name: str) -> None:
+        with self._namespace_lock:
+            self._namespaces.pop(name, None)
+
+    def _get_stripe_index(self, user: str) -> int:
+        return hash(user) % self._num_stripes
+
+    def _check_key(self, key: bytes) -> None:
+        if len(key) != self._key_size:
+            raise RuntimeError(f"Init key has {len(key)} bytes, the directory stores keys of {self._key_size} bytes")
+
+    def add_key(self, user: str, key: bytes, identifier: str = "") -> None:
+        self.add_keys(user, [key], identifier)
+
+    # pylint: disable=unused-argument
+    def add_keys(self, user: str, keys: List[bytes], identifier: str = "") -> None:
+        """
+        :param identifier: ignored, for compatibility with InitKeyStore
+        :raises RuntimeError: if a key does not have the key size of the directory
+        """
+        for key in keys:
+            self._check_key(key)
+
+        # an empty entry would look like a user with keys to take_key_for_user and take_keys
+        if not keys:
+            return
+
+        index = self._get_stripe_index(user)
+        with self._locks[index]:
+            self._stripes[index].setdefault(user, bytearray()).extend(b''.join(keys))
+
+    def get_num_keys(self, user: str) -> int:
+        index = self._get_stripe_index(user)
+        with self._locks[index]:
+            return len(self._stripes[index].get(user, b'')) // self._key_size
+
+    def has_key(self, user: str) -> bool:
+        return self.get_num_keys(user) > 0
+
+    def _pop_key(self, stripe: Dict[str, bytearray], user: str) -> bytes:
+        keys = stripe[user]
+        key = bytes(keys[-self._key_size:])
+        del keys[-self._key_size:]
+
+        # users without keys are dropped, so a directory of millions of users only holds the ones with keys
+        if not keys:
+            del stripe[user]
+
+        return key
+
+    def take_key_for_user(self, user: str) -> Optional[bytes]:
+        index = self._get_stripe_index(user)
+        with self._locks[index]:
+            if user not in self._stripes[index]:
+                return None
+            return self._pop_key(self._stripes[index], user)
+
+    def take_keys(self, users: List[str]) -> Optional[Dict[str, bytes]]:
+        """
+        Takes one key of each of the given users at once, see InitKeyStore.take_keys. The locks of all involved
+        stripes are acquired in ascending order, so concurrent batches cannot deadlock.
+        :param users: the users, duplicates are ignored
+        :return: the key of each user or None if any user has no key left
+        """
+        users = list(dict.fromkeys(users))
+        indices = {user: self._get_stripe_index(user) for user in users}
+
+        with ExitStack() as stack:
+            for index in sorted(set(indices.values())):
+                stack.enter_context(self._locks[index])
+
+            if not all(user in self._stripes[indices[user]] for user in users):
+                return None
+
+            return {user: self._pop_key(self._stripes[indices[user]], user) for user in users}
+
+    def clear_user(self, user: str) -> None:
+        index = self._get_stripe_index(user)
+        with self._locks[index]:
+            self._stripes[index].pop(user, None)
+
+    def get_num_users(self) -> int:
+        """
+        :return: the number of users with at least one key
+        """
+        num_users = 0
+        for lock, stripe in zip(self._locks, self._stripes):
+            with lock:
+                num_users += len(stripe)
+        return num_users
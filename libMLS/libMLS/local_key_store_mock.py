@@ -1,29 +1,45 @@
 import string
-from typing import Dict, Optional
+from typing import Optional
 
 from libMLS.abstract_keystore import AbstractKeystore
+from libMLS.key_directory import KeyDirectory
+from libMLS.private_key_store import PrivateKeyStore
 from libMLS.remote_key_store_mock import RemoteKeyStoreMock
 
 
 class LocalKeyStoreMock(AbstractKeystore):
-
-    def __init__(self, user_name: string):
+    """
+    Without a directory, the init keys are published to the process-wide RemoteKeyStoreMock, which hands out the
+    last key of each user any number of times. With a KeyDirectory, e.g. a namespace of a simulation, every init key
+    is handed out once as by the dirserver.
+    """
+
+    def __init__(self, user_name: string, private_keys: Optional[PrivateKeyStore] = None,
+                 directory: Optional[KeyDirectory] = None):
         super().__init__(user_name)
         self._name: string = user_name
 
-        self._public_private_keymap: Dict[bytes, bytes] = {}
+        self._private_keys: PrivateKeyStore = private_keys if private_keys is not None else PrivateKeyStore()
+        self._directory: Optional[KeyDirectory] = directory
 
     def register_keypair(self, public_key: bytes, private_key: bytes):
-        self._public_private_keymap[public_key] = private_key
-        RemoteKeyStoreMock().register_init_key(user_name=self._name, public_key=public_key)
+        self._private_keys.add_keypairs([(public_key, private_key)])
+        if self._directory is not None:
+            self._directory.add_key(self._name, public_key)
+        else:
+            RemoteKeyStoreMock().register_init_key(user_name=self._name, public_key=public_key)
 
-    # pylint: disable=no-self-use
     def fetch_init_key(self, user_name: string) -> Optional[bytes]:
+        if self._directory is not None:
+            return self._directory.take_key_for_user(user_name)
         return RemoteKeyStoreMock().fetch_init_key(user_name=user_name)
 
     def get_private_key(self, public_key: bytes) -> Optional[bytes]:
-
-        if public_key not in self._public_private_keymap:
-            return None
-
-        return self._public_private_keymap[public_key]
+        return self._private_keys.get_private_key(public_key)
+
+    def consume_private_key(self, public_key: bytes) -> Optional[bytes]:
+        private_key = self._private_keys.get_private_key(public_key)
+        # keys of the mock directory are handed out repeatedly, so they have to be kept
+        if self._directory is not None:
+            self._private_keys.delete_keys([public_key])
+        return private_key
@@ -1,23 +1,51 @@
+import functools
 import string
 import struct
 
-from struct import unpack_from
-from typing import List
+from typing import List, Tuple, Union, Iterator, Callable, Any
 
 MP_BYTE_ORDERING: str = '!'
 MP_LENGTH_FIELD_SIZE: int = struct.calcsize(MP_BYTE_ORDERING + 'L')
+MP_DEFAULT_MAX_FRAME_SIZE: int = 16 * 1024 * 1024
 
 
 class DynamicPackingException(Exception):
     pass
 
 
-def pack_dynamic(pack_fmt: string, *args) -> bytes:
-    out_fmt: string = ""
-    out_args = []
+class _FixedStep:
+    """
+    A run of format characters without vectors, packed and unpacked by a single precompiled struct
+    """
+
+    def __init__(self, fmt: string, num_args: int):
+        self.struct: struct.Struct = struct.Struct(MP_BYTE_ORDERING + fmt)
+        self.num_args: int = num_args
+
+
+class _VectorStep:
+    """
+    A length prefixed vector of bytes ('V')
+    """
+    num_args: int = 1
+
 
+_LENGTH_STRUCT: struct.Struct = struct.Struct(MP_BYTE_ORDERING + 'L')
+_VECTOR_STEP: _VectorStep = _VectorStep()
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(pack_fmt: string) -> tuple:
+    """
+    Compiles a format string once into a plan of steps. Consecutive format characters without vectors are merged
+    into a single precompiled struct.
+    :param pack_fmt: the format string, see pack_dynamic
+    :return: tuple of _FixedStep and _VectorStep
+    """
+    steps: list = []
+    fixed_fmt: string = ""
+    fixed_args: int = 0
     digit_backlog: string = ""
-    arg_index = 0
 
     # todo: padbytes
     for pack_char in pack_fmt:
@@ -27,14 +55,12 @@ def pack_dynamic(pack_fmt: string, *args) -> bytes:
             continue
 
         if pack_char != 'V':
-            out_fmt += digit_backlog + pack_char
+            fixed_fmt += digit_backlog + pack_char
 
             if pack_char == 's' or digit_backlog == "":
-                out_args.append(args[arg_index])
-                arg_index += 1
+                fixed_args += 1
             else:
-                out_args += [*args[arg_index:arg_index + int(digit_backlog)]]
-                arg_index += int(digit_backlog)
+                fixed_args += int(digit_backlog)
 
             digit_backlog = ""
             continue
@@ -42,64 +68,329 @@ def pack_dynamic(pack_fmt: string, *args) -> bytes:
         if digit_backlog != "":
             raise DynamicPackingException(f'\'V\' may not be used with quantifiers, \"{digit_backlog}\" given')
 
-        if not isinstance(args[arg_index], bytes):
-            raise DynamicPackingException('Argument provided for \'V\' is not of type \'bytes\'!')
+        if fixed_fmt != "":
+            steps.append(_FixedStep(fixed_fmt, fixed_args))
+            fixed_fmt = ""
+            fixed_args = 0
 
-        # todo: check len
-        vec_len = len(args[arg_index])
-        out_fmt += 'L'
-        out_args.append(vec_len)
-        if vec_len > 0:
-            out_fmt += f'{len(args[arg_index])}s'
-            out_args.append(args[arg_index])
-        arg_index += 1
+        steps.append(_VECTOR_STEP)
 
-    return struct.pack(MP_BYTE_ORDERING + out_fmt, *out_args)
+    if digit_backlog != "":
+        raise DynamicPackingException(f'Format string ends with the quantifier \"{digit_backlog}\"')
 
+    if fixed_fmt != "":
+        steps.append(_FixedStep(fixed_fmt, fixed_args))
 
-def unpack_dynamic(pack_fmt: string, buffer: bytes) -> tuple:
-    out_tuple: tuple = ()
+    return tuple(steps)
 
-    digit_backlog = ""
 
-    for fmt_char in pack_fmt:
-
-        if fmt_char.isdigit():
-            digit_backlog += fmt_char
-            continue
-
-        if fmt_char != 'V':
-            multiplier = 1
-            if digit_backlog != "":
-                multiplier = int(digit_backlog)
-            to_remove = struct.calcsize(MP_BYTE_ORDERING+fmt_char) * multiplier
-
-            out_tuple = out_tuple + struct.unpack(
-                f'{MP_BYTE_ORDERING}{digit_backlog}{fmt_char}', buffer[:to_remove])
-            buffer = buffer[to_remove:]
-            continue
-
-        vector_size = struct.unpack(f'{MP_BYTE_ORDERING}L', buffer[:struct.calcsize(MP_BYTE_ORDERING+'L')])[0]
-        buffer = buffer[struct.calcsize(MP_BYTE_ORDERING+'L'):]
-
-        vector_contents = struct.unpack(f'{MP_BYTE_ORDERING}{vector_size}s', buffer[:vector_size])
-        buffer = buffer[vector_size:]
+def pack_dynamic(pack_fmt: string, *args) -> bytes:
+    """
+    Packs the given arguments like struct.pack, but additionally supports 'V' for vectors of bytes, which are
+    prefixed with their length. The format string is compiled once and cached.
+    :param pack_fmt: the format string without byte ordering
+    :param args: the values to pack
+    :return: the packed values
+    """
+    out: List[bytes] = []
+    arg_index = 0
 
-        out_tuple = out_tuple + vector_contents
+    for step in _compile(pack_fmt):
+        if step is _VECTOR_STEP:
+            vector = args[arg_index]
+            if not isinstance(vector, bytes):
+                raise DynamicPackingException('Argument provided for \'V\' is not of type \'bytes\'!')
 
-    return out_tuple
+            # todo: check len
+            out.append(_LENGTH_STRUCT.pack(len(vector)))
+            out.append(vector)
+        else:
+            out.append(step.struct.pack(*args[arg_index:arg_index + step.num_args]))
 
+        arg_index += step.num_args
 
-def unpack_byte_list(buffer: bytes) -> List[bytes]:
-    pointer: int = 0
-    out_list: List[bytes] = []
-    while pointer < len(buffer):
-        entry_len: int = unpack_from(f'{MP_BYTE_ORDERING}L', buffer, pointer)[0]
-        pointer += struct.calcsize(MP_BYTE_ORDERING+'L')
+    return b''.join(out)
 
-        entry: bytes = unpack_from(f'{MP_BYTE_ORDERING}{entry_len}s', buffer, pointer)[0]
-        pointer += entry_len
 
-        out_list.append(entry)
+def calc_packed_size(pack_fmt: string, *args) -> int:
+    """
+    Calculates the length of pack_dynamic(pack_fmt, *args) without packing anything
+    """
+    size = 0
+    arg_index = 0
 
-    return out_list
+    for step in _compile(pack_fmt):
+        if step is _VECTOR_STEP:
+            size += MP_LENGTH_FIELD_SIZE + len(args[arg_index])
+        else:
+            size += step.struct.size
+
+        arg_index += step.num_args
+
+    return size
+
+
+class MessageWriter:
+    """
+    Serializes messages into a single bytearray. If the size of the message is known beforehand (see
+    AbstractMessage.packed_size), the buffer is allocated once, otherwise it grows geometrically. Nested messages
+    are written straight into the buffer of their parent.
+    """
+
+    def __init__(self, size: int = 0):
+        self._buffer: bytearray = bytearray(size)
+        self._offset: int = 0
+
+    def _reserve(self, size: int) -> None:
+        missing = self._offset + size - len(self._buffer)
+        if missing > 0:
+            self._buffer.extend(bytes(max(missing, len(self._buffer))))
+
+    def write(self, pack_fmt: string, *args) -> None:
+        """
+        Writes the given values like pack_dynamic
+        """
+        arg_index = 0
+
+        for step in _compile(pack_fmt):
+            if step is _VECTOR_STEP:
+                vector = args[arg_index]
+                if not isinstance(vector, bytes):
+                    raise DynamicPackingException('Argument provided for \'V\' is not of type \'bytes\'!')
+
+                self._reserve(MP_LENGTH_FIELD_SIZE + len(vector))
+                _LENGTH_STRUCT.pack_into(self._buffer, self._offset, len(vector))
+                self._offset += MP_LENGTH_FIELD_SIZE
+                self._buffer[self._offset:self._offset + len(vector)] = vector
+                self._offset += len(vector)
+            else:
+                self._reserve(step.struct.size)
+                step.struct.pack_into(self._buffer, self._offset, *args[arg_index:arg_index + step.num_args])
+                self._offset += step.struct.size
+
+            arg_index += step.num_args
+
+    def write_raw(self, data: bytes) -> None:
+        """
+        Writes already packed data without a length prefix
+        """
+        self._reserve(len(data))
+        self._buffer[self._offset:self._offset + len(data)] = data
+        self._offset += len(data)
+
+    def write_message_vector(self, message) -> None:
+        """
+        Writes a nested message as a vector. The length is taken from message.packed_size(), so it is written
+        before the message itself.
+        :param message: an AbstractMessage
+        """
+        size = message.packed_size()
+        self._reserve(MP_LENGTH_FIELD_SIZE + size)
+        _LENGTH_STRUCT.pack_into(self._buffer, self._offset, size)
+        self._offset += MP_LENGTH_FIELD_SIZE
+
+        start = self._offset
+        message.write(self)
+
+        if self._offset - start != size:
+            raise DynamicPackingException(f'{message.__class__.__name__} reported a size of {size} bytes, '
+                                          f'but wrote {self._offset - start} bytes')
+
+    def begin_vector(self) -> int:
+        """
+        Starts a vector of unknown length. The length field is filled by end_vector.
+        :return: the position of the length field
+        """
+        self._reserve(MP_LENGTH_FIELD_SIZE)
+        position = self._offset
+        self._offset += MP_LENGTH_FIELD_SIZE
+        return position
+
+    def end_vector(self, position: int) -> None:
+        _LENGTH_STRUCT.pack_into(self._buffer, position, self._offset - position - MP_LENGTH_FIELD_SIZE)
+
+    def get_size(self) -> int:
+        return self._offset
+
+    def getvalue(self) -> bytes:
+        if self._offset == len(self._buffer):
+            return bytes(self._buffer)
+        return bytes(memoryview(self._buffer)[:self._offset])
+
+
+def read_vector(buffer: memoryview, offset: int) -> Tuple[memoryview, int]:
+    """
+    Reads a length prefixed vector without copying it
+    :param buffer: the packed data
+    :param offset: the offset of the length field of the vector
+    :return: the contents of the vector and the offset behind it
+    """
+    vector_size = _LENGTH_STRUCT.unpack_from(buffer, offset)[0]
+    offset += MP_LENGTH_FIELD_SIZE
+
+    if offset + vector_size > len(buffer):
+        raise struct.error(f'unpack requires a buffer of {vector_size} bytes for a vector')
+
+    return buffer[offset:offset + vector_size], offset + vector_size
+
+
+def unpack_dynamic_from(pack_fmt: string, buffer: Union[bytes, memoryview], offset: int = 0,
+                        copy_vectors: bool = True) -> Tuple[tuple, int]:
+    """
+    Reverse of pack_dynamic, starting at the given offset. The buffer is walked through a memoryview, so nothing is
+    copied except for the returned values.
+    :param pack_fmt: the format string without byte ordering
+    :param buffer: the packed values
+    :param offset: offset of the first value
+    :param copy_vectors: if False, vectors are returned as memoryviews of the buffer instead of bytes. This is meant
+                         for nested messages, which are unpacked further anyway.
+    :return: the unpacked values and the offset behind them
+    """
+    view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+    out: list = []
+
+    for step in _compile(pack_fmt):
+        if step is _VECTOR_STEP:
+            vector, offset = read_vector(view, offset)
+            out.append(bytes(vector) if copy_vectors else vector)
+        else:
+            out.extend(step.struct.unpack_from(view, offset))
+            offset += step.struct.size
+
+    return tuple(out), offset
+
+
+def unpack_dynamic(pack_fmt: string, buffer: Union[bytes, memoryview]) -> tuple:
+    """
+    Reverse of pack_dynamic, trailing bytes are ignored
+    :param pack_fmt: the format string without byte ordering
+    :param buffer: the packed values
+    :return: the unpacked values
+    """
+    return unpack_dynamic_from(pack_fmt, buffer)[0]
+
+
+def iter_byte_list(buffer: Union[bytes, memoryview]) -> Iterator[memoryview]:
+    """
+    Iterates over a concatenation of vectors without copying them, see unpack_byte_list
+    """
+    view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+    offset = 0
+    while offset < len(view):
+        entry, offset = read_vector(view, offset)
+        yield entry
+
+
+def unpack_byte_list(buffer: Union[bytes, memoryview]) -> List[bytes]:
+    return [bytes(entry) for entry in iter_byte_list(buffer)]
+
+
+def frame(data: bytes) -> bytes:
+    """
+    Prefixes a packed message with its length, so it can be sent over a stream, see FrameDecoder
+    """
+    return pack_dynamic('V', data)
+
+
+class FrameDecodingError(DynamicPackingException):
+    """
+    Raised by FrameDecoder.feed if frames of the received chunk could not be decoded. The frames which were decoded
+    are not lost, they are part of the exception.
+    """
+
+    def __init__(self, frames: List[Any], errors: List[Exception]):
+        super().__init__(f'{len(errors)} frame(s) could not be decoded: {errors}')
+        self.frames: List[Any] = frames
+        self.errors: List[Exception] = errors
+
+
+class FrameDecoder:
+    """
+    Incrementally decodes length prefixed frames (see frame()) from a stream which is received in arbitrary chunks.
+
+    Complete frames are decoded straight from the received chunk where possible, only incomplete frames are
+    buffered. The size of a frame is checked as soon as its length field is received, so the buffer never grows
+    beyond the maximum frame size.
+
+    The decode function is called with a memoryview, which is only valid during the call. It has to copy whatever
+    it keeps, e.g. MLSCiphertext.from_bytes for complete messages or MLSCiphertext.peek_header for header-only
+    views of messages.
+    """
+
+    def __init__(self, decode: Callable[[memoryview], Any], max_frame_size: int = MP_DEFAULT_MAX_FRAME_SIZE):
+        self._decode: Callable[[memoryview], Any] = decode
+        self._max_frame_size: int = max_frame_size
+        self._buffer: bytearray = bytearray()
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """
+        Adds a chunk of the stream and decodes all frames which are complete afterwards. A frame which fails to
+        decode is skipped, the following frames are still decoded.
+
+        A frame which exceeds the maximum frame size means that the stream is corrupt, as the start of the next frame
+        is unknown. Everything received so far is dropped, so the decoder can be used for a new stream.
+        :param chunk: the next bytes of the stream
+        :return: the decoded frames in order of the stream
+        :raises FrameDecodingError: if a frame failed to decode or exceeded the maximum frame size, it holds the
+                                    frames which were decoded
+        """
+        if self._buffer:
+            self._buffer.extend(chunk)
+            data = self._buffer
+        else:
+            data = chunk
+
+        out: List[Any] = []
+        errors: List[Exception] = []
+        offset = 0
+        while True:
+            try:
+                frame_size = self._next_frame_size(data, offset)
+            except DynamicPackingException as error:
+                errors.append(error)
+                offset = len(data)
+                break
+
+            if frame_size is None:
+                break
+
+            start = offset + MP_LENGTH_FIELD_SIZE
+            offset = start + frame_size
+            try:
+                with memoryview(data) as view, view[start:offset] as frame_view:
+                    out.append(self._decode(frame_view))
+            # the decode function is given by the caller, so any error is reported with the frame
+            # pylint: disable=broad-except
+            except Exception as error:
+                errors.append(error)
+
+        # keep the incomplete rest of the stream
+        if data is self._buffer:
+            del self._buffer[:offset]
+        else:
+            self._buffer.extend(memoryview(data)[offset:])
+
+        if errors:
+            raise FrameDecodingError(out, errors)
+
+        return out
+
+    def _next_frame_size(self, data, offset: int):
+        if len(data) - offset < MP_LENGTH_FIELD_SIZE:
+            return None
+
+        frame_size = _LENGTH_STRUCT.unpack_from(data, offset)[0]
+        if frame_size > self._max_frame_size:
+            raise DynamicPackingException(f'Frame of {frame_size} bytes exceeds the maximum frame size of '
+                                          f'{self._max_frame_size} bytes')
+
+        if len(data) - offset - MP_LENGTH_FIELD_SIZE < frame_size:
+            return None
+
+        return frame_size
+
+    def get_num_pending_bytes(self) -> int:
+        """
+        :return: the number of buffered bytes of an incomplete frame
+        """
+        return len(self._buffer)
@@ -0,0 +1,278 @@
+"""
+Declarative schemas for messages. Instead of hand-writing a format string in _pack and from_bytes as well as
+validate and __eq__, the fields of a message dataclass are given a field spec:
+
+    @message_schema(ephemeral_key=FixedOpaque(32), cipher_text=Opaque(2 ** 16 - 1))
+    @dataclass
+    class HPKECiphertext(SchemaMessage):
+        ephemeral_key: bytes
+        cipher_text: bytes
+
+At class definition time, message_schema generates specialized _pack, packed_size, from_bytes, validate and __eq__
+methods for the declared fields and adds __slots__. The generated code packs and unpacks with precompiled structs and
+does not interpret the schema per call. The wire format is the one of pack_dynamic, i.e. every vector is prefixed
+with a 4 byte length.
+
+The generated source of a class is kept in its SCHEMA_SOURCE and registered with linecache, so tracebacks and
+debuggers show the generated lines like those of any other module.
+"""
+import linecache
+import struct
+from dataclasses import fields
+from enum import Enum
+from typing import List, Type, Tuple, Callable
+
+from libMLS.abstract_message import AbstractMessage
+from libMLS.message_packer import MP_BYTE_ORDERING
+
+
+class FieldSpec:
+    """
+    Base of all field specs
+    """
+    # struct format character of fixed size fields, None for vectors
+    fmt: str = None
+
+    def pack_expression(self, value: str) -> str:
+        return value
+
+    def unpack_expression(self, value: str) -> str:
+        return value
+
+    def validate_expression(self, value: str) -> str:
+        raise NotImplementedError()
+
+
+class UInt8(FieldSpec):
+    fmt = 'B'
+
+    def validate_expression(self, value: str) -> str:
+        return f'isinstance({value}, int) and 0 <= {value} < 2 ** 8'
+
+
+class UInt32(FieldSpec):
+    fmt = 'I'
+
+    def validate_expression(self, value: str) -> str:
+        return f'isinstance({value}, int) and 0 <= {value} < 2 ** 32'
+
+
+class EnumField(FieldSpec):
+    """
+    An enum which is encoded as uint8
+    """
+    fmt = 'B'
+
+    def __init__(self, enum_type: Type[Enum]):
+        self.enum_type: Type[Enum] = enum_type
+
+    def pack_expression(self, value: str) -> str:
+        return f'{value}.value'
+
+    def unpack_expression(self, value: str) -> str:
+        return f'{self.enum_type.__name__}({value})'
+
+    def validate_expression(self, value: str) -> str:
+        return f'isinstance({value}, {self.enum_type.__name__})'
+
+
+class FixedOpaque(FieldSpec):
+    """
+    opaque value[length];
+    """
+
+    def __init__(self, length: int):
+        self.length: int = length
+        self.fmt = f'{length}s'
+
+    def validate_expression(self, value: str) -> str:
+        return f'isinstance({value}, bytes) and len({value}) == {self.length}'
+
+
+class Opaque(FieldSpec):
+    """
+    opaque value<0..max_length>;
+    """
+
+    def __init__(self, max_length: int = 2 ** 32 - 1):
+        self.max_length: int = max_length
+
+    def validate_expression(self, value: str) -> str:
+        return f'isinstance({value}, bytes) and len({value}) <= {self.max_length}'
+
+
+class SchemaMessage(AbstractMessage):
+    """
+    Base of all messages with a schema. The methods below are replaced by the generated ones, see message_schema.
+    """
+    __slots__ = ()
+
+    # the field names and specs in order of the packed message
+    SCHEMA: Tuple[Tuple[str, FieldSpec], ...] = ()
+    # the generated methods as python source
+    SCHEMA_SOURCE: str = ''
+
+    @classmethod
+    def _not_generated(cls) -> TypeError:
+        return TypeError(f'{cls.__name__} is not decorated with message_schema')
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        raise cls._not_generated()
+
+    def _pack(self) -> bytes:
+        raise self._not_generated()
+
+    def packed_size(self) -> int:
+        raise self._not_generated()
+
+    def _validate_schema(self) -> bool:
+        raise self._not_generated()
+
+    def validate(self) -> bool:
+        return self._validate_schema()
+
+
+def _compile_functions(cls_name: str, source: str, namespace: dict) -> None:
+    """
+    Compiles the generated source into namespace, under a file name which linecache resolves to the source
+    """
+    file_name = f'<message_schema {cls_name}>'
+    lines = source.splitlines(keepends=True)
+    linecache.cache[file_name] = (len(source), None, lines, file_name)
+    exec(compile(source, file_name, 'exec'), namespace)  # pylint: disable=exec-used
+
+
+def _generate_pack(names: List[str], specs: List[FieldSpec], structs: list) -> str:
+    lines = ['def _pack(self):']
+    parts: List[str] = []
+    fmt: str = ''
+    args: List[str] = []
+
+    for name, field_spec in zip(names, specs):
+        if field_spec.fmt is not None:
+            fmt += field_spec.fmt
+            args.append(field_spec.pack_expression(f'self.{name}'))
+            continue
+
+        # the length of a vector is packed together with the preceding fixed size fields
+        lines.append(f'    {name} = self.{name}')
+        fmt += 'L'
+        args.append(f'len({name})')
+        structs.append(struct.Struct(MP_BYTE_ORDERING + fmt))
+        parts.append(f'_structs[{len(structs) - 1}].pack({", ".join(args)})')
+        parts.append(name)
+        fmt = ''
+        args = []
+
+    if fmt:
+        structs.append(struct.Struct(MP_BYTE_ORDERING + fmt))
+        parts.append(f'_structs[{len(structs) - 1}].pack({", ".join(args)})')
+
+    lines.append(f'    return b"".join(({", ".join(parts)},))')
+    return '\n'.join(lines)
+
+
+def _generate_packed_size(names: List[str], specs: List[FieldSpec]) -> str:
+    fixed_size = struct.calcsize(MP_BYTE_ORDERING + ''.join(field_spec.fmt if field_spec.fmt is not None else 'L'
+                                                            for field_spec in specs))
+    vectors = [f'len(self.{name})' for name, field_spec in zip(names, specs) if field_spec.fmt is None]
+    return f'def packed_size(self):\n    return {" + ".join([str(fixed_size)] + vectors)}'
+
+
+def _generate_from_bytes(cls_name: str, names: List[str], specs: List[FieldSpec], structs: list) -> str:
+    lines = ['def from_bytes(cls, data):',
+             '    end = len(data)',
+             '    offset = 0']
+    fmt: str = ''
+    targets: List[str] = []
+
+    def unpack_segment(segment_fmt: str, segment_targets: List[str]):
+        segment = struct.Struct(MP_BYTE_ORDERING + segment_fmt)
+        structs.append(segment)
+        lines.append(f'    if offset + {segment.size} > end:')
+        lines.append(f'        raise RuntimeError("Buffer is too short for a message of type {cls_name}")')
+        lines.append(f'    {", ".join(segment_targets)}, = _structs[{len(structs) - 1}].unpack_from(data, offset)')
+        lines.append(f'    offset += {segment.size}')
+
+    for name, field_spec in zip(names, specs):
+        if field_spec.fmt is not None:
+            fmt += field_spec.fmt
+            targets.append(name)
+            continue
+
+        unpack_segment(fmt + 'L', targets + [f'{name}_length'])
+        lines.append(f'    if offset + {name}_length > end:')
+        lines.append(f'        raise RuntimeError("Vector {name} exceeds the buffer")')
+        lines.append(f'    {name} = bytes(data[offset:offset + {name}_length])')
+        lines.append(f'    offset += {name}_length')
+        fmt = ''
+        targets = []
+
+    if fmt:
+        unpack_segment(fmt, targets)
+
+    arguments = [f'{name}={field_spec.unpack_expression(name)}' for name, field_spec in zip(names, specs)]
+    lines.append(f'    inst = cls({", ".join(arguments)})')
+    lines.append('    if not inst.validate():')
+    lines.append('        raise RuntimeError()')
+    lines.append('    return inst')
+    return '\n'.join(lines)
+
+
+def _generate_validate(names: List[str], specs: List[FieldSpec]) -> str:
+    checks = [f'({field_spec.validate_expression(f"self.{name}")})' for name, field_spec in zip(names, specs)]
+    return f'def _validate_schema(self):\n    return {" and ".join(checks) if checks else "True"}'
+
+
+def _generate_eq(names: List[str]) -> str:
+    comparisons = [f'self.{name} == other.{name}' for name in names]
+    return f'def __eq__(self, other):\n' \
+           f'    if not isinstance(other, self.__class__):\n' \
+           f'        return False\n' \
+           f'    return {" and ".join(comparisons) if comparisons else "True"}'
+
+
+def message_schema(**field_specs: FieldSpec) -> Callable[[type], type]:
+    """
+    Generates the packing, unpacking, validation and comparison of a SchemaMessage dataclass from the given field
+    specs, one for each field of the dataclass. If the class defines validate itself, it can call
+    self._validate_schema() for the generated checks.
+    """
+
+    def decorate(cls):
+        names: List[str] = [schema_field.name for schema_field in fields(cls)]
+        if not issubclass(cls, SchemaMessage):
+            raise TypeError(f'{cls.__name__} has a schema, but is no SchemaMessage')
+        if set(names) != set(field_specs):
+            raise TypeError(f'Fields {sorted(set(names) ^ set(field_specs))} of {cls.__name__} have no field spec or '
+                            f'are not part of the dataclass')
+        specs: List[FieldSpec] = [field_specs[name] for name in names]
+
+        structs: list = []
+        namespace = {'_structs': structs}
+        namespace.update({field_spec.enum_type.__name__: field_spec.enum_type
+                          for field_spec in specs if isinstance(field_spec, EnumField)})
+
+        source = '\n\n'.join([_generate_pack(names, specs, structs),
+                               _generate_packed_size(names, specs),
+                               _generate_from_bytes(cls.__name__, names, specs, structs),
+                               _generate_validate(names, specs),
+                               _generate_eq(names)]) + '\n'
+        _compile_functions(cls.__name__, source, namespace)
+
+        attributes = dict(cls.__dict__)
+        attributes.pop('__dict__', None)
+        attributes.pop('__weakref__', None)
+        attributes['__slots__'] = tuple(names)
+        attributes['SCHEMA'] = tuple(zip(names, specs))
+        attributes['SCHEMA_SOURCE'] = source
+        for name in ['_pack', 'packed_size', '_validate_schema', '__eq__']:
+            attributes[name] = namespace[name]
+        attributes['from_bytes'] = classmethod(namespace['from_bytes'])
+        if 'validate' not in cls.__dict__:
+            attributes['validate'] = namespace['_validate_schema']
+
+        return type(cls)(cls.__name__, cls.__bases__, attributes)
+
+    return decorate
@@ -0,0 +1,213 @@
+"""
+Lazy views of packed messages. A view only holds a memoryview of the packed message and the offsets of its fields.
+Nested messages are decoded when they are accessed for the first time, so a receiver which needs only a few entries
+of a message does not pay for copying and validating all of them.
+
+The views mimic the attributes of the corresponding dataclasses in libMLS.messages, so they can be used in their
+place wherever a message is only read.
+"""
+import struct
+from typing import Optional, List, Callable, Union
+
+from libMLS.message_packer import MP_BYTE_ORDERING, read_vector
+from libMLS.messages import HPKECiphertext, UpdateMessage, GroupOperationType, GroupOperation, ContentType, \
+    MLSPlaintext, MLSCiphertext
+
+_PLAINTEXT_HEADER = struct.Struct(f'{MP_BYTE_ORDERING}IIB')
+_PUBLIC_KEY_SIZE: int = 32
+_CONFIRMATION_SIZE: int = struct.calcsize(f'{MP_BYTE_ORDERING}I')
+# see HPKECiphertext
+_MAX_CIPHER_TEXT_SIZE: int = 2 ** 16 - 1
+
+
+def _read_vector(view: memoryview, offset: int) -> (memoryview, int):
+    """
+    Reads a length prefixed vector, see read_vector
+    :return: the contents of the vector and the offset behind it
+    """
+    try:
+        return read_vector(view, offset)
+    except struct.error as error:
+        raise RuntimeError("Vector exceeds the buffer") from error
+
+
+def _validate_ciphertext(entry: memoryview) -> bool:
+    """
+    Checks a packed HPKECiphertext like HPKECiphertext.from_bytes, but without copying it
+    """
+    if len(entry) < _PUBLIC_KEY_SIZE:
+        return False
+
+    cipher_text, _ = _read_vector(entry, _PUBLIC_KEY_SIZE)
+    return len(cipher_text) <= _MAX_CIPHER_TEXT_SIZE
+
+
+class _VectorListView:
+    """
+    A list of length prefixed entries, see unpack_byte_list. The offsets are determined on first access, each entry
+    is decoded on its first access.
+    """
+
+    def __init__(self, view: memoryview, decode: Callable, validate_entry: Callable[[memoryview], bool]):
+        self._view: memoryview = view
+        self._decode: Callable = decode
+        self._validate_entry: Callable[[memoryview], bool] = validate_entry
+        self._entries: Optional[List[memoryview]] = None
+        self._decoded: dict = {}
+
+    def _get_entries(self) -> List[memoryview]:
+        if self._entries is None:
+            entries: List[memoryview] = []
+            offset = 0
+            while offset < len(self._view):
+                entry, offset = _read_vector(self._view, offset)
+                entries.append(entry)
+            self._entries = entries
+
+        return self._entries
+
+    def __len__(self):
+        return len(self._get_entries())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[entry_index] for entry_index in range(len(self))[index]]
+
+        entries = self._get_entries()
+        if index < 0:
+            index += len(entries)
+
+        if index not in self._decoded:
+            self._decoded[index] = self._decode(entries[index])
+
+        return self._decoded[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def validate(self) -> bool:
+        """
+        Checks all entries without decoding them
+        """
+        try:
+            return all(self._validate_entry(entry) for entry in self._get_entries())
+        except RuntimeError:
+            # an entry or the list itself exceeds its buffer
+            return False
+
+
+class DirectPathNodeView:
+    """
+    See DirectPathNode. Only the ciphertexts which are accessed are decoded, but validate checks all of them.
+    """
+
+    def __init__(self, view: memoryview):
+        if len(view) < _PUBLIC_KEY_SIZE:
+            raise RuntimeError("Buffer is too short for a DirectPathNode")
+
+        self._view: memoryview = view
+        self.encrypted_path_secret: _VectorListView = _VectorListView(
+            _read_vector(view, _PUBLIC_KEY_SIZE)[0],
+            lambda entry: HPKECiphertext.from_bytes(bytes(entry)),
+            _validate_ciphertext)
+
+    @property
+    def public_key(self) -> bytes:
+        return bytes(self._view[:_PUBLIC_KEY_SIZE])
+
+    def validate(self) -> bool:
+        return self.encrypted_path_secret.validate()
+
+
+class UpdateMessageView:
+    """
+    See UpdateMessage. The view accepts the same messages as UpdateMessage.from_bytes once validate was called, which
+    State.process_update does before the update is applied.
+    """
+
+    def __init__(self, view: memoryview):
+        self._view: memoryview = view
+        self.direct_path: _VectorListView = _VectorListView(_read_vector(view, 0)[0], DirectPathNodeView,
+                                                            lambda entry: DirectPathNodeView(entry).validate())
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> 'UpdateMessageView':
+        return cls(memoryview(data))
+
+    def validate(self) -> bool:
+        """
+        Checks the key and ciphertext lengths of all nodes, without decoding the ciphertexts
+        """
+        return self.direct_path.validate()
+
+    def to_message(self) -> UpdateMessage:
+        return UpdateMessage.from_bytes(bytes(self._view))
+
+
+class GroupOperationView:
+    """
+    See GroupOperation. Only UpdateMessages can be read lazily, all other operations are decoded by to_message.
+    """
+
+    def __init__(self, view: memoryview):
+        if not view:
+            raise RuntimeError("Buffer is too short for a GroupOperation")
+
+        self._view: memoryview = view
+        self.msg_type: GroupOperationType = GroupOperationType(view[0])
+        self._operation_view: memoryview = _read_vector(view, 1)[0]
+
+    def get_update(self) -> UpdateMessageView:
+        if self.msg_type != GroupOperationType.UPDATE:
+            raise RuntimeError(f"GroupOperation is of type {self.msg_type}, not an Update")
+
+        return UpdateMessageView(self._operation_view)
+
+    def to_message(self) -> GroupOperation:
+        return GroupOperation.from_bytes(bytes(self._view))
+
+
+class MLSPlaintextView:
+    """
+    See MLSPlaintext. The header fields are read on creation, the content on access.
+    """
+
+    def __init__(self, view: memoryview):
+        self._view: memoryview = view
+        group_id, offset = _read_vector(view, 0)
+        self.group_id: bytes = bytes(group_id)
+
+        if offset + _PLAINTEXT_HEADER.size > len(view):
+            raise RuntimeError("Buffer is too short for an MLSPlaintext")
+
+        self.epoch, self.sender, content_type = _PLAINTEXT_HEADER.unpack_from(view, offset)
+        self.content_type: ContentType = ContentType(content_type)
+        self._content, offset = _read_vector(view, offset + _PLAINTEXT_HEADER.size)
+        self._signature: memoryview = _read_vector(view, offset)[0]
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> 'MLSPlaintextView':
+        return cls(memoryview(data))
+
+    @property
+    def signature(self) -> bytes:
+        return bytes(self._signature)
+
+    def get_group_operation(self) -> GroupOperationView:
+        """
+        :return: the operation of a handshake, see MLSPlaintextHandshake
+        """
+        if self.content_type != ContentType.HANDSHAKE:
+            raise RuntimeError("MLSPlaintext does not contain a handshake")
+
+        # struct { uint32 confirmation; GroupOperation operation; } MLSPlaintextHandshake
+        return GroupOperationView(_read_vector(self._content, _CONFIRMATION_SIZE)[0])
+
+    def to_message(self) -> MLSPlaintext:
+        return MLSPlaintext.from_bytes(bytes(self._view))
+
+    def verify_metadata_from_cipher(self, encrypted: MLSCiphertext) -> bool:
+        return self.group_id == encrypted.group_id and \
+               self.epoch == encrypted.epoch and \
+               self.content_type == encrypted.content_type
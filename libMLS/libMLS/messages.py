@@ -3,13 +3,38 @@ Refer to RFC-8446 https://tools.ietf.org/html/rfc8446#section-3.4
 """
 from dataclasses import dataclass
 from enum import Enum
-from struct import pack
-from typing import Union, List
+from struct import pack, unpack_from, error as StructError
+from typing import Union, List, Optional
 
 from libMLS.abstract_message import AbstractMessage
-from libMLS.message_packer import pack_dynamic, unpack_dynamic, unpack_byte_list
+from libMLS.compact_tree import compact_tree_size, write_compact_tree, unpack_compact_tree, can_pack_compact_tree
+from libMLS.message_schema import message_schema, SchemaMessage, UInt32, Opaque, FixedOpaque, EnumField
+from libMLS.message_packer import MessageWriter, calc_packed_size, unpack_dynamic, unpack_dynamic_from, \
+    iter_byte_list, MP_BYTE_ORDERING, MP_LENGTH_FIELD_SIZE
 from libMLS.tree_node import TreeNode
 
+# ProtocolVersion of draft-07, the tree of a WelcomeInfo is a list of vectors holding either a packed TreeNode or a
+# placeholder for blank nodes
+PROTOCOL_VERSION_DRAFT_07: bytes = b'0'
+# the tree of a WelcomeInfo is packed compactly, see WelcomeInfoMessage
+PROTOCOL_VERSION_COMPACT_TREE: bytes = b'1'
+# ordered by preference
+SUPPORTED_PROTOCOL_VERSIONS: List[bytes] = [PROTOCOL_VERSION_COMPACT_TREE, PROTOCOL_VERSION_DRAFT_07]
+
+
+def negotiate_protocol_version(peer_versions: Optional[List[bytes]]) -> bytes:
+    """
+    Selects the most preferred protocol version which is supported by us and the peer
+    :param peer_versions: the versions supported by the peer, None if the peer did not announce any
+    :return: the selected version, draft-07 if there is no common version
+    """
+    if peer_versions:
+        for version in SUPPORTED_PROTOCOL_VERSIONS:
+            if version in peer_versions:
+                return version
+
+    return PROTOCOL_VERSION_DRAFT_07
+
 
 class ContentType(Enum):
     """
@@ -46,6 +71,8 @@ class GroupOperationType(Enum):
     ADD = 1
     UPDATE = 2
     REMOVE = 3
+    # not part of the RFC, removes several members under a single epoch change
+    BULK_REMOVE = 4
 
 
 class CipherSuiteType(Enum):
@@ -53,6 +80,36 @@ class CipherSuiteType(Enum):
     X25519_SHA256_AES128GCM = 1
 
 
+def _direct_path_size(direct_path: List['DirectPathNode']) -> int:
+    return MP_LENGTH_FIELD_SIZE + sum(MP_LENGTH_FIELD_SIZE + node.packed_size() for node in direct_path)
+
+
+def _write_direct_path(writer: MessageWriter, direct_path: List['DirectPathNode']) -> None:
+    position = writer.begin_vector()
+    for node in direct_path:
+        writer.write_message_vector(node)
+    writer.end_vector(position)
+
+
+def _unpack_direct_path(data: memoryview) -> List['DirectPathNode']:
+    direct_path: List[DirectPathNode] = []
+    for entry in iter_byte_list(data):
+        direct_path.append(DirectPathNode.from_bytes(entry))
+
+    return direct_path
+
+
+def _direct_path_eq(path: List['DirectPathNode'], other_path: List['DirectPathNode']) -> bool:
+    if len(path) != len(other_path):
+        return False
+
+    for index, node in enumerate(path):
+        if node != other_path[index]:
+            return False
+
+    return True
+
+
 class InitMessage(AbstractMessage):
     """
     RFC Section 9.1 Init
@@ -82,8 +139,9 @@ class InitMessage(AbstractMessage):
         pass
 
 
+@message_schema(index=UInt32(), init_key=Opaque(), welcome_info_hash=Opaque(255))
 @dataclass
-class AddMessage(AbstractMessage):
+class AddMessage(SchemaMessage):
     """
     RFC Section 9.2 Add
     https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.2
@@ -113,32 +171,6 @@ class AddMessage(AbstractMessage):
     init_key: bytes
     welcome_info_hash: bytes
 
-    def _pack(self) -> bytes:
-        return pack_dynamic('IVV', self.index, self.init_key, self.welcome_info_hash)
-
-    def validate(self) -> bool:
-        return True
-
-    @classmethod
-    def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('IVV', data)
-        # pylint: disable=unexpected-keyword-arg
-        inst: AddMessage = cls(index=box[0], init_key=box[1], welcome_info_hash=box[2])
-
-        if not inst.validate():
-            raise RuntimeError()
-
-        return inst
-
-    def __eq__(self, other):
-
-        if not isinstance(other, self.__class__):
-            return False
-
-        return self.index == other.index and \
-               self.init_key == other.init_key and \
-               self.welcome_info_hash == other.welcome_info_hash
-
 
 @dataclass
 class DirectPathNode(AbstractMessage):
@@ -172,22 +204,25 @@ class DirectPathNode(AbstractMessage):
     public_key: bytes
     encrypted_path_secret: List['HPKECiphertext']
 
-    def _pack(self) -> bytes:
+    def packed_size(self) -> int:
+        return 32 + MP_LENGTH_FIELD_SIZE + sum(MP_LENGTH_FIELD_SIZE + entry.packed_size()
+                                               for entry in self.encrypted_path_secret)
 
-        path_secret_buffer: bytes = b''
-        for entry in self.encrypted_path_secret:
-            path_secret_buffer += pack_dynamic('V', entry.pack())
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('32s', self.public_key)
 
-        return pack_dynamic('32sV', self.public_key, path_secret_buffer)
+        position = writer.begin_vector()
+        for entry in self.encrypted_path_secret:
+            writer.write_message_vector(entry)
+        writer.end_vector(position)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('32sV', data)
+        box: tuple = unpack_dynamic_from('32sV', data, copy_vectors=False)[0]
 
         public_key: bytes = box[0]
-        encrypted_messages_bytes: List[bytes] = unpack_byte_list(box[1])
         encrypted_messages: List[HPKECiphertext] = []
-        for entry in encrypted_messages_bytes:
+        for entry in iter_byte_list(box[1]):
             encrypted_messages.append(HPKECiphertext.from_bytes(entry))
 
         # pylint: disable=unexpected-keyword-arg
@@ -231,21 +266,16 @@ class UpdateMessage(AbstractMessage):
     """
     direct_path: List[DirectPathNode]
 
-    def _pack(self) -> bytes:
-
-        nodes_buffer: bytes = b''
-        for node in self.direct_path:
-            nodes_buffer += pack_dynamic('V', node.pack())
+    def packed_size(self) -> int:
+        return _direct_path_size(self.direct_path)
 
-        return pack_dynamic('V', nodes_buffer)
+    def _write(self, writer: MessageWriter) -> None:
+        _write_direct_path(writer, self.direct_path)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        node_bytes: List[bytes] = unpack_byte_list(unpack_dynamic('V', data)[0])
-
-        direct_path: List[DirectPathNode] = []
-        for entry in node_bytes:
-            direct_path.append(DirectPathNode.from_bytes(entry))
+        box: tuple = unpack_dynamic_from('V', data, copy_vectors=False)[0]
+        direct_path: List[DirectPathNode] = _unpack_direct_path(box[0])
 
         # pylint: disable=unexpected-keyword-arg
         inst: UpdateMessage = cls(direct_path=direct_path)
@@ -263,13 +293,10 @@ class UpdateMessage(AbstractMessage):
         if not isinstance(other, self.__class__):
             return False
 
-        for index, node in enumerate(self.direct_path):
-            if node != other.direct_path[index]:
-                return False
-
-        return True
+        return _direct_path_eq(self.direct_path, other.direct_path)
 
 
+@dataclass
 class RemoveMessage(AbstractMessage):
     """
     RFC Section 9.4 Remove
@@ -285,16 +312,96 @@ class RemoveMessage(AbstractMessage):
         uint32 removed;
         DirectPath path;
     } Remove;
+
+    This implementation blanks the removed leaf and its direct path before the
+    path is computed, so "path" is the fresh direct path of the sender in the
+    tree without the removed member.
     """
+    removed: int
+    direct_path: List[DirectPathNode]
+
+    def packed_size(self) -> int:
+        return calc_packed_size('I', self.removed) + _direct_path_size(self.direct_path)
+
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('I', self.removed)
+        _write_direct_path(writer, self.direct_path)
+
     def validate(self) -> bool:
-        return False
+        return self.removed >= 0
 
-    def _pack(self) -> bytes:
-        pass
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        box: tuple = unpack_dynamic_from('IV', data, copy_vectors=False)[0]
+
+        # pylint: disable=unexpected-keyword-arg
+        inst: RemoveMessage = cls(removed=box[0], direct_path=_unpack_direct_path(box[1]))
+
+        if not inst.validate():
+            raise RuntimeError()
+
+        return inst
+
+    def __eq__(self, other):
+
+        if not isinstance(other, self.__class__):
+            return False
+
+        return self.removed == other.removed and _direct_path_eq(self.direct_path, other.direct_path)
+
+
+@dataclass
+class BulkRemoveMessage(AbstractMessage):
+    """
+    This message is NOT part of the RFC.
+
+    It removes several members at once: All removed leaves and their direct
+    paths are blanked, after which the sender refreshes its own direct path a
+    single time. Thus, the group only advances one epoch and pays for one path
+    update, regardless of how many members are evicted.
+
+    struct {
+        uint32 removed<0..2^32-1>;
+        DirectPath path;
+    } BulkRemove;
+    """
+    removed: List[int]
+    direct_path: List[DirectPathNode]
+
+    def packed_size(self) -> int:
+        return MP_LENGTH_FIELD_SIZE + calc_packed_size(f'{len(self.removed)}I', *self.removed) + \
+               _direct_path_size(self.direct_path)
+
+    def _write(self, writer: MessageWriter) -> None:
+        position = writer.begin_vector()
+        writer.write(f'{len(self.removed)}I', *self.removed)
+        writer.end_vector(position)
+        _write_direct_path(writer, self.direct_path)
+
+    def validate(self) -> bool:
+        return len(self.removed) > 0 and len(set(self.removed)) == len(self.removed)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        pass
+        box: tuple = unpack_dynamic_from('VV', data, copy_vectors=False)[0]
+        if len(box[0]) % 4 != 0:
+            raise RuntimeError(f"Removed leaves of {len(box[0])} bytes are not a list of uint32")
+        removed: List[int] = list(unpack_dynamic(f'{len(box[0]) // 4}I', box[0]))
+
+        # pylint: disable=unexpected-keyword-arg
+        inst: BulkRemoveMessage = cls(removed=removed, direct_path=_unpack_direct_path(box[1]))
+
+        if not inst.validate():
+            raise RuntimeError()
+
+        return inst
+
+    def __eq__(self, other):
+
+        if not isinstance(other, self.__class__):
+            return False
+
+        return self.removed == other.removed and _direct_path_eq(self.direct_path, other.direct_path)
 
 
 @dataclass
@@ -317,24 +424,28 @@ class GroupOperation(AbstractMessage):
     encrypted form, as MLSCiphertext messages.
     """
     msg_type: GroupOperationType
-    operation: Union[InitMessage, AddMessage, UpdateMessage, RemoveMessage]
+    operation: Union[InitMessage, AddMessage, UpdateMessage, RemoveMessage, BulkRemoveMessage]
 
     def validate(self) -> bool:
         return True
 
-    def _pack(self) -> bytes:
-        return pack_dynamic('BV',
-                            self.msg_type.value,
-                            self.operation.pack()
-                            )
+    def packed_size(self) -> int:
+        return calc_packed_size('B', self.msg_type.value) + MP_LENGTH_FIELD_SIZE + self.operation.packed_size()
+
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('B', self.msg_type.value)
+        writer.write_message_vector(self.operation)
 
     @classmethod
-    def from_instance(cls, group_operation: Union[InitMessage, AddMessage, UpdateMessage, RemoveMessage]):
+    def from_instance(cls, group_operation: Union[InitMessage, AddMessage, UpdateMessage, RemoveMessage,
+                                                  BulkRemoveMessage]):
 
         if isinstance(group_operation, AddMessage):
             op_type = GroupOperationType.ADD
         elif isinstance(group_operation, RemoveMessage):
             op_type = GroupOperationType.REMOVE
+        elif isinstance(group_operation, BulkRemoveMessage):
+            op_type = GroupOperationType.BULK_REMOVE
         elif isinstance(group_operation, UpdateMessage):
             op_type = GroupOperationType.UPDATE
         else:
@@ -345,7 +456,7 @@ class GroupOperation(AbstractMessage):
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('BV', data)
+        box: tuple = unpack_dynamic_from('BV', data, copy_vectors=False)[0]
 
         group_operation_type: GroupOperationType = GroupOperationType(box[0])
 
@@ -356,7 +467,9 @@ class GroupOperation(AbstractMessage):
         elif group_operation_type == GroupOperationType.INIT:
             raise NotImplementedError()
         elif group_operation_type == GroupOperationType.REMOVE:
-            raise NotImplementedError()
+            group_operation = RemoveMessage.from_bytes(data=box[1])
+        elif group_operation_type == GroupOperationType.BULK_REMOVE:
+            group_operation = BulkRemoveMessage.from_bytes(data=box[1])
         else:
             raise ValueError()
 
@@ -384,16 +497,16 @@ class MLSPlaintextHandshake(AbstractMessage):
     def validate(self) -> bool:
         return isinstance(self.group_operation, GroupOperation)
 
-    def _pack(self) -> bytes:
-        return pack_dynamic(
-            'IV',
-            self.confirmation,
-            self.group_operation.pack()
-        )
+    def packed_size(self) -> int:
+        return calc_packed_size('I', self.confirmation) + MP_LENGTH_FIELD_SIZE + self.group_operation.packed_size()
+
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('I', self.confirmation)
+        writer.write_message_vector(self.group_operation)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('IV', data)
+        box: tuple = unpack_dynamic_from('IV', data, copy_vectors=False)[0]
 
         group_op: GroupOperation = GroupOperation.from_bytes(data=box[1])
 
@@ -413,37 +526,15 @@ class MLSPlaintextHandshake(AbstractMessage):
                self.group_operation == other.group_operation
 
 
+@message_schema(application_data=Opaque())
 @dataclass
-class MLSPlaintextApplicationData(AbstractMessage):
+class MLSPlaintextApplicationData(SchemaMessage):
     application_data: bytes
 
-    def validate(self) -> bool:
-        return True
-
-    def _pack(self) -> bytes:
-        return pack_dynamic('V', self.application_data)
-        # return self.application_data
-
-    @classmethod
-    def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('V', data)
-        # pylint: disable=unexpected-keyword-arg
-        inst: MLSPlaintextApplicationData = cls(application_data=box[0])
-
-        if not inst.validate():
-            raise RuntimeError()
-
-        return inst
-
-    def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
-
-        return self.application_data == other.application_data
-
 
+@message_schema(sender=UInt32(), generation=UInt32())
 @dataclass
-class MLSSenderData(AbstractMessage):
+class MLSSenderData(SchemaMessage):
     """
     RFC Section 8.1 Metadata Encryption
     https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-8.1
@@ -466,33 +557,6 @@ class MLSSenderData(AbstractMessage):
     sender: int
     generation: int
 
-    def validate(self) -> bool:
-        return self.sender is not None
-
-    @classmethod
-    def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('II', data)
-        # pylint: disable=unexpected-keyword-arg
-        inst: MLSSenderData = cls(sender=box[0], generation=box[1])
-
-        if not inst.validate():
-            raise RuntimeError()
-
-        return inst
-
-    def _pack(self) -> bytes:
-        return pack_dynamic(
-            'II',
-            self.sender,
-            self.generation
-        )
-
-    def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
-
-        return self.sender == other.sender and self.generation == other.generation
-
 
 @dataclass
 class MLSPlaintext(AbstractMessage):
@@ -541,20 +605,18 @@ class MLSPlaintext(AbstractMessage):
         # return len(self.group_id) <= 256 and len(self.signature) < 2 ** 16
         return True
 
-    def _pack(self) -> bytes:
-        return pack_dynamic(
-            'VIIBVV',
-            self.group_id,
-            self.epoch,
-            self.sender,
-            self.content_type.value,
-            self.content.pack(),
-            self.signature
-        )
+    def packed_size(self) -> int:
+        return calc_packed_size('VIIB', self.group_id, self.epoch, self.sender, self.content_type.value) + \
+               MP_LENGTH_FIELD_SIZE + self.content.packed_size() + calc_packed_size('V', self.signature)
+
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('VIIB', self.group_id, self.epoch, self.sender, self.content_type.value)
+        writer.write_message_vector(self.content)
+        writer.write('V', self.signature)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('VIIBVV', data)
+        box: tuple = unpack_dynamic_from('VIIBVV', data, copy_vectors=False)[0]
 
         content_bytes = box[4]
         content_type = ContentType(box[3])
@@ -566,12 +628,12 @@ class MLSPlaintext(AbstractMessage):
             raise RuntimeError()
 
         # pylint: disable=unexpected-keyword-arg
-        inst: MLSPlaintext = cls(group_id=box[0],
+        inst: MLSPlaintext = cls(group_id=bytes(box[0]),
                                  epoch=box[1],
                                  sender=box[2],
                                  content_type=content_type,
                                  content=content,
-                                 signature=box[5]
+                                 signature=bytes(box[5])
                                  )
 
         if not inst.validate():
@@ -597,7 +659,26 @@ class MLSPlaintext(AbstractMessage):
 
 
 @dataclass
-class MLSCiphertext(AbstractMessage):
+class MLSCiphertextHeader:
+    """
+    The unencrypted prefix of an MLSCiphertext, which is sufficient to route a message to its group and epoch:
+
+    struct {
+       opaque group_id<0..255>;
+       uint32 epoch;
+       ContentType content_type;
+       ...
+   } MLSCiphertext;
+    """
+    group_id: bytes
+    epoch: int
+    content_type: ContentType
+
+
+@message_schema(group_id=Opaque(255), epoch=UInt32(), content_type=EnumField(ContentType),
+                sender_data_nounce=Opaque(255), encrypted_sender_data=Opaque(255), ciphertext=Opaque())
+@dataclass
+class MLSCiphertext(SchemaMessage):
     """
     RFC Section 8 Message Framing
     https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-8
@@ -633,50 +714,37 @@ class MLSCiphertext(AbstractMessage):
     encrypted_sender_data: bytes
     ciphertext: bytes
 
-    def validate(self) -> bool:
-        return True
-
-    def _pack(self) -> bytes:
-        return pack_dynamic('VIBVVV',
-                            self.group_id,
-                            self.epoch,
-                            self.content_type.value,
-                            self.sender_data_nounce,
-                            self.encrypted_sender_data,
-                            self.ciphertext
-                            )
-
     @classmethod
-    def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('VIBVVV', data)
-        # pylint: disable=unexpected-keyword-arg
-        inst: MLSCiphertext = cls(group_id=box[0],
-                                  epoch=box[1],
-                                  content_type=ContentType(box[2]),
-                                  sender_data_nounce=box[3],
-                                  encrypted_sender_data=box[4],
-                                  ciphertext=box[5]
-                                  )
-
-        if not inst.validate():
-            raise RuntimeError()
-
-        return inst
+    def peek_header(cls, buffer: bytes) -> MLSCiphertextHeader:
+        """
+        Reads group_id, epoch and content_type of a packed MLSCiphertext without copying or parsing the rest of the
+        message
+        :param buffer: a packed MLSCiphertext
+        :return: the header of the message
+        :raises RuntimeError: if the buffer does not start with a valid header
+        """
+        view = memoryview(buffer)
+        try:
+            group_id_len: int = unpack_from(f'{MP_BYTE_ORDERING}L', view, 0)[0]
+            offset = MP_LENGTH_FIELD_SIZE + group_id_len
+
+            if offset > len(view):
+                raise RuntimeError("Buffer is too short for the given group_id")
+
+            epoch, content_type = unpack_from(f'{MP_BYTE_ORDERING}IB', view, offset)
+            content_type = ContentType(content_type)
+        except (StructError, ValueError) as error:
+            raise RuntimeError("Buffer does not start with a valid MLSCiphertext header") from error
 
-    def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
-
-        return self.group_id == other.group_id and \
-               self.epoch == other.epoch and \
-               self.content_type == other.content_type and \
-               self.sender_data_nounce == other.sender_data_nounce and \
-               self.encrypted_sender_data == other.encrypted_sender_data and \
-               self.ciphertext == other.ciphertext
+        # pylint: disable=unexpected-keyword-arg
+        return MLSCiphertextHeader(group_id=bytes(view[MP_LENGTH_FIELD_SIZE:offset]),
+                                   epoch=epoch,
+                                   content_type=content_type)
 
 
+@message_schema(ephemeral_key=FixedOpaque(32), cipher_text=Opaque(2 ** 16 - 1))
 @dataclass
-class HPKECiphertext(AbstractMessage):
+class HPKECiphertext(SchemaMessage):
     """
     RFC Section 6.5 Direct Paths
     https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-6.5
@@ -702,30 +770,6 @@ class HPKECiphertext(AbstractMessage):
     ephemeral_key: bytes
     cipher_text: bytes
 
-    def _pack(self) -> bytes:
-        return pack_dynamic('32sV', self.ephemeral_key, self.cipher_text)
-
-    def validate(self) -> bool:
-        return True
-
-    @classmethod
-    def from_bytes(cls, data: bytes):
-        box: tuple = unpack_dynamic('32sV', data)
-        # pylint: disable=unexpected-keyword-arg
-        inst: HPKECiphertext = cls(ephemeral_key=box[0], cipher_text=box[1])
-
-        if not inst.validate():
-            raise RuntimeError()
-
-        return inst
-
-    def __eq__(self, other):
-
-        if not isinstance(other, self.__class__):
-            return False
-
-        return self.ephemeral_key == other.ephemeral_key and self.cipher_text == other.cipher_text
-
 
 @dataclass
 # pylint: disable=too-many-instance-attributes
@@ -773,6 +817,9 @@ class WelcomeInfoMessage(AbstractMessage):
     key: bytes
     nounce: bytes
 
+    # placeholder for blank nodes in the packed tree
+    BLANK_NODE = b"NOTHING"
+
     def __eq__(self, other):
 
         if not isinstance(other, self.__class__):
@@ -794,60 +841,76 @@ class WelcomeInfoMessage(AbstractMessage):
         # todo Pack and unpack test
         return nodes_equal
 
-    def _pack(self) -> bytes:
-        return pack_dynamic(
-            'VVIVVVVV',
-            self.protocol_version,
-            self.group_id,
-            self.epoch,
-            self._packed_nodes(),
-            self.interim_transcript_hash,
-            self.init_secret,
-            self.key,
-            self.nounce
-        )
+    def has_compact_tree(self) -> bool:
+        """
+        With PROTOCOL_VERSION_COMPACT_TREE, the tree is packed without blank nodes and empty vectors, see
+        libMLS.compact_tree
+        """
+        return self.protocol_version == PROTOCOL_VERSION_COMPACT_TREE
+
+    def _tree_size(self) -> int:
+        if self.has_compact_tree():
+            return compact_tree_size(self.tree)
 
-    def _packed_nodes(self) -> bytes:
-        # packed_list: List[bytes] = []
-        packed_list: bytes = b''
+        nodes_size = 0
         for node in self.tree:
+            nodes_size += MP_LENGTH_FIELD_SIZE + (len(self.BLANK_NODE) if node is None else node.packed_size())
+        return nodes_size
 
-            if node is None:
-                packed_list += pack_dynamic('V', b"NOTHING")
-            else:
-                packed_list += pack_dynamic('V', node.pack())
+    def packed_size(self) -> int:
+        return calc_packed_size('VVI', self.protocol_version, self.group_id, self.epoch) + \
+               MP_LENGTH_FIELD_SIZE + self._tree_size() + \
+               calc_packed_size('VVVV', self.interim_transcript_hash, self.init_secret, self.key, self.nounce)
 
-        return packed_list
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('VVI', self.protocol_version, self.group_id, self.epoch)
+
+        position = writer.begin_vector()
+        if self.has_compact_tree():
+            write_compact_tree(writer, self.tree)
+        else:
+            for node in self.tree:
+                if node is None:
+                    writer.write('V', self.BLANK_NODE)
+                else:
+                    writer.write_message_vector(node)
+        writer.end_vector(position)
+
+        writer.write('VVVV', self.interim_transcript_hash, self.init_secret, self.key, self.nounce)
 
     def validate(self) -> bool:
         # todo: write auto validate for fmt string and dump this validation func
-        return True
+        return not self.has_compact_tree() or can_pack_compact_tree(self.tree)
 
     @classmethod
     def from_bytes(cls, data: bytes):
-        box = unpack_dynamic('VVIVVVVV', data)
+        box = unpack_dynamic_from('VVIVVVVV', data, copy_vectors=False)[0]
+        protocol_version = bytes(box[0])
+        nodes: List[Optional[TreeNode]] = []
 
-        raw_nodes: List[bytes] = unpack_byte_list(box[3])
-        nodes: List[TreeNode] = []
+        if protocol_version == PROTOCOL_VERSION_COMPACT_TREE:
+            nodes = unpack_compact_tree(box[3])
+        else:
+            raw_nodes: List[memoryview] = list(iter_byte_list(box[3]))
 
-        # if there are no nodes in the tree, the raw_nodes list contains just one empty entry
-        if raw_nodes != [] and raw_nodes[0] != b'':
-            for raw_node in raw_nodes:
+            # if there are no nodes in the tree, the raw_nodes list contains just one empty entry
+            if raw_nodes and raw_nodes[0] != b'':
+                for raw_node in raw_nodes:
 
-                if raw_node == b"NOTHING":
-                    nodes.append(None)
-                else:
-                    nodes.append(TreeNode.from_bytes(raw_node))
+                    if raw_node == cls.BLANK_NODE:
+                        nodes.append(None)
+                    else:
+                        nodes.append(TreeNode.from_bytes(raw_node))
 
         # pylint: disable=unexpected-keyword-arg
-        inst = cls(protocol_version=box[0],
-                   group_id=box[1],
+        inst = cls(protocol_version=protocol_version,
+                   group_id=bytes(box[1]),
                    epoch=box[2],
                    tree=nodes,
-                   interim_transcript_hash=box[4],
-                   init_secret=box[5],
-                   key=box[6],
-                   nounce=box[7])
+                   interim_transcript_hash=bytes(box[4]),
+                   init_secret=bytes(box[5]),
+                   key=bytes(box[6]),
+                   nounce=bytes(box[7]))
 
         if not inst.validate():
             raise RuntimeError()
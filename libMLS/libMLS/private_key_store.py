@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class PrivateKeyStore:
+    """
+    The private keys of the init keys a user has published, keyed by their public key. This store keeps them in
+    memory, so they are lost on restart, see SQLitePrivateKeyStore.
+    """
+
+    def __init__(self):
+        self._keys: Dict[bytes, bytes] = {}
+
+    def add_keypairs(self, key_pairs: List[Tuple[bytes, bytes]]) -> None:
+        """
+        :param key_pairs: public and private key of each init key
+        """
+        self._keys.update(key_pairs)
+
+    def get_private_key(self, public_key: bytes) -> Optional[bytes]:
+        return self._keys.get(public_key)
+
+    def delete_keys(self, public_keys: List[bytes]) -> None:
+        for public_key in public_keys:
+            self._keys.pop(public_key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLitePrivateKeyStore(PrivateKeyStore):
+    """
+    Keeps the private keys in an SQLite database, so the init keys at the dirserver stay usable after a restart. The
+    keys are looked up through the primary key index and never loaded as a whole, so opening the store takes the same
+    time for any number of keys. The database is only readable by its owner, as it holds the private keys in clear.
+    """
+
+    # pylint: disable=super-init-not-called
+    # the keys are kept in the database, the dict of PrivateKeyStore would stay unused
+    def __init__(self, path: str):
+        self._path: str = path
+        # the store is shared with the threads which upload new init keys
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            # create the file with its final mode, so the keys are never readable by others in between
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS private_keys ('
+                                     'public_key BLOB PRIMARY KEY, private_key BLOB NOT NULL) WITHOUT ROWID')
+
+    def add_keypairs(self, key_pairs: List[Tuple[bytes, bytes]]) -> None:
+        # one transaction for the whole batch
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO private_keys VALUES (?, ?)', key_pairs)
+
+    def get_private_key(self, public_key: bytes) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection.execute('SELECT private_key FROM private_keys WHERE public_key = ?',
+                                           (public_key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete_keys(self, public_keys: List[bytes]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM private_keys WHERE public_key = ?',
+                                         [(public_key,) for public_key in public_keys])
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM private_keys').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
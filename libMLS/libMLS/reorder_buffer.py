@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+from libMLS.messages import MLSCiphertext
+
+DEFAULT_MAX_MESSAGES: int = 256
+DEFAULT_MAX_BYTES: int = 1024 * 1024
+
+
+@dataclass
+class ReorderBufferMetrics:
+    # number of messages currently held back
+    depth: int
+    # bytes currently held back
+    size: int
+    # highest depth since the creation of the buffer
+    max_depth: int
+    num_released: int
+    num_rejected: int
+
+
+class ReorderBuffer:
+    """
+    Holds back messages which arrive before the handshake message that creates their epoch. The buffer is keyed by
+    the epoch a group has to reach before a message can be processed and is bounded by the number of messages as well
+    as by their size.
+    """
+
+    def __init__(self, max_messages: int = DEFAULT_MAX_MESSAGES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._max_messages: int = max_messages
+        self._max_bytes: int = max_bytes
+        self._messages: Dict[int, List[MLSCiphertext]] = {}
+        self._depth: int = 0
+        self._size: int = 0
+        self._max_depth: int = 0
+        self._num_released: int = 0
+        self._num_rejected: int = 0
+
+    @staticmethod
+    def get_message_size(message: MLSCiphertext) -> int:
+        # the fixed fields and length prefixes are negligible for the bound
+        return len(message.group_id) + len(message.sender_data_nounce) + len(message.encrypted_sender_data) + \
+               len(message.ciphertext)
+
+    def push(self, message: MLSCiphertext, required_epoch: int) -> None:
+        """
+        Holds back a message until its epoch is released
+        :param message: the message
+        :param required_epoch: the epoch the group has to reach before the message can be processed
+        :raises RuntimeError: if the buffer is full
+        """
+        size = self.get_message_size(message)
+
+        if self._depth + 1 > self._max_messages or self._size + size > self._max_bytes:
+            self._num_rejected += 1
+            raise RuntimeError(f"Reorder buffer is full, cannot hold back message of epoch {message.epoch}")
+
+        self._messages.setdefault(required_epoch, []).append(message)
+        self._depth += 1
+        self._size += size
+        self._max_depth = max(self._max_depth, self._depth)
+
+    def release(self, current_epoch: int) -> List[MLSCiphertext]:
+        """
+        Removes all messages which can be processed in the given epoch
+        :param current_epoch: the current epoch of the group
+        :return: the released messages, ordered by epoch and arrival
+        """
+        released: List[MLSCiphertext] = []
+
+        for epoch in sorted(self._messages.keys()):
+            if epoch > current_epoch:
+                break
+            released.extend(self._messages.pop(epoch))
+
+        self._depth -= len(released)
+        self._size -= sum(self.get_message_size(message) for message in released)
+        self._num_released += len(released)
+        return released
+
+    def get_depth(self) -> int:
+        return self._depth
+
+    def get_metrics(self) -> ReorderBufferMetrics:
+        # pylint: disable=unexpected-keyword-arg
+        return ReorderBufferMetrics(depth=self._depth,
+                                    size=self._size,
+                                    max_depth=self._max_depth,
+                                    num_released=self._num_released,
+                                    num_rejected=self._num_rejected)
+
+    def __len__(self):
+        return self._depth
@@ -1,14 +1,40 @@
 import string
-from typing import Optional
+import struct
+from dataclasses import dataclass, field
+from typing import Optional, List, Iterable, Union, Generator
 
-from libMLS.abstract_application_handler import AbstractApplicationHandler
+from libMLS.abstract_application_handler import AbstractApplicationHandler, DeferringHandler
 from libMLS.abstract_keystore import AbstractKeystore
+from libMLS.compression import PayloadCompressor
 from libMLS.group_context import GroupContext
+from libMLS.message_packer import DynamicPackingException
 from libMLS.messages import WelcomeInfoMessage, AddMessage, UpdateMessage, MLSCiphertext, ContentType, \
-    MLSSenderData, MLSPlaintext, MLSPlaintextApplicationData, MLSPlaintextHandshake, GroupOperation
+    MLSSenderData, MLSPlaintext, MLSPlaintextApplicationData, MLSPlaintextHandshake, GroupOperation, RemoveMessage, \
+    BulkRemoveMessage, MLSCiphertextHeader, GroupOperationType, negotiate_protocol_version
+from libMLS.message_views import MLSPlaintextView, GroupOperationView, UpdateMessageView
+from libMLS.reorder_buffer import ReorderBuffer
 from libMLS.state import State
 from libMLS.x25519_cipher_suite import X25519CipherSuite
 
+# errors of received messages which are malformed or do not fit the state of the group
+MESSAGE_ERRORS = (RuntimeError, ValueError, IndexError, struct.error, DynamicPackingException)
+
+
+@dataclass
+class ProcessingResult:
+    """
+    The outcome of a single message of a batch, see Session.process_messages. The header is None if not even the
+    header of the message could be read. The held-back messages which a handshake released are reported separately,
+    their errors do not affect the result of the handshake.
+    """
+    header: Optional[MLSCiphertextHeader]
+    error: Optional[Exception] = None
+    released: List['ProcessingResult'] = field(default_factory=list)
+
+    @property
+    def processed(self) -> bool:
+        return self.error is None
+
 
 class Session:
 
@@ -17,6 +43,8 @@ class Session:
         self._key_store = key_store
         self._user_name = user_name
         self._user_index: Optional[int] = user_index
+        self._reorder_buffer: ReorderBuffer = ReorderBuffer()
+        self._compressor: Optional[PayloadCompressor] = None
 
     @classmethod
     def from_welcome(cls, welcome: WelcomeInfoMessage, key_store: AbstractKeystore, user_name: string) -> 'Session':
@@ -32,6 +60,24 @@ class Session:
         state.get_key_schedule().set_init_secret(welcome.init_secret)
         return cls(state, key_store, user_name, user_index=None)
 
+    @classmethod
+    def from_packed_welcome(cls, data: bytes, key_store: AbstractKeystore, user_name: string,
+                            compressor: Optional[PayloadCompressor] = None) -> 'Session':
+        """
+        Creates a session from a welcome packed by pack_welcome. The session uses the given compressor for its
+        application messages as well.
+        :param data: the packed welcome
+        :param key_store: see from_welcome
+        :param user_name: see from_welcome
+        :param compressor: the compressor of the group, None if the group does not compress
+        """
+        if compressor is not None:
+            data = compressor.decompress(data)
+
+        session = cls.from_welcome(WelcomeInfoMessage.from_bytes(data), key_store, user_name)
+        session.set_compressor(compressor)
+        return session
+
     # todo: Use user_credentials
     @classmethod
     def from_empty(cls, key_store: AbstractKeystore, user_name: string, group_name: string) -> 'Session':
@@ -48,14 +94,39 @@ class Session:
             cipher_suite=X25519CipherSuite(),
             context=empty_context,
             leaf_public=public_key,
-            leaf_secret=key_store.get_private_key(public_key))
+            leaf_secret=key_store.consume_private_key(public_key))
 
         return cls(state, key_store, user_name, user_index=0)
 
     def get_state(self) -> State:
         return self._state
 
-    def add_member(self, user_name: string, user_credentials: bytes) -> (WelcomeInfoMessage, AddMessage):
+    def get_reorder_buffer(self) -> ReorderBuffer:
+        return self._reorder_buffer
+
+    def set_compressor(self, compressor: Optional[PayloadCompressor]) -> None:
+        """
+        Enables the compression of application data before its encryption. As the codec tag is part of the
+        application data, all members of a group have to either use a compressor or none.
+        :param compressor: the compressor, None to disable compression
+        """
+        self._compressor = compressor
+
+    def get_compressor(self) -> Optional[PayloadCompressor]:
+        return self._compressor
+
+    def pack_welcome(self, welcome: WelcomeInfoMessage) -> bytes:
+        """
+        Packs a welcome created by add_member, which is compressed if this session uses a compressor. Welcomes of
+        large groups consist mostly of the tree, see from_packed_welcome.
+        """
+        if self._compressor is None:
+            return welcome.pack()
+
+        return self._compressor.compress(welcome.pack())
+
+    def add_member(self, user_name: string, user_credentials: bytes,
+                   supported_versions: Optional[List[bytes]] = None) -> (WelcomeInfoMessage, AddMessage):
         """
         From draft-ietf-mls-protocol-07:
         In order to add a new member to the group, an existing member of the
@@ -64,6 +135,7 @@ class Session:
         2.  Send an Add message to the group (including the new member)
         :param user_credentials:
         :param user_name:
+        :param supported_versions: the protocol versions supported by the new member, see negotiate_protocol_version
         :return:
         """
 
@@ -73,7 +145,7 @@ class Session:
             raise RuntimeError()
 
         # todo: Verify Keys and Cipher Suite support
-        return self._state.add(user_init_key, user_credentials)
+        return self._state.add(user_init_key, user_credentials, negotiate_protocol_version(supported_versions))
 
         # todo: encrypt welcome message
         # todo: encrypt add message
@@ -119,7 +191,7 @@ class Session:
         :return:
         """
 
-        private_key = self._key_store.get_private_key(add_message.init_key)
+        private_key = self._key_store.consume_private_key(add_message.init_key)
 
         if private_key is not None:
             # we possess the private key for this given init_key
@@ -149,7 +221,17 @@ class Session:
 
         return self._state.update(self._user_index)
 
-    def process_update(self, leaf_index: int, update_message: UpdateMessage) -> None:
+    def precompute_update(self) -> None:
+        """
+        Speculatively computes the next UpdateMessage in the background, so a following call to update() returns
+        immediately. The precomputed update is discarded if a handshake message is processed in the meantime.
+        """
+        if self._user_index is None:
+            raise RuntimeError("User index is None, cannot precompute an update")
+
+        self._state.precompute_update(self._user_index)
+
+    def process_update(self, leaf_index: int, update_message: Union[UpdateMessage, UpdateMessageView]) -> None:
         """
         RFC Section 9.3 Update
         https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.3
@@ -166,6 +248,61 @@ class Session:
         """
         self._state.process_update(leaf_index=leaf_index, message=update_message)
 
+    def remove_member(self, leaf_index: int) -> RemoveMessage:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        A Remove message is sent by a group member to remove one or more
+        other members from the group.  A member MUST NOT use a Remove message
+        to remove themselves from the group.
+
+        Like update(), this applies the removal to the local state immediately.
+
+        :param leaf_index: the leaf of the member to remove
+        :return: the RemoveMessage
+        """
+        if self._user_index is None:
+            raise RuntimeError("User index is None, cannot remove a member")
+
+        return self._state.remove(self._user_index, leaf_index)
+
+    def remove_members(self, leaf_indices: List[int]) -> BulkRemoveMessage:
+        """
+        Removes all given members under a single epoch change and a single path refresh. This is a lot cheaper than
+        sending one RemoveMessage per member, e.g. when evicting idle members.
+
+        :param leaf_indices: the leaves of the members to remove
+        :return: the BulkRemoveMessage
+        """
+        if self._user_index is None:
+            raise RuntimeError("User index is None, cannot remove members")
+
+        return self._state.bulk_remove(self._user_index, leaf_indices)
+
+    def process_remove(self, leaf_index: int, remove_message: RemoveMessage) -> None:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        :param leaf_index: the leaf of the sender
+        :param remove_message: the RemoveMessage
+        """
+        self._state.process_remove(leaf_index=leaf_index, message=remove_message)
+
+    def process_bulk_remove(self, leaf_index: int, remove_message: BulkRemoveMessage) -> None:
+        """
+        :param leaf_index: the leaf of the sender
+        :param remove_message: the BulkRemoveMessage
+        """
+        self._state.process_bulk_remove(leaf_index=leaf_index, message=remove_message)
+
+    def is_member(self) -> bool:
+        """
+        :return: False if this member was removed from the group or does not know its own leaf yet
+        """
+        return self._user_index is not None
+
     def encrypt_application_message(self, message: bytes) -> MLSCiphertext:
         """
         RFC Section 11.1 Tree of Application Secrets
@@ -193,7 +330,8 @@ class Session:
             content_type=ContentType.APPLICATION,
             sender=self._user_index,
             signature=b'0',
-            content=MLSPlaintextApplicationData(application_data=message)
+            content=MLSPlaintextApplicationData(
+                application_data=message if self._compressor is None else self._compressor.compress(message))
         )
 
         # pylint: disable=unexpected-keyword-arg
@@ -287,30 +425,54 @@ class Session:
         :param handler: handler for processing
         """
         # todo: Usually, this would have to be decrypted right here
-        plain = MLSPlaintext.from_bytes(message.ciphertext)
+        # The plaintext is read lazily, so only the parts of an update which are addressed to us are decoded
+        plain = MLSPlaintextView.from_bytes(message.ciphertext)
 
         if not plain.verify_metadata_from_cipher(message):
             raise RuntimeError()
 
-        if not isinstance(plain.content, MLSPlaintextHandshake):
+        if plain.content_type != ContentType.HANDSHAKE:
             raise RuntimeError()
 
         # todo: We most certainly have to perform more checks here
-        operation: GroupOperation = plain.content.group_operation
+        operation_view: GroupOperationView = plain.get_group_operation()
 
-        if isinstance(operation.operation, AddMessage):
-            self.process_add(operation.operation)
-            handler.on_group_member_added(plain.group_id)
-        elif isinstance(operation.operation, UpdateMessage):
+        if operation_view.msg_type == GroupOperationType.UPDATE:
             # As this method is NOT resequencing safe, we must not execute our own update.
             # See https://git.fh-muenster.de/masterprojekt-mls/implementation/issues/8
             if plain.sender != self._user_index:
-                self.process_update(leaf_index=plain.sender, update_message=operation.operation)
+                self.process_update(leaf_index=plain.sender, update_message=operation_view.get_update())
             handler.on_keys_updated(plain.group_id)
+            return
+
+        operation: GroupOperation = operation_view.to_message()
+
+        if isinstance(operation.operation, AddMessage):
+            self.process_add(operation.operation)
+            handler.on_group_member_added(plain.group_id)
+        elif isinstance(operation.operation, (RemoveMessage, BulkRemoveMessage)):
+            self._process_removal(plain.sender, operation.operation)
+            handler.on_group_member_removed(plain.group_id)
         else:
             raise RuntimeError()
 
-    # pylint: disable=no-self-use
+    def _process_removal(self, sender: int, operation) -> None:
+        removed = [operation.removed] if isinstance(operation, RemoveMessage) else operation.removed
+
+        if self._user_index in removed:
+            # we cannot decrypt the new path secrets and are not part of the group anymore
+            self._user_index = None
+            return
+
+        # Removals are applied by the sender immediately, see update()
+        if sender == self._user_index:
+            return
+
+        if isinstance(operation, RemoveMessage):
+            self.process_remove(leaf_index=sender, remove_message=operation)
+        else:
+            self.process_bulk_remove(leaf_index=sender, remove_message=operation)
+
     def _process_application(self, message: MLSCiphertext, handler: AbstractApplicationHandler) -> None:
         """
         RFC Section 11 Application Messages
@@ -344,10 +506,19 @@ class Session:
         signatures are required.  Handshake messages MUST use asymmetric
         signatures to strongly authenticate the sender of a message.
 
+        Application messages are routed by the epoch in their header. Messages of past epochs can still be processed
+        as long as the epoch is part of the epoch history of the state.
+
         :param message: the ApplicationMessage
         :param handler: handler for Application Message
         """
-        # todo: Usually, this would have to be decrypted right here
+        epoch_secrets = self._state.get_epoch_secrets(message.epoch)
+        if epoch_secrets is None and message.epoch != self._state.get_group_context().epoch:
+            raise RuntimeError(f"Secrets for epoch {message.epoch} are not available "
+                               f"(current epoch is {self._state.get_group_context().epoch})")
+
+        # todo: Usually, this would have to be decrypted right here using the secrets of the message's epoch
+        sender_data = MLSSenderData.from_bytes(message.encrypted_sender_data)
         plain = MLSPlaintext.from_bytes(message.ciphertext)
 
         if not plain.verify_metadata_from_cipher(message):
@@ -356,15 +527,66 @@ class Session:
         if not isinstance(plain.content, MLSPlaintextApplicationData):
             raise RuntimeError()
 
-        handler.on_application_message(plain.content.application_data, plain.group_id.decode('ASCII'))
+        if epoch_secrets is not None:
+            self._state.get_epoch_history().record_generation(message.epoch, sender_data.sender,
+                                                              sender_data.generation)
+
+        application_data = plain.content.application_data
+        if self._compressor is not None:
+            application_data = self._compressor.decompress(application_data)
+
+        handler.on_application_message(application_data, plain.group_id.decode('ASCII'))
 
-    # pylint: disable=no-self-use
-    def process_message(self, message: MLSCiphertext, handler: AbstractApplicationHandler) -> None:
+    def process_message(self, message: MLSCiphertext, handler: AbstractApplicationHandler) -> List[ProcessingResult]:
         """
-        Determines if a message is of type Handshake or type Application
+        Determines if a message is of type Handshake or type Application. Application messages are processed with the
+        secrets of the epoch given in their header, so they may arrive after the handshake which ended their epoch.
+
+        Messages which arrive before the handshake that creates their epoch are held back in the reorder buffer and
+        are processed with the given handler as soon as the group reaches their epoch.
         :param message: the message to determine the type
         :param handler: Handler for the message
+        :return: the results of the held-back messages which were processed after the message
+        """
+        required_epoch = self._get_required_epoch(message)
+        if required_epoch > self._state.get_group_context().epoch:
+            self._reorder_buffer.push(message, required_epoch)
+            return []
+
+        self._dispatch_message(message, handler)
+
+        if message.content_type != ContentType.HANDSHAKE:
+            return []
+
+        return self._process_released(handler)
+
+    def _process_released(self, handler: AbstractApplicationHandler) -> List[ProcessingResult]:
         """
+        Processes the held-back messages of the epochs the group has reached. The messages were already taken from
+        the reorder buffer, so a failing message is reported in its result instead of losing the others.
+        """
+        results: List[ProcessingResult] = []
+
+        released = self._reorder_buffer.release(self._state.get_group_context().epoch)
+        while released:
+            for early_message in released:
+                # pylint: disable=unexpected-keyword-arg
+                header = MLSCiphertextHeader(group_id=early_message.group_id, epoch=early_message.epoch,
+                                             content_type=early_message.content_type)
+                try:
+                    self._dispatch_message(early_message, handler)
+                except MESSAGE_ERRORS as error:
+                    # pylint: disable=unexpected-keyword-arg
+                    results.append(ProcessingResult(header=header, error=error))
+                    continue
+
+                # pylint: disable=unexpected-keyword-arg
+                results.append(ProcessingResult(header=header))
+            released = self._reorder_buffer.release(self._state.get_group_context().epoch)
+
+        return results
+
+    def _dispatch_message(self, message: MLSCiphertext, handler: AbstractApplicationHandler) -> None:
         if message.content_type == ContentType.APPLICATION:
             self._process_application(message=message, handler=handler)
         elif message.content_type == ContentType.HANDSHAKE:
@@ -372,6 +594,99 @@ class Session:
         else:
             raise RuntimeError()
 
+    def _get_required_epoch(self, message: MLSCiphertext) -> int:
+        """
+        Determines the epoch the group has to be in before the message can be processed. Application messages
+        belong to the epoch in their header. Handshake messages carry the epoch their sender has already advanced to,
+        except for Add messages, which are sent before the epoch is advanced.
+        :param message: the message
+        :return: the required epoch
+        """
+        if message.content_type != ContentType.HANDSHAKE or message.epoch <= self._state.get_group_context().epoch:
+            return message.epoch
+
+        # todo: Usually, this would have to be decrypted right here
+        plain = MLSPlaintextView.from_bytes(message.ciphertext)
+        if plain.content_type == ContentType.HANDSHAKE and \
+                plain.get_group_operation().msg_type == GroupOperationType.ADD:
+            return message.epoch
+
+        return message.epoch - 1
+
+    def process_messages(self, messages: Iterable[Union[bytes, MLSCiphertext]],
+                         handler: AbstractApplicationHandler) -> Generator[ProcessingResult, None, None]:
+        """
+        Processes a backlog of messages of this group in a single pass and yields one result per message.
+
+        Handshake messages are stable-sorted by epoch ahead of the application messages of the same epoch, which
+        depend on them. Packed messages are only parsed when they are processed, their order is determined by their
+        headers. Malformed, failing or stale messages do not abort the batch, their error is part of the result.
+        Messages whose header can not be read are reported first.
+
+        All handler notifications are deferred and delivered with a single call to handler.on_batch_processed once
+        the generator is exhausted or closed.
+        :param messages: packed or parsed MLSCiphertexts of this group
+        :param handler: handler for the messages
+        """
+        batch = []
+        malformed: List[ProcessingResult] = []
+        for message in messages:
+            try:
+                if isinstance(message, MLSCiphertext):
+                    # pylint: disable=unexpected-keyword-arg
+                    header = MLSCiphertextHeader(group_id=message.group_id, epoch=message.epoch,
+                                                 content_type=message.content_type)
+                else:
+                    header = MLSCiphertext.peek_header(message)
+            except MESSAGE_ERRORS as error:
+                # pylint: disable=unexpected-keyword-arg
+                malformed.append(ProcessingResult(header=None, error=error))
+                continue
+            batch.append((header, message))
+
+        batch.sort(key=lambda entry: (entry[0].epoch, entry[0].content_type != ContentType.HANDSHAKE))
+
+        deferred = DeferringHandler()
+        try:
+            yield from malformed
+
+            for header, message in batch:
+                if self.is_stale(header):
+                    # pylint: disable=unexpected-keyword-arg
+                    yield ProcessingResult(header=header, error=RuntimeError(f"Message of epoch {header.epoch} "
+                                                                             f"is stale"))
+                    continue
+
+                try:
+                    if not isinstance(message, MLSCiphertext):
+                        message = MLSCiphertext.from_bytes(message)
+                    released = self.process_message(message, deferred)
+                except MESSAGE_ERRORS as error:
+                    # pylint: disable=unexpected-keyword-arg
+                    yield ProcessingResult(header=header, error=error)
+                    continue
+
+                # pylint: disable=unexpected-keyword-arg
+                yield ProcessingResult(header=header, released=released)
+        finally:
+            if deferred.events:
+                handler.on_batch_processed(self._state.get_group_context().group_id, deferred.events)
+
+    def is_stale(self, header: MLSCiphertextHeader) -> bool:
+        """
+        Checks whether a message can be dropped without parsing it. This is the case for handshake messages of past
+        epochs and for application messages of epochs which are not part of the epoch history anymore.
+        :param header: the header of the message, see MLSCiphertext.peek_header
+        :return: True if the message can not be processed
+        """
+        if header.epoch >= self._state.get_group_context().epoch:
+            return False
+
+        if header.content_type == ContentType.APPLICATION:
+            return self._state.get_epoch_secrets(header.epoch) is None
+
+        return True
+
     @staticmethod
     def get_groupid_from_cipher(data: bytes) -> bytes:
-        return MLSCiphertext.from_bytes(data).group_id
+        return MLSCiphertext.peek_header(data).group_id
@@ -0,0 +1,88 @@
+from typing import Dict, Optional, Iterable, Generator, List
+
+from libMLS.abstract_application_handler import AbstractApplicationHandler
+from libMLS.messages import MLSCiphertext, MLSCiphertextHeader
+from libMLS.session import Session, ProcessingResult, MESSAGE_ERRORS
+
+
+class SessionManager:
+    """
+    Routes packed MLSCiphertexts to the Session of their group. Only the header of a message is read for routing,
+    messages of unknown groups and stale epochs are dropped before the rest of the message is parsed.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[bytes, Session] = {}
+        self._num_dropped: int = 0
+
+    def add_session(self, session: Session) -> None:
+        self._sessions[session.get_state().get_group_context().group_id] = session
+
+    def remove_session(self, group_id: bytes) -> None:
+        self._sessions.pop(group_id, None)
+
+    def get_session(self, group_id: bytes) -> Optional[Session]:
+        return self._sessions.get(group_id)
+
+    def get_num_dropped(self) -> int:
+        return self._num_dropped
+
+    def process_message(self, data: bytes, handler: AbstractApplicationHandler) -> Optional[MLSCiphertextHeader]:
+        """
+        Processes a packed MLSCiphertext with the session of its group
+        :param data: the packed message
+        :param handler: handler for the message
+        :return: the header of the processed message or None if the message was dropped
+        """
+        header: MLSCiphertextHeader = MLSCiphertext.peek_header(data)
+        session = self._sessions.get(header.group_id)
+
+        if session is None or session.is_stale(header):
+            self._num_dropped += 1
+            return None
+
+        session.process_message(MLSCiphertext.from_bytes(data), handler)
+        return header
+
+    def process_messages(self, messages: Iterable[bytes],
+                         handler: AbstractApplicationHandler) -> Generator[ProcessingResult, None, None]:
+        """
+        Processes packed MLSCiphertexts of any groups, each group as one batch with Session.process_messages, in
+        the order the groups first appear. Messages which can not be routed, as their header is malformed or their
+        group is unknown, and stale messages are dropped and reported first.
+        :param messages: the packed messages
+        :param handler: handler for the messages
+        :return: one result per message
+        """
+        batches: Dict[bytes, List[bytes]] = {}
+        dropped: List[ProcessingResult] = []
+        for data in messages:
+            try:
+                header: MLSCiphertextHeader = MLSCiphertext.peek_header(data)
+            except MESSAGE_ERRORS as error:
+                # pylint: disable=unexpected-keyword-arg
+                dropped.append(ProcessingResult(header=None, error=error))
+                continue
+
+            session = self._sessions.get(header.group_id)
+            if session is None:
+                # pylint: disable=unexpected-keyword-arg
+                dropped.append(ProcessingResult(header=header, error=RuntimeError("Message of an unknown group")))
+            elif session.is_stale(header):
+                # pylint: disable=unexpected-keyword-arg
+                dropped.append(ProcessingResult(header=header, error=RuntimeError(f"Message of epoch "
+                                                                                  f"{header.epoch} is stale")))
+            else:
+                batches.setdefault(header.group_id, []).append(data)
+
+        self._num_dropped += len(dropped)
+        yield from dropped
+
+        for group_id, batch in batches.items():
+            yield from self._sessions[group_id].process_messages(batch, handler)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, group_id: bytes) -> bool:
+        return group_id in self._sessions
@@ -1,18 +1,36 @@
 import os
+import threading
 
-from typing import Optional, List, Dict
+from dataclasses import dataclass, replace
+from typing import Optional, List, Dict, Tuple, Union
 
 from libMLS.cipher_suite import CipherSuite
 from libMLS.crypto import hkdf_expand_label
+from libMLS.epoch_history import EpochHistory, EpochSecrets, DEFAULT_MAX_EPOCHS, DEFAULT_MAX_BYTES
 from libMLS.group_context import GroupContext
 from libMLS.key_schedule import KeySchedule, advance_epoch
 from libMLS.tree_math import parent, direct_path, sibling, copath, resolve
 from libMLS.tree_node import TreeNode
-from libMLS.messages import WelcomeInfoMessage, AddMessage, UpdateMessage, DirectPathNode, HPKECiphertext
+from libMLS.messages import WelcomeInfoMessage, AddMessage, UpdateMessage, DirectPathNode, HPKECiphertext, \
+    RemoveMessage, BulkRemoveMessage, PROTOCOL_VERSION_DRAFT_07
+from libMLS.message_views import UpdateMessageView
 from libMLS.tree import Tree
 from libMLS.x25519_cipher_suite import X25519CipherSuite
 
 
+@dataclass
+class PathUpdate:
+    """
+    A freshly computed direct path, which has not been merged into the tree yet. It is only valid for the
+    GroupContext (i.e. epoch and tree) it was computed in.
+    """
+    context_key: bytes
+    leaf_index: int
+    nodes: Dict[int, TreeNode]
+    direct_path: List[DirectPathNode]
+    update_secret: bytes
+
+
 class State:
     """
     RFC Section 6.4 Group State
@@ -77,7 +95,9 @@ class State:
             self,
             cipher_suite: CipherSuite,
             tree: Tree,
-            context: GroupContext
+            context: GroupContext,
+            max_epoch_history: int = DEFAULT_MAX_EPOCHS,
+            max_epoch_history_bytes: int = DEFAULT_MAX_BYTES
     ):
 
         # todo: Credentials, private key
@@ -85,6 +105,15 @@ class State:
         self._tree = tree
         self._context = context
         self._key_schedule = KeySchedule(self._cipher_suite)
+        self._epoch_history = EpochHistory(max_epochs=max_epoch_history, max_bytes=max_epoch_history_bytes)
+        # The epoch we start in is known as well, even though we may not have its secrets, e.g. if we joined the
+        # group using a Welcome message. This keeps application messages sent in that epoch processable.
+        self._epoch_history.add(EpochSecrets.from_key_schedule(self._context.epoch, self._key_schedule))
+
+        self._precompute_lock = threading.Lock()
+        self._precompute_worker: Optional[threading.Thread] = None
+        self._precompute_generation: int = 0
+        self._precomputed_path: Optional[PathUpdate] = None
 
     @classmethod
     def from_existing(cls, cipher_suite: CipherSuite, context: GroupContext,
@@ -109,9 +138,28 @@ class State:
     def get_key_schedule(self) -> KeySchedule:
         return self._key_schedule
 
+    def get_epoch_history(self) -> EpochHistory:
+        return self._epoch_history
+
+    def get_epoch_secrets(self, epoch: int) -> Optional[EpochSecrets]:
+        """
+        Returns the application and sender data secrets of the given epoch, if it is the current one or still part of
+        the epoch history
+        :param epoch: epoch of a received message
+        :return: the secrets or None if the epoch is unknown or was already evicted
+        """
+        return self._epoch_history.get(epoch)
+
+    def _advance_epoch(self, update_secret: bytes) -> None:
+        # a speculatively computed update belongs to the previous epoch
+        self._discard_precomputed_path()
+        advance_epoch(self._context, self._key_schedule, update_secret)
+        self._epoch_history.add(EpochSecrets.from_key_schedule(self._context.epoch, self._key_schedule))
+
     # todo: user user_credential
     # pylint: disable=unused-argument
-    def add(self, user_init_key: bytes, user_credential: bytes) -> (WelcomeInfoMessage, AddMessage):
+    def add(self, user_init_key: bytes, user_credential: bytes,
+            protocol_version: bytes = PROTOCOL_VERSION_DRAFT_07) -> (WelcomeInfoMessage, AddMessage):
         """
         RFC Section 9.2 Add
         https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.2
@@ -138,6 +186,7 @@ class State:
 
         :param user_init_key: the init_key of the user
         :param user_credential: the user credentials
+        :param protocol_version: the protocol version of the welcome, which selects the encoding of the tree
         :return: WelcomeInfoMessage and AddMessage
         """
         # pylint: disable=unexpected-keyword-arg
@@ -149,7 +198,7 @@ class State:
             key=b'0',
             nounce=b'0',
             tree=[],
-            protocol_version=b'0'
+            protocol_version=protocol_version
         )
 
         # strip private keys
@@ -215,8 +264,7 @@ class State:
         # todo: validate stuff
         self._tree.add_leaf(TreeNode(add_message.init_key, private_key, None))
 
-        advance_epoch(self._context, self._key_schedule,
-                      bytes(bytearray(b'\x00') * self._cipher_suite.get_hash_length()))
+        self._advance_epoch(bytes(bytearray(b'\x00') * self._cipher_suite.get_hash_length()))
 
     def update(self, leaf_index: int) -> UpdateMessage:
         """
@@ -242,65 +290,179 @@ class State:
         # nicht unseren tree borken. Gerade erstzen wir das leaf secret sofort, wenn die update nachricht dann
         # resequenced wird ist der updatende client raus. MLSpp von cisco hat das gleiche problem.
 
-        nodes_in_copath = copath(leaf_index * 2, self._tree.get_num_leaves())
+        nodes_out, last_path_secret = self._refresh_path(leaf_index)
+
+        self._advance_epoch(last_path_secret)
+        return UpdateMessage(direct_path=nodes_out)
+
+    def _refresh_path(self, leaf_index: int) -> Tuple[List[DirectPathNode], bytes]:
+        """
+        RFC Section 5.4 Ratchet Tree Updates
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-5.4
+
+        Generates a fresh leaf secret, derives the path secrets for the direct path of the given leaf and encrypts
+        them for the resolution of the copath nodes. The new nodes are merged into the local tree.
+
+        :param leaf_index: leaf whose direct path is refreshed
+        :return: the DirectPathNodes of the new path and the path secret of the root node
+        """
+        path_update = self._take_precomputed_path(leaf_index)
+        if path_update is None:
+            path_update = self._compute_path(leaf_index, self._tree, self._context)
+
+        for node_index, node in path_update.nodes.items():
+            self._tree.set_node(node_index=node_index, node=node)
+
+        return path_update.direct_path, path_update.update_secret
+
+    # pylint: disable=too-many-locals
+    def _compute_path(self, leaf_index: int, tree: Tree, context: GroupContext) -> PathUpdate:
+        """
+        Computes a fresh direct path for the given leaf without touching the tree, so this can run in the background
+        :param leaf_index: leaf whose direct path is computed
+        :param tree: the tree, a snapshot of it if this runs in the background
+        :param context: the GroupContext, a snapshot of it if this runs in the background
+        :return: the new nodes and DirectPathNodes of the path
+        """
+        context_key = bytes(context)
+        num_leaves = tree.get_num_leaves()
+        nodes_in_copath = copath(leaf_index * 2, num_leaves)
+        new_nodes: Dict[int, TreeNode] = {}
         nodes_out: List[DirectPathNode] = []
         # Corresponds to X=path_secret[0]
         path_secret = os.urandom(16)
         # todo: get hash len
         node_secret = hkdf_expand_label(secret=path_secret,
-                                        context=self._context,
+                                        context=context,
                                         label=b"node",
                                         cipher_suite=self._cipher_suite)
 
-        self._tree.set_node(node_index=leaf_index * 2, node=TreeNode.from_node_secret(node_secret=node_secret,
-                                                                                      cipher_suite=self._cipher_suite))
+        new_nodes[leaf_index * 2] = TreeNode.from_node_secret(node_secret=node_secret,
+                                                              cipher_suite=self._cipher_suite)
 
         # pylint: disable=unexpected-keyword-arg
-        nodes_out.append(DirectPathNode(public_key=self._tree.get_node(leaf_index * 2).get_public_key(),
+        nodes_out.append(DirectPathNode(public_key=new_nodes[leaf_index * 2].get_public_key(),
                                         encrypted_path_secret=[]))
 
         last_path_secret = None
         for conode_index in nodes_in_copath:
-            node_index = parent(conode_index, self._tree.get_num_leaves())
+            node_index = parent(conode_index, num_leaves)
 
-            path_secret = hkdf_expand_label(secret=path_secret, context=self._context, label=b"path",
+            path_secret = hkdf_expand_label(secret=path_secret, context=context, label=b"path",
                                             cipher_suite=self._cipher_suite)
             last_path_secret = path_secret
 
-            node_secret = hkdf_expand_label(secret=path_secret, context=self._context, label=b"node",
+            node_secret = hkdf_expand_label(secret=path_secret, context=context, label=b"node",
                                             cipher_suite=self._cipher_suite)
 
-            self._tree.set_node(node_index=node_index,
-                                node=TreeNode.from_node_secret(node_secret=node_secret,
-                                                               cipher_suite=self._cipher_suite))
+            new_nodes[node_index] = TreeNode.from_node_secret(node_secret=node_secret,
+                                                              cipher_suite=self._cipher_suite)
 
             # encrypt the path secret for the nodes in the copath
-            resolution: List[int] = resolve(self._tree.get_nodes(), conode_index, self._tree.get_num_leaves())
+            resolution: List[int] = resolve(tree.get_nodes(), conode_index, num_leaves)
             ciphers: List[HPKECiphertext] = []
             # todo: This loop must be updated with Issue !6
             # https://git.fh-muenster.de/masterprojekt-mls/implementation/issues/6
             # pylint: disable=unused-variable
             for resolution_node_index in resolution:
                 # pylint: disable=unexpected-keyword-arg
-                ciphers.append(HPKECiphertext(ephemeral_key=b'0', cipher_text=path_secret))
+                ciphers.append(HPKECiphertext(ephemeral_key=b'0' * 32, cipher_text=path_secret))
 
             # todo: SetupBaseI aus HPKE nutzen https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.3
             # todo: Path secret verschlüsseln
             # pylint: disable=unexpected-keyword-arg
-            nodes_out.append(DirectPathNode(public_key=self._tree.get_node(node_index).get_public_key(),
+            nodes_out.append(DirectPathNode(public_key=new_nodes[node_index].get_public_key(),
                                             encrypted_path_secret=ciphers))
 
-        if len(nodes_in_copath) == 0 and self._tree.get_num_leaves() == 1:
+        if len(nodes_in_copath) == 0 and num_leaves == 1:
             last_path_secret = path_secret
 
         if last_path_secret is None:
             raise ValueError()
 
-        advance_epoch(self._context, self._key_schedule, last_path_secret)
-        return UpdateMessage(direct_path=nodes_out)
+        # pylint: disable=unexpected-keyword-arg
+        return PathUpdate(context_key=context_key, leaf_index=leaf_index, nodes=new_nodes, direct_path=nodes_out,
+                          update_secret=last_path_secret)
 
-    # pylint: disable=too-many-locals
-    def process_update(self, leaf_index: int, message: UpdateMessage) -> None:
+    def precompute_update(self, leaf_index: int) -> threading.Thread:
+        """
+        Speculatively computes the next update of the given leaf in a background thread. The result is bound to the
+        current GroupContext, the next call to update() uses it if the tree did not change in between. Otherwise,
+        e.g. if a handshake message arrives first, it is discarded. A path which is still valid is kept, so calling
+        this after every poll does not compute the path again.
+
+        :param leaf_index: leaf to update
+        :return: the worker thread
+        """
+        with self._precompute_lock:
+            if self._precompute_worker is not None and self._precompute_worker.is_alive():
+                return self._precompute_worker
+
+            # _discard_precomputed_path drops the path whenever the generation changes, so a stored path belongs to
+            # the current generation
+            path_update = self._precomputed_path
+            if path_update is not None and path_update.leaf_index == leaf_index and \
+                    path_update.context_key == bytes(self._context):
+                return self._precompute_worker
+
+            self._precomputed_path = None
+            # the worker computes on a snapshot, the tree and context may change while it is running
+            tree = Tree(self._tree.cipher_suite, list(self._tree.get_nodes()))
+            context = replace(self._context)
+            self._precompute_worker = threading.Thread(target=self._precompute_path,
+                                                       args=(leaf_index, tree, context, self._precompute_generation),
+                                                       daemon=True)
+            self._precompute_worker.start()
+            return self._precompute_worker
+
+    def _precompute_path(self, leaf_index: int, tree: Tree, context: GroupContext, generation: int) -> None:
+        try:
+            path_update = self._compute_path(leaf_index, tree, context)
+        except (ValueError, IndexError):
+            # the leaf is not part of the tree, update() reports this once it computes the path itself
+            return
+
+        with self._precompute_lock:
+            if generation == self._precompute_generation:
+                self._precomputed_path = path_update
+
+    def _take_precomputed_path(self, leaf_index: int) -> Optional[PathUpdate]:
+        with self._precompute_lock:
+            worker = self._precompute_worker
+
+        # a worker for the current tree is cheaper to wait for than to start over
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+
+        with self._precompute_lock:
+            path_update = self._precomputed_path
+            self._precomputed_path = None
+
+        if path_update is None or path_update.leaf_index != leaf_index or \
+                path_update.context_key != bytes(self._context):
+            return None
+
+        return path_update
+
+    def _discard_precomputed_path(self) -> None:
+        """
+        Must be called whenever the tree changes, so running workers do not store outdated results
+        """
+        with self._precompute_lock:
+            self._precompute_generation += 1
+            self._precomputed_path = None
+
+    def has_precomputed_update(self) -> bool:
+        return self.get_precomputed_update() is not None
+
+    def get_precomputed_update(self) -> Optional[PathUpdate]:
+        """
+        :return: the path the next update() uses if it is still valid, None if there is none
+        """
+        with self._precompute_lock:
+            return self._precomputed_path
+
+    def process_update(self, leaf_index: int, message: Union[UpdateMessage, UpdateMessageView]) -> None:
         """
         RFC Section 5.5 Synchronizing Views of the Tree
         https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-5.5
@@ -333,45 +495,69 @@ class State:
           empty list.
 
         :param leaf_index: leaf node that got updated
-        :param message: received updateMessage
+        :param message: received updateMessage, a lazy UpdateMessageView only decodes the ciphertexts we decrypt
         """
+        if not message.validate():
+            raise RuntimeError("Validation failed for the received UpdateMessage")
 
+        last_path_secret = self._merge_direct_path(leaf_index, message.direct_path)
+
+        self._advance_epoch(last_path_secret)
+
+    # pylint: disable=too-many-locals
+    def _merge_direct_path(self, leaf_index: int, received_path: List[DirectPathNode]) -> bytes:
+        """
+        RFC Section 5.5 Synchronizing Views of the Tree
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-5.5
+
+        Decrypts the path secrets of a received direct path and merges the new nodes into the local tree.
+
+        :param leaf_index: leaf from which the direct path originates
+        :param received_path: the received DirectPathNodes, ordered from the leaf to the root
+        :return: the path secret of the root node
+        """
         # todo: more sanity checks
         len_local_path = len(direct_path(leaf_index * 2, self._tree.get_num_leaves()))
-        len_received_path = len(message.direct_path)
+        len_received_path = len(received_path)
         # the direct path does not include the root or the target node, so we have to add 2 to the expected count
         if len_local_path + 2 != len_received_path:
             raise RuntimeError(
                 f"Len of direct path to target leaf is {len_local_path} vs received path of len {len_received_path}")
 
-        if message.direct_path[0].encrypted_path_secret:
+        if received_path[0].encrypted_path_secret:
             raise RuntimeError()
 
         # We do not update the tree immediately, as we may need the old secrets to unpack further nodes. We rather
         # store them and apply them after unpacking all nodes.
         nodes_to_update: Dict[int, TreeNode] = {
-            leaf_index * 2: TreeNode(message.direct_path[0].public_key, None, None)
+            leaf_index * 2: TreeNode(received_path[0].public_key, None, None)
         }
 
         last_node_index = leaf_index * 2
-        last_path_secret = None
-        for entry in message.direct_path[1:]:
+        path_secret: Optional[bytes] = None
+        for entry in received_path[1:]:
             current_node_index = parent(last_node_index, self._tree.get_num_leaves())
 
-            last_node_sibling_index = sibling(current_node_index, self._tree.get_num_leaves())
-            last_node_sibling_resolution = resolve(self._tree.get_nodes(), last_node_sibling_index,
-                                                   self._tree.get_num_leaves())
+            if path_secret is None:
+                # the path secret of this node is encrypted for the resolution of the copath node
+                copath_node_index = sibling(last_node_index, self._tree.get_num_leaves())
+                copath_node_resolution = resolve(self._tree.get_nodes(), copath_node_index,
+                                                 self._tree.get_num_leaves())
+
+                for cipher_index, resolution_node_index in enumerate(copath_node_resolution):
+                    if not self._tree.get_node(resolution_node_index).has_private_key():
+                        continue
+
+                    # todo: decrypt secret here, as soon as it is encrypted
+                    path_secret = entry.encrypted_path_secret[cipher_index].cipher_text
+                    break
+            else:
+                # Derive path secrets for ancestors of that node using the algorithm described above.
+                path_secret = hkdf_expand_label(secret=path_secret, context=self._context, label=b"path",
+                                                cipher_suite=self._cipher_suite)
 
             computed_node: TreeNode = TreeNode(entry.public_key, None, None)
-            for resolution_node_index in last_node_sibling_resolution:
-                resolution_node = self._tree.get_node(resolution_node_index)
-                if not resolution_node.has_private_key():
-                    continue
-
-                # todo: decrypt secret here, as soon as it is encrypted
-                path_secret: Optional[bytes] = entry.encrypted_path_secret[0].cipher_text
-                last_path_secret = path_secret
-
+            if path_secret is not None:
                 node_secret = hkdf_expand_label(secret=path_secret, context=self._context, label=b"node",
                                                 cipher_suite=self._cipher_suite)
 
@@ -382,13 +568,128 @@ class State:
                 if computed_node.get_public_key() != entry.public_key:
                     raise RuntimeError("Received path secret does not match the received public key.")
 
-                break
-
             nodes_to_update[current_node_index] = computed_node
             last_node_index = current_node_index
 
+        if path_secret is None:
+            raise RuntimeError("None of the received path secrets was encrypted for this member.")
+
         # apply new nodes
         for index, node in nodes_to_update.items():
             self._tree.set_node(index, node)
 
-        advance_epoch(self._context, self._key_schedule, last_path_secret)
+        return path_secret
+
+    def remove(self, leaf_index: int, removed_leaf_index: int) -> RemoveMessage:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        A Remove message is sent by a group member to remove one or more
+        other members from the group.  A member MUST NOT use a Remove message
+        to remove themselves from the group.
+
+        The removed leaf and its direct path are blanked and the tree is truncated before the sender refreshes its
+        own direct path. This way, the new path secrets are never encrypted for the removed member.
+
+        :param leaf_index: leaf of the sender
+        :param removed_leaf_index: leaf to remove
+        :return: RemoveMessage
+        """
+        # pylint: disable=unexpected-keyword-arg
+        return RemoveMessage(removed=removed_leaf_index,
+                             direct_path=self._remove_and_refresh(leaf_index, [removed_leaf_index]))
+
+    def bulk_remove(self, leaf_index: int, removed_leaf_indices: List[int]) -> BulkRemoveMessage:
+        """
+        Removes several members at once. In contrast to sending one Remove message per member, the group advances
+        a single epoch and the sender has to refresh its direct path only once.
+
+        :param leaf_index: leaf of the sender
+        :param removed_leaf_indices: leaves to remove
+        :return: BulkRemoveMessage
+        """
+        # pylint: disable=unexpected-keyword-arg
+        return BulkRemoveMessage(removed=list(removed_leaf_indices),
+                                 direct_path=self._remove_and_refresh(leaf_index, removed_leaf_indices))
+
+    def _remove_and_refresh(self, leaf_index: int, removed_leaf_indices: List[int]) -> List[DirectPathNode]:
+        self._remove_leaves(leaf_index, removed_leaf_indices)
+
+        nodes_out, last_path_secret = self._refresh_path(leaf_index)
+
+        self._advance_epoch(last_path_secret)
+        return nodes_out
+
+    def process_remove(self, leaf_index: int, message: RemoveMessage) -> None:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        The recipient of a Remove message:
+
+        o  Replace the leaf node at position "removed" with a blank node
+        o  Blank the intermediate nodes along the path from the removed
+           leaf to the root
+        o  Truncate the tree by reducing the size of tree until the
+           rightmost non-blank leaf node
+        o  Update the ratchet tree by replacing nodes in the direct path
+           from the sender's leaf using the information in the Remove
+           message
+
+        :param leaf_index: leaf of the sender
+        :param message: received RemoveMessage
+        """
+        self._process_removal(leaf_index, [message.removed], message.direct_path)
+
+    def process_bulk_remove(self, leaf_index: int, message: BulkRemoveMessage) -> None:
+        """
+        Same as process_remove, but all leaves in the message are removed before the direct path is merged
+
+        :param leaf_index: leaf of the sender
+        :param message: received BulkRemoveMessage
+        """
+        self._process_removal(leaf_index, message.removed, message.direct_path)
+
+    def _process_removal(self, leaf_index: int, removed_leaf_indices: List[int],
+                         received_path: List[DirectPathNode]) -> None:
+        # the tree is only changed if the whole message can be applied, otherwise we would be out of sync with the
+        # group without noticing
+        nodes = list(self._tree.get_nodes())
+        try:
+            self._remove_leaves(leaf_index, removed_leaf_indices)
+            last_path_secret = self._merge_direct_path(leaf_index, received_path)
+        except Exception:
+            self._tree.set_nodes(nodes)
+            raise
+
+        self._advance_epoch(last_path_secret)
+
+    def _check_removal(self, leaf_index: int, removed_leaf_indices: List[int]) -> None:
+        """
+        Checks all leaves of a removal before any of them is removed
+        :raises RuntimeError: if a leaf is out of range, blank, given twice or the sender itself
+        """
+        if not removed_leaf_indices:
+            raise RuntimeError("No leaves to remove given")
+
+        if leaf_index in removed_leaf_indices:
+            raise RuntimeError("A member must not remove themselves from the group")
+
+        if len(set(removed_leaf_indices)) != len(removed_leaf_indices):
+            raise RuntimeError("A leaf must not be removed twice")
+
+        for removed_leaf_index in removed_leaf_indices:
+            if not 0 <= removed_leaf_index < self._tree.get_num_leaves() or \
+                    self._tree.get_node(removed_leaf_index * 2) is None:
+                raise RuntimeError(f"Leaf {removed_leaf_index} is blank or not part of the tree")
+
+    def _remove_leaves(self, leaf_index: int, removed_leaf_indices: List[int]) -> None:
+        self._check_removal(leaf_index, removed_leaf_indices)
+
+        self._discard_precomputed_path()
+
+        for removed_leaf_index in removed_leaf_indices:
+            self._tree.remove_leaf(removed_leaf_index)
+
+        self._tree.truncate()
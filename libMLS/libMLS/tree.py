@@ -85,6 +85,12 @@ class Tree:
     def set_node(self, node_index: int, node: Optional[TreeNode]):
         self._nodes[node_index] = node
 
+    def set_nodes(self, nodes: List[Optional[TreeNode]]) -> None:
+        """
+        Replaces all nodes, e.g. to restore the tree after a handshake message could not be applied
+        """
+        self._nodes[:] = nodes
+
     def add_leaf(self, node: TreeNode, leaf_index: Optional[int] = None) -> None:
         """
         Appends a ratchetTreeNode to the ratchetTree
@@ -107,6 +113,37 @@ class Tree:
         # blank path to root
         self._blank_path(len(self._nodes) - 1)
 
+    def remove_leaf(self, leaf_index: int) -> None:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        Replaces the leaf at the given index with a blank node and blanks all nodes in its direct path. The tree is
+        not truncated, see truncate()
+        :param leaf_index: index of the leaf which should be removed
+        """
+        node_index = leaf_index * 2
+
+        if node_index >= self.get_num_nodes() or self._nodes[node_index] is None:
+            raise IndexError(f"Leaf {leaf_index} is blank or not part of the tree")
+
+        self._nodes[node_index] = None
+        self._blank_path(node_index)
+
+    def truncate(self) -> None:
+        """
+        RFC Section 9.4 Remove
+        https://tools.ietf.org/html/draft-ietf-mls-protocol-07#section-9.4
+
+        Truncate the tree by reducing the size of tree until the rightmost
+        non-blank leaf node.
+
+        Since the tree has an odd number of nodes, the rightmost leaf is always preceded by an intermediate node,
+        which gets dropped together with the leaf.
+        """
+        while self.get_num_nodes() > 1 and self._nodes[-1] is None:
+            del self._nodes[-2:]
+
     def _blank_path(self, node_index: int) -> None:
         """
         RFC Section 5.2 Ratchet Tree Nodes
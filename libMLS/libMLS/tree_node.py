@@ -3,7 +3,7 @@ from dataclasses import dataclass
 
 from libMLS.abstract_message import AbstractMessage
 from libMLS.cipher_suite import CipherSuite
-from libMLS.message_packer import pack_dynamic, unpack_dynamic
+from libMLS.message_packer import MessageWriter, calc_packed_size, unpack_dynamic
 
 
 @dataclass
@@ -166,11 +166,16 @@ class TreeNode(AbstractMessage):
 
         return inst
 
-    def _pack(self) -> bytes:
-        return pack_dynamic('VVV',
-                            self._public_key,
-                            self._private_key if self._private_key is not None else b'',
-                            self._credentials if self._credentials is not None else b'')
+    def _fields(self) -> tuple:
+        return self._public_key, \
+               self._private_key if self._private_key is not None else b'', \
+               self._credentials if self._credentials is not None else b''
+
+    def packed_size(self) -> int:
+        return calc_packed_size('VVV', *self._fields())
+
+    def _write(self, writer: MessageWriter) -> None:
+        writer.write('VVV', *self._fields())
 
     def validate(self) -> bool:
         return self._public_key is not None
@@ -1,14 +1,20 @@
+import asyncio
 import functools
 import re
 from typing import List, Union, Dict
 
 import pytest
-from libMLS.abstract_application_handler import AbstractApplicationHandler
+from libMLS.abstract_application_handler import AbstractApplicationHandler, DeferringHandler
+from libMLS.async_session import AsyncSession, AsyncApplicationHandler
+from libMLS.compression import PayloadCompressor, CompressionCodec
 from libMLS.dot_dumper import DotDumper
 
 from libMLS.local_key_store_mock import LocalKeyStoreMock
-from libMLS.messages import UpdateMessage, WelcomeInfoMessage, AddMessage, GroupOperation, GroupOperationType
+from libMLS.messages import UpdateMessage, WelcomeInfoMessage, AddMessage, GroupOperation, GroupOperationType, \
+    RemoveMessage, BulkRemoveMessage, ContentType, MLSCiphertext
+from libMLS.reorder_buffer import ReorderBuffer
 from libMLS.session import Session
+from libMLS.session_manager import SessionManager
 
 from libMLS.tree_math import parent, root
 
@@ -372,6 +378,27 @@ class StubHandler(AbstractApplicationHandler):
     def on_keys_updated(self, group_id: bytes):
         pass
 
+    def on_group_member_removed(self, group_id: bytes):
+        pass
+
+
+class RecordingHandler(StubHandler):
+    """
+    Records the received application data and the callbacks of every processed batch
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+        self.batches = []
+
+    def on_application_message(self, application_data: bytes, group_id: bytes):
+        self.received.append(application_data)
+
+    def on_batch_processed(self, group_id: bytes, events):
+        self.batches.append([event.callback for event in events])
+        super().on_batch_processed(group_id, events)
+
 
 def test_handshake_processing():
     alice_store = LocalKeyStoreMock('alice')
@@ -395,3 +422,454 @@ def test_handshake_processing():
     # assert that both sessions have the same state after adds
     assert alice_session.get_state().get_tree().get_num_nodes() == 3
     assert bob_session.get_state().get_tree().get_num_nodes() == 3
+
+
+def assert_sessions_in_sync(sessions: List[Session]):
+    for session in sessions:
+        assert sessions[0].get_state().get_tree() == session.get_state().get_tree()
+        assert sessions[0].get_state().get_group_context() == session.get_state().get_group_context()
+        assert sessions[0].get_state().get_key_schedule().get_epoch_secret() == \
+               session.get_state().get_key_schedule().get_epoch_secret()
+
+
+@pytest.mark.dependency(depends=["test_update_session_with_many_members"])
+def test_remove_member():
+    for i in range(2, 10, 1):
+        for removed_index in range(1, i, 1):
+            sessions = create_session_with_n_members(i)
+
+            update_msg = sessions[0].update()
+            for session in sessions[1:]:
+                session.process_update(0, update_msg)
+
+            remove_msg = sessions[0].remove_member(removed_index)
+            remove_msg = RemoveMessage.from_bytes(remove_msg.pack())
+
+            remaining = [session for index, session in enumerate(sessions) if index != removed_index]
+            for session in remaining[1:]:
+                session.process_remove(0, remove_msg)
+
+            assert_sessions_in_sync(remaining)
+
+            tree = sessions[0].get_state().get_tree()
+            assert tree.get_num_leaves() <= removed_index or tree.get_node(removed_index * 2) is None
+
+
+def test_remove_truncates_tree():
+    sessions = create_session_with_n_members(4)
+
+    remove_msg = sessions[0].remove_member(3)
+    for session in sessions[1:3]:
+        session.process_remove(0, remove_msg)
+
+    assert sessions[0].get_state().get_tree().get_num_leaves() == 3
+    assert_sessions_in_sync(sessions[:3])
+
+
+def test_bulk_remove_advances_one_epoch():
+    sessions = create_session_with_n_members(8)
+    epoch = sessions[0].get_state().get_group_context().epoch
+
+    remove_msg = sessions[2].remove_members([0, 5, 7])
+    remove_msg = BulkRemoveMessage.from_bytes(remove_msg.pack())
+
+    remaining = [session for index, session in enumerate(sessions) if index not in [0, 5, 7]]
+    for session in remaining:
+        if session is not sessions[2]:
+            session.process_bulk_remove(2, remove_msg)
+
+    assert_sessions_in_sync(remaining)
+    assert sessions[2].get_state().get_group_context().epoch == epoch + 1
+    # the leaf 7 was the rightmost leaf, so the tree got truncated
+    assert sessions[2].get_state().get_tree().get_num_leaves() == 7
+
+
+def test_member_must_not_remove_itself():
+    sessions = create_session_with_n_members(3)
+
+    with pytest.raises(RuntimeError):
+        sessions[0].remove_member(0)
+
+
+def test_invalid_removal_leaves_tree_unchanged():
+    sessions = create_session_with_n_members(4)
+    tree = list(sessions[1].get_state().get_tree().get_nodes())
+
+    for leaf_indices in [[2, 9], [2, 2], []]:
+        with pytest.raises(RuntimeError):
+            sessions[0].remove_members(leaf_indices)
+
+    remove_msg = sessions[0].remove_members([2, 3])
+    # a direct path which does not fit the tree after the removal
+    bad_remove_msg = BulkRemoveMessage(removed=[2, 3], direct_path=remove_msg.direct_path[:1])
+    for message in [BulkRemoveMessage(removed=[2, 9], direct_path=remove_msg.direct_path), bad_remove_msg]:
+        with pytest.raises(RuntimeError):
+            sessions[1].process_bulk_remove(0, message)
+        assert sessions[1].get_state().get_tree().get_nodes() == tree
+
+    sessions[1].process_bulk_remove(0, remove_msg)
+    assert_sessions_in_sync(sessions[:2])
+
+
+def test_removed_member_cannot_remove():
+    sessions = create_session_with_n_members(3)
+
+    remove_op = GroupOperation.from_instance(sessions[0].remove_member(2))
+    sessions[2].process_message(sessions[0].encrypt_handshake_message(remove_op), StubHandler())
+
+    with pytest.raises(RuntimeError):
+        sessions[2].remove_member(1)
+    with pytest.raises(RuntimeError):
+        sessions[2].remove_members([0, 1])
+
+
+def test_remove_handshake_processing():
+    sessions = create_session_with_n_members(4)
+    handler = StubHandler()
+
+    remove_op = GroupOperation.from_instance(sessions[1].remove_members([2, 3]))
+    cipher = sessions[1].encrypt_handshake_message(remove_op)
+
+    for session in sessions:
+        session.process_message(cipher, handler)
+
+    assert not sessions[2].is_member() and not sessions[3].is_member()
+    assert_sessions_in_sync(sessions[:2])
+
+    # the remaining members can still update each other
+    update_op = GroupOperation.from_instance(sessions[0].update())
+    cipher = sessions[0].encrypt_handshake_message(update_op)
+    for session in sessions[:2]:
+        session.process_message(cipher, handler)
+
+    assert_sessions_in_sync(sessions[:2])
+
+
+def test_late_application_message_is_processed_with_epoch_history():
+    sessions = create_session_with_n_members(3)
+
+    handler = RecordingHandler()
+    late_message = sessions[1].encrypt_application_message(b'late')
+
+    update_op = GroupOperation.from_instance(sessions[0].update())
+    cipher = sessions[0].encrypt_handshake_message(update_op)
+    for session in sessions:
+        session.process_message(cipher, handler)
+
+    sessions[2].process_message(late_message, handler)
+    assert handler.received == [b'late']
+    assert sessions[2].get_state().get_epoch_secrets(late_message.epoch).generations == {1: 0}
+
+
+def test_application_message_of_evicted_epoch_is_rejected():
+    sessions = create_session_with_n_members(2)
+    old_message = sessions[1].encrypt_application_message(b'old')
+
+    for _ in range(sessions[0].get_state().get_epoch_history().get_num_epochs() + 8):
+        update = sessions[0].update()
+        sessions[1].process_update(0, update)
+
+    with pytest.raises(RuntimeError):
+        sessions[1].process_message(old_message, StubHandler())
+
+
+def test_precomputed_update_is_used():
+    sessions = create_session_with_n_members(5)
+
+    state = sessions[2].get_state()
+    worker = state.precompute_update(2)
+    worker.join()
+    precomputed = state.get_precomputed_update()
+    assert precomputed is not None
+
+    # e.g. after an idle poll, the valid path is kept instead of being computed again
+    assert state.precompute_update(2) is worker
+    assert state.get_precomputed_update() is precomputed
+
+    update = sessions[2].update()
+    assert not state.has_precomputed_update()
+    assert update.direct_path == precomputed.direct_path
+    assert state.get_tree().get_node(4).get_public_key() == precomputed.nodes[4].get_public_key()
+
+    for session in sessions:
+        if session is not sessions[2]:
+            session.process_update(2, update)
+
+    assert_sessions_in_sync(sessions)
+
+
+def test_precomputed_update_is_discarded_by_handshake():
+    sessions = create_session_with_n_members(5)
+
+    sessions[2].get_state().precompute_update(2).join()
+    assert sessions[2].get_state().has_precomputed_update()
+
+    update = sessions[0].update()
+    for session in sessions[1:]:
+        session.process_update(0, update)
+
+    assert not sessions[2].get_state().has_precomputed_update()
+
+    update = sessions[2].update()
+    for session in sessions:
+        if session is not sessions[2]:
+            session.process_update(2, update)
+
+    assert_sessions_in_sync(sessions)
+
+
+def test_application_message_of_welcome_epoch_is_processed():
+    alice_store = LocalKeyStoreMock('alice')
+    alice_store.register_keypair(b'0', b'0')
+    bob_store = LocalKeyStoreMock('bob')
+    bob_store.register_keypair(b'1', b'1')
+
+    alice_session = Session.from_empty(alice_store, 'alice', 'test')
+    welcome, add = alice_session.add_member('bob', b'1')
+    encrypted_add = alice_session.encrypt_handshake_message(GroupOperation.from_instance(add))
+    # the application message is sent before alice processes her own add, e.g. the user list of the chat client
+    message = alice_session.encrypt_application_message(b'hello')
+
+    bob_session = Session.from_welcome(welcome, bob_store, 'bob')
+    for session in [alice_session, bob_session]:
+        session.process_message(encrypted_add, StubHandler())
+        session.process_message(message, StubHandler())
+
+
+def test_session_manager_routes_messages_by_group():
+    sessions = create_session_with_n_members(2)
+    manager = SessionManager()
+    manager.add_session(sessions[1])
+
+    group_id = sessions[1].get_state().get_group_context().group_id
+    assert group_id in manager
+    assert manager.get_session(group_id) is sessions[1]
+
+    header = manager.process_message(sessions[0].encrypt_application_message(b'hello').pack(), StubHandler())
+    assert header.group_id == group_id
+    assert header.content_type == ContentType.APPLICATION
+
+    manager.remove_session(group_id)
+    assert manager.process_message(sessions[0].encrypt_application_message(b'hello').pack(), StubHandler()) is None
+    assert manager.get_num_dropped() == 1
+
+
+def test_session_manager_drops_stale_handshakes():
+    sessions = create_session_with_n_members(2)
+    manager = SessionManager()
+    manager.add_session(sessions[1])
+
+    first_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update())).pack()
+    assert manager.process_message(first_update, StubHandler()) is not None
+
+    second_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update())).pack()
+    assert manager.process_message(second_update, StubHandler()) is not None
+    assert_sessions_in_sync(sessions)
+
+    # a replayed handshake of a past epoch is dropped without being parsed
+    assert manager.process_message(first_update, StubHandler()) is None
+    assert manager.get_num_dropped() == 1
+    assert_sessions_in_sync(sessions)
+
+
+def test_session_manager_processes_batches_of_several_groups():
+    sessions = create_session_with_n_members(2)
+    manager = SessionManager()
+    manager.add_session(sessions[1])
+
+    other_store = LocalKeyStoreMock('other')
+    other_store.register_keypair(b'2', b'2')
+    other_session = Session.from_empty(other_store, 'other', 'other')
+
+    update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update())).pack()
+    message = sessions[0].encrypt_application_message(b'hello').pack()
+    unknown = other_session.encrypt_application_message(b'unknown').pack()
+
+    handler = RecordingHandler()
+    results = list(manager.process_messages([message, b'\x00', unknown, update], handler))
+
+    assert [result.processed for result in results] == [False, False, True, True]
+    assert results[0].header is None
+    assert results[1].header.group_id == b'other'
+    assert manager.get_num_dropped() == 2
+    assert handler.received == [b'hello']
+    assert_sessions_in_sync(sessions)
+
+
+def test_process_messages_orders_handshakes_before_dependent_application_messages():
+    sessions = create_session_with_n_members(3)
+
+    first_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update()))
+    sessions[1].process_message(first_update, StubHandler())
+    message = sessions[1].encrypt_application_message(b'hello').pack()
+    second_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update()))
+
+    handler = RecordingHandler()
+    # the application message depends on the first update, but arrives first
+    results = list(sessions[2].process_messages([second_update.pack(), message, first_update], handler))
+
+    assert all(result.processed for result in results)
+    assert [result.header.content_type for result in results] == \
+           [ContentType.HANDSHAKE, ContentType.APPLICATION, ContentType.HANDSHAKE]
+    assert handler.batches == [['on_keys_updated', 'on_application_message', 'on_keys_updated']]
+    assert_sessions_in_sync([sessions[0], sessions[2]])
+
+
+def test_process_messages_reports_stale_messages():
+    sessions = create_session_with_n_members(2)
+
+    update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update())).pack()
+    sessions[1].process_message(MLSCiphertext.from_bytes(update), StubHandler())
+    sessions[1].process_update(0, sessions[0].update())
+
+    results = list(sessions[1].process_messages([update], StubHandler()))
+    assert len(results) == 1
+    assert not results[0].processed
+    assert_sessions_in_sync(sessions)
+
+
+def test_process_messages_reports_malformed_messages():
+    sessions = create_session_with_n_members(3)
+
+    update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update())).pack()
+    message = sessions[0].encrypt_application_message(b'hello').pack()
+    header = MLSCiphertext.peek_header(update)
+    # a valid header followed by a vector length which exceeds the buffer
+    broken_body = update[:4 + len(header.group_id) + 5] + b'\xff' * 8
+    remove = sessions[0].remove_members([2])
+    bad_remove = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(
+        BulkRemoveMessage(removed=[5], direct_path=remove.direct_path))).pack()
+
+    results = list(sessions[1].process_messages([update[:3], message, broken_body, update, bad_remove],
+                                                StubHandler()))
+
+    assert [result.processed for result in results] == [False, False, True, True, False]
+    assert results[0].header is None
+    assert [result.header for result in results[1:4]] == [header, header, MLSCiphertext.peek_header(message)]
+    # the rejected remove did not change the state
+    assert sessions[1].get_state().get_group_context().epoch == header.epoch
+    assert sessions[1].get_state().get_tree().get_num_leaves() == 3
+
+
+def test_async_session_processes_messages_in_order():
+    sessions = create_session_with_n_members(2)
+
+    class AsyncRecordingHandler(AsyncApplicationHandler):
+        def __init__(self):
+            super().__init__()
+            self.received = []
+
+        async def on_application_message(self, application_data: bytes, group_id: bytes):
+            self.received.append(application_data)
+
+        async def on_keys_updated(self, group_id: bytes):
+            self.received.append(b'update')
+
+    async def run():
+        sender = AsyncSession(sessions[0])
+        receiver = AsyncSession(sessions[1])
+        handler = AsyncRecordingHandler()
+
+        update = GroupOperation.from_instance(await sender.update())
+        messages = [sessions[0].encrypt_handshake_message(update)] + \
+                   [sessions[0].encrypt_application_message(bytes([index])) for index in range(5)]
+
+        # all tasks are started at once, but are processed in order of their creation
+        await asyncio.gather(*[receiver.process_message(message, handler) for message in messages])
+        return handler.received
+
+    assert asyncio.run(run()) == [b'update'] + [bytes([index]) for index in range(5)]
+    assert_sessions_in_sync(sessions)
+
+
+def test_future_epoch_messages_are_held_back_until_their_epoch():
+    sessions = create_session_with_n_members(3)
+
+    first_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update()))
+    sessions[1].process_message(first_update, StubHandler())
+    early_message = sessions[1].encrypt_application_message(b'early')
+    second_update = sessions[1].encrypt_handshake_message(GroupOperation.from_instance(sessions[1].update()))
+
+    handler = RecordingHandler()
+    buffer = sessions[2].get_reorder_buffer()
+
+    sessions[2].process_message(second_update, handler)
+    sessions[2].process_message(early_message, handler)
+    assert buffer.get_depth() == 2
+    assert handler.received == []
+
+    sessions[2].process_message(first_update, handler)
+    assert handler.received == [b'early']
+    assert_sessions_in_sync([sessions[1], sessions[2]])
+
+    metrics = buffer.get_metrics()
+    assert metrics.depth == 0
+    assert metrics.size == 0
+    assert metrics.max_depth == 2
+    assert metrics.num_released == 2
+
+
+def test_failing_held_back_message_does_not_affect_the_others():
+    sessions = create_session_with_n_members(3)
+
+    first_update = sessions[0].encrypt_handshake_message(GroupOperation.from_instance(sessions[0].update()))
+    sessions[1].process_message(first_update, StubHandler())
+    broken_message = sessions[1].encrypt_application_message(b'broken')
+    broken_message.ciphertext = b'\x00'
+    early_message = sessions[1].encrypt_application_message(b'early')
+
+    handler = RecordingHandler()
+    for message in [broken_message, early_message]:
+        sessions[2].process_message(message, handler)
+    assert sessions[2].get_reorder_buffer().get_depth() == 2
+
+    results = list(sessions[2].process_messages([first_update.pack()], handler))
+
+    # the update itself was applied, only the broken message failed
+    assert [result.processed for result in results] == [True]
+    assert [released.processed for released in results[0].released] == [False, True]
+    assert handler.received == [b'early']
+    assert sessions[2].get_reorder_buffer().get_depth() == 0
+    assert_sessions_in_sync(sessions)
+
+
+def test_reorder_buffer_is_bounded():
+    sessions = create_session_with_n_members(2)
+    sessions[0].update()
+    message = sessions[0].encrypt_application_message(b'early')
+
+    buffer = ReorderBuffer(max_messages=1)
+    buffer.push(message, message.epoch)
+    with pytest.raises(RuntimeError):
+        buffer.push(message, message.epoch)
+
+    buffer = ReorderBuffer(max_bytes=ReorderBuffer.get_message_size(message) - 1)
+    with pytest.raises(RuntimeError):
+        buffer.push(message, message.epoch)
+    assert buffer.get_metrics().num_rejected == 1
+    assert buffer.release(message.epoch) == []
+
+
+def test_compressed_welcome_and_application_data():
+    alice_store = LocalKeyStoreMock('alice')
+    alice_store.register_keypair(b'0', b'0')
+    bob_store = LocalKeyStoreMock('bob')
+    bob_store.register_keypair(b'1', b'1')
+
+    alice_session = Session.from_empty(alice_store, 'alice', 'test')
+    alice_session.set_compressor(PayloadCompressor(CompressionCodec.ZLIB, threshold=64))
+    welcome, add = alice_session.add_member('bob', b'1')
+    encrypted_add = alice_session.encrypt_handshake_message(GroupOperation.from_instance(add))
+
+    bob_session = Session.from_packed_welcome(alice_session.pack_welcome(welcome), bob_store, 'bob',
+                                              PayloadCompressor(CompressionCodec.LZMA))
+    for session in [alice_session, bob_session]:
+        session.process_message(encrypted_add, StubHandler())
+
+    payload = b'file contents ' * 1000
+    message = alice_session.encrypt_application_message(payload)
+    assert len(message.ciphertext) < len(payload)
+
+    handler = DeferringHandler()
+    bob_session.process_message(message, handler)
+    assert handler.events[0].args == (payload, 'test')
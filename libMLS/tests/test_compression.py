@@ -0,0 +1,50 @@
+import os
+import zlib
+
+import pytest
+
+from libMLS.compression import PayloadCompressor, CompressionCodec
+
+
+@pytest.mark.parametrize('codec', list(CompressionCodec))
+def test_payload_roundtrip(codec: CompressionCodec):
+    compressor = PayloadCompressor(codec, threshold=16)
+
+    for payload in [b'', b'short', b'a' * 4096, os.urandom(4096)]:
+        assert compressor.decompress(compressor.compress(payload)) == payload
+
+
+def test_small_and_incompressible_payloads_are_not_compressed():
+    compressor = PayloadCompressor(CompressionCodec.ZLIB, threshold=64)
+
+    assert compressor.compress(b'a' * 63)[0] == CompressionCodec.NONE.value
+    assert compressor.compress(b'a' * 64)[0] == CompressionCodec.ZLIB.value
+    assert compressor.compress(os.urandom(4096))[0] == CompressionCodec.NONE.value
+
+
+def test_any_codec_can_be_decompressed():
+    payload = b'a' * 4096
+    packed = PayloadCompressor(CompressionCodec.LZMA).compress(payload)
+
+    assert PayloadCompressor(CompressionCodec.ZLIB).decompress(packed) == payload
+
+
+@pytest.mark.parametrize('codec', [CompressionCodec.ZLIB, CompressionCodec.LZMA])
+def test_decompression_bomb_is_rejected(codec: CompressionCodec):
+    packed = PayloadCompressor(codec).compress(bytes(1024 * 1024))
+    assert len(packed) < 8 * 1024
+
+    with pytest.raises(RuntimeError):
+        PayloadCompressor(codec, max_decompressed_size=1024 * 1024 - 1).decompress(packed)
+
+    assert len(PayloadCompressor(codec, max_decompressed_size=1024 * 1024).decompress(packed)) == 1024 * 1024
+
+
+def test_invalid_payloads_are_rejected():
+    compressor = PayloadCompressor()
+    packed = compressor.compress(b'a' * 4096)
+
+    for invalid in [b'', bytes([255]) + packed[1:], packed[:-4],
+                    bytes([CompressionCodec.ZLIB.value]) + zlib.compress(b'a')[:2] + b'garbage']:
+        with pytest.raises(RuntimeError):
+            compressor.decompress(invalid)
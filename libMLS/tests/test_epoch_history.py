@@ -0,0 +1,60 @@
+import pytest
+
+from libMLS.epoch_history import EpochHistory, EpochSecrets
+
+
+def create_secrets(epoch: int, size: int = 32) -> EpochSecrets:
+    # pylint: disable=unexpected-keyword-arg
+    return EpochSecrets(epoch=epoch, application_secret=bytearray(b'a' * size),
+                        sender_data_secret=bytearray(b's' * size))
+
+
+def test_history_is_bounded_by_count():
+    history = EpochHistory(max_epochs=3)
+    secrets = [create_secrets(epoch) for epoch in range(5)]
+
+    for entry in secrets:
+        history.add(entry)
+
+    assert history.get_num_epochs() == 3
+    assert 0 not in history and 1 not in history
+    assert history.get(4) is secrets[4]
+
+    # evicted secrets must be zeroed
+    assert secrets[0].application_secret == bytearray(32)
+    assert secrets[1].sender_data_secret == bytearray(32)
+
+
+def test_history_is_bounded_by_memory():
+    history = EpochHistory(max_epochs=100, max_bytes=256)
+
+    for epoch in range(10):
+        history.add(create_secrets(epoch))
+
+    assert history.get_size() <= 256
+    assert history.get_num_epochs() == 4
+    assert 9 in history
+
+
+def test_ratchet_state_counts_against_memory():
+    history = EpochHistory(max_epochs=100, max_bytes=128 + 8)
+    history.add(create_secrets(0))
+    history.add(create_secrets(1))
+
+    history.record_generation(1, sender=3, generation=5)
+    history.record_generation(1, sender=3, generation=2)
+    assert history.get(1).generations == {3: 5}
+    assert history.get_num_epochs() == 2
+
+    history.record_generation(1, sender=4, generation=1)
+    assert history.get_num_epochs() == 1
+
+    with pytest.raises(KeyError):
+        history.record_generation(0, sender=3, generation=1)
+
+
+def test_newest_epoch_is_always_kept():
+    history = EpochHistory(max_epochs=2, max_bytes=16)
+    history.add(create_secrets(0))
+
+    assert 0 in history
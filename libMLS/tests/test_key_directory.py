@@ -0,0 +1,116 @@
+import threading
+
+import pytest
+
+from libMLS.key_directory import KeyDirectory
+from libMLS.local_key_store_mock import LocalKeyStoreMock
+from libMLS.session import Session
+
+
+def _key(index: int) -> bytes:
+    return index.to_bytes(32, 'big')
+
+
+def test_keys_are_handed_out_once():
+    directory = KeyDirectory(num_stripes=4)
+    directory.add_keys('alice', [_key(0), _key(1)])
+    directory.add_key('alice', _key(2))
+
+    assert directory.get_num_keys('alice') == 3
+    assert [directory.take_key_for_user('alice') for _ in range(4)] == [_key(2), _key(1), _key(0), None]
+    assert not directory.has_key('alice')
+    assert directory.get_num_users() == 0
+
+
+def test_keys_of_wrong_size_are_rejected():
+    directory = KeyDirectory()
+
+    with pytest.raises(RuntimeError):
+        directory.add_keys('alice', [_key(0), b'short'])
+
+    assert directory.get_num_keys('alice') == 0
+
+
+def test_empty_key_lists_add_no_user():
+    directory = KeyDirectory()
+    directory.add_keys('alice', [])
+    directory.add_key('bob', _key(0))
+
+    assert directory.get_num_users() == 1
+    assert directory.take_key_for_user('alice') is None
+    assert directory.take_keys(['alice', 'bob']) is None
+    assert directory.get_num_keys('bob') == 1
+
+
+def test_batches_are_atomic():
+    directory = KeyDirectory(num_stripes=2)
+    for index, user in enumerate(['alice', 'bob', 'carol']):
+        directory.add_key(user, _key(index))
+
+    assert directory.take_keys(['alice', 'dave']) is None
+    assert directory.get_num_keys('alice') == 1
+
+    assert directory.take_keys(['alice', 'bob', 'alice']) == {'alice': _key(0), 'bob': _key(1)}
+    assert directory.get_num_users() == 1
+
+    directory.clear_user('carol')
+    assert directory.take_key_for_user('carol') is None
+
+
+def test_namespaces_are_isolated():
+    directory = KeyDirectory()
+    directory.namespace('first').add_key('alice', _key(0))
+
+    assert directory.namespace('first') is directory.namespace('first')
+    assert not directory.namespace('second').has_key('alice')
+    assert not directory.has_key('alice')
+
+    directory.drop_namespace('first')
+    assert not directory.namespace('first').has_key('alice')
+
+
+def test_concurrent_batches_take_each_key_once():
+    directory = KeyDirectory(num_stripes=8)
+    users = [f'user{index}' for index in range(64)]
+    for user in users:
+        directory.add_keys(user, [_key(index) for index in range(50)])
+
+    taken = []
+
+    def take(offset: int):
+        batch = users[offset::3]
+        while True:
+            keys = directory.take_keys(batch[::-1] if offset % 2 else batch)
+            if keys is None:
+                return
+            taken.extend(keys.items())
+
+    threads = [threading.Thread(target=take, args=(offset,)) for offset in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(taken) == len(set(taken)) == 64 * 50
+    assert directory.get_num_users() == 0
+
+
+def test_sessions_with_directory():
+    directory = KeyDirectory(key_size=1).namespace('test_sessions_with_directory')
+
+    alice_store = LocalKeyStoreMock('alice', directory=directory)
+    alice_store.register_keypair(b'0', b'0')
+    bob_store = LocalKeyStoreMock('bob', directory=directory)
+    bob_store.register_keypair(b'1', b'1')
+
+    alice_session = Session.from_empty(alice_store, 'alice', 'test')
+    welcome, add = alice_session.add_member('bob', b'1')
+    bob_session = Session.from_welcome(welcome, bob_store, 'bob')
+    alice_session.process_add(add_message=add)
+    bob_session.process_add(add_message=add)
+
+    assert bob_session.get_state().get_key_schedule().get_epoch_secret() == \
+           alice_session.get_state().get_key_schedule().get_epoch_secret()
+    # both init keys were used up
+    assert directory.get_num_users() == 0
+    assert bob_store.get_private_key(b'1') is None
@@ -0,0 +1,10 @@
+from libMLS.local_key_store_mock import LocalKeyStoreMock
+
+
+def test_fetch_init_keys_falls_back_to_single_fetches():
+    alice_store = LocalKeyStoreMock('alice')
+    alice_store.register_keypair(b'0', b'0')
+    bob_store = LocalKeyStoreMock('bob')
+    bob_store.register_keypair(b'1', b'1')
+
+    assert alice_store.fetch_init_keys(['alice', 'bob', 'nobody']) == {'alice': b'0', 'bob': b'1', 'nobody': None}
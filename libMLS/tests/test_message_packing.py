@@ -4,8 +4,10 @@ from typing import List, Dict
 
 import pytest
 
+from libMLS.abstract_message import AbstractMessage
 from libMLS.message_packer import pack_dynamic, MP_LENGTH_FIELD_SIZE, DynamicPackingException, \
-    unpack_dynamic, unpack_byte_list, MP_BYTE_ORDERING
+    unpack_dynamic, unpack_byte_list, MP_BYTE_ORDERING, unpack_dynamic_from, iter_byte_list, MessageWriter, \
+    calc_packed_size, FrameDecoder, FrameDecodingError, frame
 
 
 def test_plain_vector():
@@ -105,3 +107,144 @@ def test_non_binary_must_fail():
     for case in cases:
         with pytest.raises(DynamicPackingException):
             pack_dynamic('V', case)
+
+
+def test_invalid_formats_and_buffers_must_fail():
+    with pytest.raises(DynamicPackingException):
+        pack_dynamic('2V', b'a', b'b')
+
+    with pytest.raises(DynamicPackingException):
+        pack_dynamic('L2', 1)
+
+    with pytest.raises(struct.error):
+        unpack_dynamic('LV', pack_dynamic('LV', 1, b'abc')[:-1])
+
+
+def test_unpack_from_offset():
+    first = pack_dynamic('LV', 1337, b'a' * 10)
+    second = pack_dynamic('VL', b'b' * 20, 7331)
+    buffer = first + second
+
+    values, offset = unpack_dynamic_from('LV', buffer)
+    assert values == (1337, b'a' * 10)
+    assert offset == len(first)
+
+    values, offset = unpack_dynamic_from('VL', buffer, offset, copy_vectors=False)
+    assert isinstance(values[0], memoryview)
+    assert values[0] == b'b' * 20
+    assert values[1] == 7331
+    assert offset == len(buffer)
+
+
+def test_iter_byte_list_does_not_copy():
+    buffer = pack_dynamic('V', b'a' * 32) + pack_dynamic('V', b'') + pack_dynamic('V', b'b' * 64)
+
+    entries = list(iter_byte_list(buffer))
+    assert all(isinstance(entry, memoryview) for entry in entries)
+    assert [bytes(entry) for entry in entries] == unpack_byte_list(buffer) == [b'a' * 32, b'', b'b' * 64]
+
+    with pytest.raises(struct.error):
+        list(iter_byte_list(buffer[:-1]))
+
+
+def test_message_writer_matches_pack_dynamic():
+    cases: Dict[string, List] = {
+        'V': [b'a' * 10],
+        'LVL': [1337, b'b' * 16, 7331],
+        '32sV': [b'a' * 32, b''],
+        '2LB': [1, 2, 3],
+    }
+
+    for fmt_string, arguments in cases.items():
+        # the writer has to grow its buffer, if no size is given
+        writer = MessageWriter()
+        writer.write(fmt_string, *arguments)
+
+        assert writer.getvalue() == pack_dynamic(fmt_string, *arguments)
+        assert writer.get_size() == calc_packed_size(fmt_string, *arguments)
+
+
+def test_message_writer_vectors():
+    writer = MessageWriter(2)
+    position = writer.begin_vector()
+    writer.write('VL', b'abc', 42)
+    writer.end_vector(position)
+
+    assert writer.getvalue() == pack_dynamic('V', pack_dynamic('VL', b'abc', 42))
+
+
+def test_message_with_only_pack_is_written():
+    class PackOnlyMessage(AbstractMessage):
+        def _pack(self) -> bytes:
+            return b'abc'
+
+        def validate(self) -> bool:
+            return True
+
+    writer = MessageWriter()
+    writer.write_message_vector(PackOnlyMessage())
+
+    assert PackOnlyMessage().packed_size() == 3
+    assert writer.getvalue() == pack_dynamic('V', b'abc')
+
+
+def test_message_without_pack_or_write_is_rejected():
+    class EmptyMessage(AbstractMessage):
+        def validate(self) -> bool:
+            return True
+
+    with pytest.raises(NotImplementedError):
+        EmptyMessage().pack()
+
+    with pytest.raises(NotImplementedError):
+        EmptyMessage().packed_size()
+
+    with pytest.raises(NotImplementedError):
+        EmptyMessage().write(MessageWriter())
+
+
+def test_frame_decoder_reassembles_chunks():
+    payloads = [b'a' * 10, b'', b'b' * 300, b'c']
+    stream = b''.join(frame(payload) for payload in payloads)
+
+    for chunk_size in [1, 3, 7, len(stream)]:
+        decoder = FrameDecoder(bytes)
+        decoded = []
+        for offset in range(0, len(stream), chunk_size):
+            decoded += decoder.feed(stream[offset:offset + chunk_size])
+
+        assert decoded == payloads
+        assert decoder.get_num_pending_bytes() == 0
+
+
+def test_frame_decoder_enforces_max_frame_size():
+    decoder = FrameDecoder(bytes, max_frame_size=16)
+    assert decoder.feed(frame(b'a' * 16)) == [b'a' * 16]
+
+    with pytest.raises(DynamicPackingException):
+        decoder.feed(frame(b'a' * 17)[:MP_LENGTH_FIELD_SIZE])
+
+    # the corrupt stream is dropped, the frames before the oversized one are kept
+    assert decoder.get_num_pending_bytes() == 0
+    with pytest.raises(FrameDecodingError) as error:
+        decoder.feed(frame(b'one') + frame(b'a' * 17) + frame(b'two'))
+    assert error.value.frames == [b'one']
+    assert decoder.get_num_pending_bytes() == 0
+    assert decoder.feed(frame(b'three')) == [b'three']
+
+
+def test_frame_decoder_skips_frames_which_fail_to_decode():
+    def decode(frame_view: memoryview) -> bytes:
+        if frame_view == b'bad':
+            raise RuntimeError('bad frame')
+        return bytes(frame_view)
+
+    stream = frame(b'one') + frame(b'bad') + frame(b'two') + frame(b'three')
+    decoder = FrameDecoder(decode)
+    with pytest.raises(FrameDecodingError) as error:
+        decoder.feed(stream[:-2])
+
+    assert error.value.frames == [b'one', b'two']
+    assert [str(frame_error) for frame_error in error.value.errors] == ['bad frame']
+    assert decoder.feed(stream[-2:]) == [b'three']
+    assert decoder.get_num_pending_bytes() == 0
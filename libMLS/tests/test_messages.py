@@ -1,11 +1,17 @@
 # pylint: disable=unexpected-keyword-arg,too-many-function-args
+import inspect
 import os
 
 import pytest
 
 from libMLS.messages import UpdateMessage, DirectPathNode, HPKECiphertext, WelcomeInfoMessage, AddMessage, \
     MLSCiphertext, ContentType, MLSPlaintext, MLSPlaintextHandshake, GroupOperation, GroupOperationType, \
-    MLSPlaintextApplicationData
+    MLSPlaintextApplicationData, RemoveMessage, BulkRemoveMessage, PROTOCOL_VERSION_COMPACT_TREE, \
+    PROTOCOL_VERSION_DRAFT_07, negotiate_protocol_version
+from libMLS import messages
+from libMLS.message_schema import SchemaMessage, FieldSpec, UInt8, UInt32, EnumField, FixedOpaque, Opaque
+from libMLS.message_packer import FrameDecoder, frame, pack_dynamic, unpack_dynamic
+from libMLS.message_views import UpdateMessageView, MLSPlaintextView
 from libMLS.tree_node import TreeNode
 
 
@@ -45,6 +51,60 @@ def test_update_message():
     assert DirectPathNode.from_bytes(direct_path_node1.pack()) == direct_path_node1
 
     assert UpdateMessage.from_bytes(message.pack()) == message
+    assert message.packed_size() == len(message.pack())
+
+
+def test_update_message_view():
+    direct_path = [DirectPathNode(os.urandom(32), [])]
+    for level in range(1, 4):
+        direct_path.append(DirectPathNode(os.urandom(32), [HPKECiphertext(os.urandom(32), os.urandom(level * 16))
+                                                           for _ in range(level)]))
+    message = UpdateMessage(direct_path)
+
+    view = UpdateMessageView.from_bytes(message.pack())
+    assert len(view.direct_path) == len(direct_path)
+    assert not view.direct_path[0].encrypted_path_secret
+    assert view.direct_path[-1].public_key == direct_path[-1].public_key
+    assert view.direct_path[2].encrypted_path_secret[1] == direct_path[2].encrypted_path_secret[1]
+    assert [node.public_key for node in view.direct_path[1:]] == [node.public_key for node in direct_path[1:]]
+    assert view.to_message() == message
+
+    with pytest.raises(RuntimeError):
+        len(UpdateMessageView.from_bytes(message.pack()[:-1]).direct_path[3].encrypted_path_secret)
+
+
+def test_update_message_view_validates_unread_ciphertexts():
+    valid = HPKECiphertext(os.urandom(32), os.urandom(16))
+    # the key of the second ciphertext is one byte short, the cipher text is prefixed with a length of 16
+    short_key = os.urandom(31) + b'\x00\x00\x00\x10' + os.urandom(16)
+    node = os.urandom(32) + pack_dynamic('V', pack_dynamic('VV', valid.pack(), short_key))
+    packed = pack_dynamic('V', pack_dynamic('VV', DirectPathNode(os.urandom(32), []).pack(), node))
+
+    with pytest.raises(RuntimeError):
+        UpdateMessage.from_bytes(packed)
+
+    view = UpdateMessageView.from_bytes(packed)
+    # only the first ciphertext is accessed, it is valid
+    assert view.direct_path[1].encrypted_path_secret[0] == valid
+    assert not view.validate()
+    assert UpdateMessageView.from_bytes(UpdateMessage([DirectPathNode(os.urandom(32), [valid])]).pack()).validate()
+
+
+def test_plaintext_view():
+    update = UpdateMessage([DirectPathNode(os.urandom(32), [])])
+    plaintext = MLSPlaintext(group_id=b'hello', epoch=42, sender=7, content_type=ContentType.HANDSHAKE,
+                             content=MLSPlaintextHandshake(confirmation=0,
+                                                           group_operation=GroupOperation.from_instance(update)),
+                             signature=b'signature')
+
+    view = MLSPlaintextView.from_bytes(plaintext.pack())
+    assert view.group_id == b'hello'
+    assert view.epoch == 42
+    assert view.sender == 7
+    assert view.signature == b'signature'
+    assert view.get_group_operation().msg_type == GroupOperationType.UPDATE
+    assert view.get_group_operation().get_update().to_message() == update
+    assert view.to_message() == plaintext
 
 
 def test_tree_node():
@@ -82,6 +142,88 @@ def test_welcome_info_message():
 
     message.tree = tree
     assert WelcomeInfoMessage.from_bytes(message.pack()) == message
+    assert message.packed_size() == len(message.pack())
+
+
+def test_welcome_info_message_compact_tree():
+    tree = [
+        TreeNode(public_key=b'a' * 32, credentials=b'alice'),
+        None,
+        None,
+        None,
+        TreeNode(public_key=b'c' * 32),
+        None,
+        None,
+        None,
+        TreeNode(public_key=b'e' * 32, credentials=b'eve')
+    ]
+
+    message = WelcomeInfoMessage(
+        protocol_version=PROTOCOL_VERSION_COMPACT_TREE,
+        group_id=b'00000001',
+        epoch=42,
+        tree=tree,
+        interim_transcript_hash=b'a' * 32,
+        init_secret=b'b' * 32,
+        key=b'c' * 32,
+        nounce=b'd' * 32
+    )
+
+    packed = message.pack()
+    assert message.packed_size() == len(packed)
+
+    unpacked = WelcomeInfoMessage.from_bytes(packed)
+    assert unpacked == message
+    assert [node.get_credentials() if node else None for node in unpacked.tree] == \
+           [b'alice', None, None, None, None, None, None, None, b'eve']
+
+    legacy = WelcomeInfoMessage.from_bytes(packed)
+    legacy.protocol_version = PROTOCOL_VERSION_DRAFT_07
+    assert len(packed) < len(legacy.pack())
+
+    # node e without its credentials
+    tree_vector = unpack_dynamic('VVIV', packed)[3]
+    with pytest.raises(RuntimeError):
+        WelcomeInfoMessage.from_bytes(pack_dynamic('VVIVVVVV', PROTOCOL_VERSION_COMPACT_TREE, b'', 0, tree_vector[:-7],
+                                                   b'', b'', b'', b''))
+
+    # a welcome never contains private keys
+    message.tree = [TreeNode(public_key=b'a' * 32, private_key=b'a' * 32)]
+    with pytest.raises(RuntimeError):
+        message.pack()
+
+    message.tree = []
+    assert WelcomeInfoMessage.from_bytes(message.pack()) == message
+
+
+def test_negotiate_protocol_version():
+    assert negotiate_protocol_version(None) == PROTOCOL_VERSION_DRAFT_07
+    assert negotiate_protocol_version([b'unknown']) == PROTOCOL_VERSION_DRAFT_07
+    assert negotiate_protocol_version([PROTOCOL_VERSION_DRAFT_07, PROTOCOL_VERSION_COMPACT_TREE]) == \
+           PROTOCOL_VERSION_COMPACT_TREE
+
+
+def test_remove_messages():
+    direct_path = [
+        DirectPathNode(os.urandom(32), []),
+        DirectPathNode(os.urandom(32), [HPKECiphertext(os.urandom(32), b'a' * 32)])
+    ]
+
+    # pylint: disable=unexpected-keyword-arg
+    remove = RemoveMessage(removed=3, direct_path=direct_path)
+    assert RemoveMessage.from_bytes(remove.pack()) == remove
+
+    bulk_remove = BulkRemoveMessage(removed=[1, 4, 7], direct_path=direct_path)
+    assert BulkRemoveMessage.from_bytes(bulk_remove.pack()) == bulk_remove
+
+    # a removed vector of 11 bytes, with the last byte of the third leaf cut off
+    packed = bulk_remove.pack()
+    with pytest.raises(RuntimeError):
+        BulkRemoveMessage.from_bytes((11).to_bytes(4, 'big') + packed[4:15] + packed[16:])
+
+    group_op = GroupOperation.from_instance(bulk_remove)
+    assert group_op.msg_type == GroupOperationType.BULK_REMOVE
+    assert GroupOperation.from_bytes(group_op.pack()) == group_op
 
 
 @pytest.mark.dependency(name="test_add_message")
@@ -106,6 +248,99 @@ def test_ciphertext_message():
     assert MLSCiphertext.from_bytes(message.pack()) == message
 
 
+def test_ciphertext_peek_header():
+    # pylint: disable=unexpected-keyword-arg
+    message = MLSCiphertext(
+        group_id=b'helloworld',
+        epoch=1337,
+        content_type=ContentType.APPLICATION,
+        sender_data_nounce=b'steffensoddemann',
+        encrypted_sender_data=b'mepmep',
+        ciphertext=b'topsecrit'
+    )
+
+    header = MLSCiphertext.peek_header(message.pack())
+    assert header.group_id == b'helloworld'
+    assert header.epoch == 1337
+    assert header.content_type == ContentType.APPLICATION
+
+    with pytest.raises(RuntimeError):
+        MLSCiphertext.peek_header(message.pack()[:8])
+
+
+def test_frame_decoder_yields_ciphertexts():
+    messages = [MLSCiphertext(group_id=b'group', epoch=epoch, content_type=ContentType.APPLICATION,
+                              sender_data_nounce=b'0', encrypted_sender_data=b'0', ciphertext=os.urandom(epoch))
+                for epoch in range(1, 6)]
+    stream = b''.join(frame(message.pack()) for message in messages)
+
+    decoder = FrameDecoder(MLSCiphertext.from_bytes)
+    header_decoder = FrameDecoder(MLSCiphertext.peek_header)
+    decoded = []
+    headers = []
+    for offset in range(0, len(stream), 13):
+        decoded += decoder.feed(stream[offset:offset + 13])
+        headers += header_decoder.feed(stream[offset:offset + 13])
+
+    assert decoded == messages
+    assert [header.epoch for header in headers] == [message.epoch for message in messages]
+
+
+def test_generated_schema_methods():
+    message = HPKECiphertext(ephemeral_key=b'a' * 32, cipher_text=b'secret')
+
+    assert not hasattr(message, '__dict__')
+    assert message.packed_size() == len(message.pack())
+    assert HPKECiphertext.from_bytes(message.pack()) == message
+    assert message != HPKECiphertext(ephemeral_key=b'a' * 32, cipher_text=b'other')
+
+    with pytest.raises(RuntimeError):
+        HPKECiphertext.from_bytes(message.pack()[:-1])
+
+    # length bounds of the RFC
+    with pytest.raises(RuntimeError):
+        HPKECiphertext(ephemeral_key=b'a', cipher_text=b'').pack()
+
+    with pytest.raises(RuntimeError):
+        HPKECiphertext(ephemeral_key=b'a' * 32, cipher_text=b'a' * 2 ** 16).pack()
+
+    with pytest.raises(RuntimeError):
+        MLSCiphertext(group_id=b'a' * 256, epoch=0, content_type=ContentType.APPLICATION, sender_data_nounce=b'',
+                      encrypted_sender_data=b'', ciphertext=b'').pack()
+
+
+def _get_example_value(field_spec: FieldSpec):
+    if isinstance(field_spec, (UInt8, UInt32)):
+        return 200
+    if isinstance(field_spec, EnumField):
+        return list(field_spec.enum_type)[-1]
+    if isinstance(field_spec, FixedOpaque):
+        return os.urandom(field_spec.length)
+    if isinstance(field_spec, Opaque):
+        return os.urandom(min(field_spec.max_length, 40))
+    raise TypeError(field_spec)
+
+
+def test_schema_messages_round_trip():
+    schema_classes = [cls for cls in vars(messages).values()
+                      if isinstance(cls, type) and issubclass(cls, SchemaMessage) and cls is not SchemaMessage]
+    assert len(schema_classes) == 5
+
+    for cls in schema_classes:
+        message = cls(**{name: _get_example_value(field_spec) for name, field_spec in cls.SCHEMA})
+        packed = message.pack()
+
+        assert cls.from_bytes(packed) == message
+        assert message.packed_size() == len(packed)
+
+        with pytest.raises(RuntimeError):
+            cls.from_bytes(packed[:-1])
+
+        # the generated code can be inspected like any other source
+        assert inspect.getsource(cls.from_bytes).startswith('def from_bytes(cls, data):')
+        assert 'def _pack(self):' in cls.SCHEMA_SOURCE
+
+
 @pytest.mark.dependency(name="test_plaintext_message", depends=[test_add_message])
 def test_plaintext_message():
     add_message = AddMessage(index=1337, init_key=os.urandom(32), welcome_info_hash=os.urandom(32))
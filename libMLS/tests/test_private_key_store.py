@@ -0,0 +1,42 @@
+import os
+import stat
+import tempfile
+
+import pytest
+
+from libMLS.private_key_store import PrivateKeyStore, SQLitePrivateKeyStore
+
+
+def create_stores(path: str):
+    return [PrivateKeyStore(), SQLitePrivateKeyStore(path)]
+
+
+@pytest.mark.parametrize('store_index', [0, 1])
+def test_add_get_and_delete(store_index: int):
+    with tempfile.TemporaryDirectory() as directory:
+        store = create_stores(os.path.join(directory, 'keys.sqlite'))[store_index]
+
+        store.add_keypairs([(b'public%d' % index, b'private%d' % index) for index in range(100)])
+        assert len(store) == 100
+        assert store.get_private_key(b'public42') == b'private42'
+        assert store.get_private_key(b'unknown') is None
+
+        store.delete_keys([b'public42', b'unknown'])
+        assert store.get_private_key(b'public42') is None
+        assert len(store) == 99
+        store.close()
+
+
+def test_sqlite_store_is_persistent():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'keys.sqlite')
+
+        store = SQLitePrivateKeyStore(path)
+        store.add_keypairs([(b'public', b'private')])
+        store.close()
+
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+        store = SQLitePrivateKeyStore(path)
+        assert store.get_private_key(b'public') == b'private'
+        store.close()
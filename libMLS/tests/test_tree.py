@@ -107,3 +107,24 @@ def test_tree_hash_with_blank_intermediate():
 
     assert tree.get_tree_hash() == \
            b't}\xf5\x07\x80_\xfdu\x1d\xdd\xbf\xb8d~\xe0\xca,\xa2\xbe\xactl\x02\xc8\xb4\xf4]]\x91\xb1C~'
+
+
+def test_remove_leaf_blanks_path_and_truncates():
+    tree: Tree = Tree(cipher_suite=X25519CipherSuite())
+
+    for name in [b'A', b'B', b'C', b'D']:
+        tree.add_leaf(TreeNode(b'public' + name, None, name))
+    tree.set_node(3, TreeNode(b'publicRoot'))
+    tree.set_node(5, TreeNode(b'publicCD'))
+
+    tree.remove_leaf(2)
+    assert tree.get_node(4) is None
+    assert tree.get_node(5) is None and tree.get_node(3) is None
+
+    tree.truncate()
+    assert tree.get_num_leaves() == 4
+
+    tree.remove_leaf(3)
+    tree.truncate()
+    assert tree.get_num_leaves() == 2
+    assert tree.get_num_nodes() == 3